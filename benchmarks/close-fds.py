@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+# vim: ts=4:sw=4:et:ai:sts=4
+
+import getopt, nemu.subprocess_, os, os.path, resource, sys, time
+
+__doc__ = """Measures the latency of spawning a process with close_fds, as a
+function of the limit of open files, for the different ways of closing the
+inherited descriptors."""
+
+def usage(f):
+    f.write("Usage: %s [-n PROCESSES]\n%s\n\n" %
+            (os.path.basename(sys.argv[0]), __doc__))
+    f.write("  -n, --processes=NUM  Number of processes to start for each " +
+            "measurement (default: 20)\n")
+
+def close_loop(lowfd, keep = None):
+    # What spawn() used to do
+    for i in xrange(lowfd, nemu.subprocess_.MAXFD):
+        if i != keep:
+            try:
+                os.close(i)
+            except:
+                pass
+
+def close_proc(lowfd, keep = None):
+    for fd in [int(x) for x in os.listdir("/proc/self/fd")]:
+        if fd >= lowfd and fd != keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+methods = [
+        ("close_range", nemu.subprocess_._close_fds_from),
+        ("/proc/self/fd", close_proc),
+        ("loop", close_loop),
+        ]
+
+def run(count):
+    null = os.open("/dev/null", os.O_RDWR)
+    start = time.time()
+    for i in xrange(count):
+        pid = nemu.subprocess_.spawn("/bin/true", stdin = null, stdout = null,
+                stderr = null, close_fds = True)
+        nemu.subprocess_.wait(pid)
+    os.close(null)
+    return time.time() - start
+
+def main():
+    count = 20
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:", ["help", "processes="])
+        for (k, v) in opts:
+            if k in ("-h", "--help"):
+                usage(sys.stdout)
+                return 0
+            if k in ("-n", "--processes"):
+                count = int(v)
+    except (getopt.GetoptError, ValueError), e:
+        sys.stderr.write("%s\n\n" % e)
+        usage(sys.stderr)
+        return 2
+
+    # Measure the fork path, which is the one that closes descriptors itself
+    nemu.subprocess_.USE_POSIX_SPAWN = False
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    maxlimit = hard
+    try:
+        # root can raise the hard limit up to fs.nr_open
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, 1048576))
+        maxlimit = 1048576
+    except (ValueError, resource.error):
+        pass
+    limits = [x for x in (1024, 65536, 1048576)
+            if maxlimit == resource.RLIM_INFINITY or x <= maxlimit]
+    orig = nemu.subprocess_._close_fds_from
+    print "%-10s" % "rlimit" + "".join("%16s" % m[0] for m in methods) + \
+            "   (ms per process)"
+    try:
+        for limit in limits:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, maxlimit))
+            nemu.subprocess_.MAXFD = limit
+            line = "%-10d" % limit
+            for name, func in methods:
+                nemu.subprocess_._close_fds_from = func
+                line += "%16.3f" % (run(count) * 1e3 / count)
+            print line
+    finally:
+        nemu.subprocess_._close_fds_from = orig
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
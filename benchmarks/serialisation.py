@@ -0,0 +1,77 @@
+#!/usr/bin/env python2
+# vim: ts=4:sw=4:et:ai:sts=4
+
+import cPickle, getopt, nemu.iproute, nemu.protocol, os.path, sys, time
+
+__doc__ = """Compares the decoding cost of the control protocol payloads against
+the pickle-based encoding that was used previously."""
+
+def usage(f):
+    f.write("Usage: %s [-n RECORDS] [-r REPETITIONS]\n%s\n\n" %
+            (os.path.basename(sys.argv[0]), __doc__))
+    f.write("  -n, --records=NUM    Number of records per payload " +
+            "(default: 100)\n")
+    f.write("  -r, --repeat=NUM     Number of decodings to time " +
+            "(default: 1000)\n")
+
+def sample_data(n):
+    ifaces = [nemu.iproute.interface(index = i, name = "eth%d" % i,
+        up = True, mtu = 1500, lladdr = "02:00:00:00:%02x:%02x" % (
+            i / 256, i % 256), broadcast = "ff:ff:ff:ff:ff:ff",
+        multicast = True, arp = True) for i in range(1, n + 1)]
+    ifdata = (dict((i.index, i) for i in ifaces),
+            dict((i.name, i) for i in ifaces))
+    addrs = ({}, {})
+    for i in ifaces:
+        addrs[0][i.index] = addrs[1][i.name] = [
+                nemu.iproute.ipv4address("10.%d.%d.1" % (i.index / 256,
+                    i.index % 256), 24, "10.%d.%d.255" % (i.index / 256,
+                        i.index % 256)),
+                nemu.iproute.ipv6address("fe80::%x" % i.index, 64)]
+    routes = [nemu.iproute.route(prefix = "10.%d.%d.0" % (i / 256, i % 256),
+        prefix_len = 24, nexthop = "10.0.0.1", interface = 1)
+        for i in range(1, n + 1)]
+    return [("interfaces", ifdata, n), ("addresses", addrs, 2 * n),
+            ("routes", routes, n)]
+
+def timeit(func, data, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        func(data)
+    return time.time() - start
+
+def main():
+    records = 100
+    repeat = 1000
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:r:",
+                ["help", "records=", "repeat="])
+        for (k, v) in opts:
+            if k in ("-h", "--help"):
+                usage(sys.stdout)
+                return 0
+            if k in ("-n", "--records"):
+                records = int(v)
+            if k in ("-r", "--repeat"):
+                repeat = int(v)
+    except (getopt.GetoptError, ValueError), e:
+        sys.stderr.write("%s\n\n" % e)
+        usage(sys.stderr)
+        return 2
+
+    print "%-12s %10s %10s %12s %12s %8s" % ("payload", "pickle B",
+            "nemu B", "pickle us/r", "nemu us/r", "speedup")
+    for name, obj, nrec in sample_data(records):
+        pickled = cPickle.dumps(obj, protocol = 2)
+        encoded = nemu.protocol._serialise(obj)
+        assert repr(nemu.protocol._unserialise(encoded)) == repr(obj)
+        t_pickle = timeit(cPickle.loads, pickled, repeat)
+        t_nemu = timeit(nemu.protocol._unserialise, encoded, repeat)
+        per = 1e6 / (repeat * nrec)
+        print "%-12s %10d %10d %12.3f %12.3f %7.2fx" % (name, len(pickled),
+                len(encoded), t_pickle * per, t_nemu * per,
+                t_pickle / t_nemu)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
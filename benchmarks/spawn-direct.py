@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+# vim: ts=4:sw=4:et:ai:sts=4
+
+import getopt, nemu, os, os.path, sys, threading, time
+
+__doc__ = """Compares the rate of process launches from several threads into
+the same node, through the node server and with the direct setns path.
+Requires root privileges."""
+
+def usage(f):
+    f.write("Usage: %s [-n PROCESSES] [-t THREADS]\n%s\n\n" %
+            (os.path.basename(sys.argv[0]), __doc__))
+    f.write("  -n, --processes=NUM  Number of processes to start per thread " +
+            "(default: 200)\n")
+    f.write("  -t, --threads=NUM    Number of launching threads " +
+            "(default: 4)\n")
+
+def run(node, count, threads, direct):
+    null = os.open("/dev/null", os.O_RDWR)
+    procs = []
+    def launch():
+        for i in xrange(count):
+            procs.append(node.Subprocess(["true"], stdout = null,
+                direct = direct))
+    workers = [threading.Thread(target = launch) for i in xrange(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+    nemu.wait_all(procs)
+    os.close(null)
+    return elapsed
+
+def main():
+    count = 200
+    threads = 4
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:t:",
+                ["help", "processes=", "threads="])
+        for (k, v) in opts:
+            if k in ("-h", "--help"):
+                usage(sys.stdout)
+                return 0
+            if k in ("-n", "--processes"):
+                count = int(v)
+            if k in ("-t", "--threads"):
+                threads = int(v)
+    except (getopt.GetoptError, ValueError), e:
+        sys.stderr.write("%s\n\n" % e)
+        usage(sys.stderr)
+        return 2
+
+    node = nemu.Node()
+    total = count * threads
+    print "%-12s %10s %10s" % ("method", "total s", "procs/s")
+    for name, direct in (("server", False), ("direct", True)):
+        t = run(node, count, threads, direct)
+        print "%-12s %10.3f %10.0f" % (name, t, total / t)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
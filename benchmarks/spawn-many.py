@@ -0,0 +1,51 @@
+#!/usr/bin/env python2
+# vim: ts=4:sw=4:et:ai:sts=4
+
+import getopt, nemu, os, os.path, sys, time
+
+__doc__ = """Compares the rate of process launches in a node, one request per
+process against a single PROC SPMN request for all of them."""
+
+def usage(f):
+    f.write("Usage: %s [-n PROCESSES]\n%s\n\n" %
+            (os.path.basename(sys.argv[0]), __doc__))
+    f.write("  -n, --processes=NUM  Number of processes to start " +
+            "(default: 1000)\n")
+
+def main():
+    count = 1000
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:", ["help", "processes="])
+        for (k, v) in opts:
+            if k in ("-h", "--help"):
+                usage(sys.stdout)
+                return 0
+            if k in ("-n", "--processes"):
+                count = int(v)
+    except (getopt.GetoptError, ValueError), e:
+        sys.stderr.write("%s\n\n" % e)
+        usage(sys.stderr)
+        return 2
+
+    node = nemu.Node(nonetns = True)
+    null = os.open("/dev/null", os.O_RDWR)
+    print "%-12s %10s %10s" % ("method", "total s", "procs/s")
+
+    start = time.time()
+    procs = [node.Subprocess(["true", str(i)], stdout = null)
+            for i in xrange(count)]
+    t = time.time() - start
+    nemu.wait_all(procs)
+    print "%-12s %10.3f %10.0f" % ("Subprocess", t, count / t)
+
+    start = time.time()
+    procs = node.spawn_many([{"argv": ["true", str(i)], "stdout": null}
+        for i in xrange(count)])
+    t = time.time() - start
+    nemu.wait_all(procs)
+    print "%-12s %10.3f %10.0f" % ("spawn_many", t, count / t)
+    os.close(null)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python2
+# vim: ts=4:sw=4:et:ai:sts=4
+
+import getopt, nemu.subprocess_, os, os.path, sys, time
+
+__doc__ = """Compares the cost of starting processes with posix_spawn and with
+fork and exec, as done by the node servers."""
+
+def usage(f):
+    f.write("Usage: %s [-n PROCESSES] [-m MEGABYTES]\n%s\n\n" %
+            (os.path.basename(sys.argv[0]), __doc__))
+    f.write("  -n, --processes=NUM  Number of processes to start " +
+            "(default: 1000)\n")
+    f.write("  -m, --memory=NUM     Memory to allocate first, to simulate " +
+            "a big server (default: 0)\n")
+
+def run(count):
+    null = os.open("/dev/null", os.O_RDWR)
+    start = time.time()
+    for i in xrange(count):
+        pid = nemu.subprocess_.spawn("/bin/true", stdin = null, stdout = null,
+                stderr = null)
+        nemu.subprocess_.wait(pid)
+    os.close(null)
+    return time.time() - start
+
+def main():
+    count = 1000
+    memory = 0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:m:",
+                ["help", "processes=", "memory="])
+        for (k, v) in opts:
+            if k in ("-h", "--help"):
+                usage(sys.stdout)
+                return 0
+            if k in ("-n", "--processes"):
+                count = int(v)
+            if k in ("-m", "--memory"):
+                memory = int(v)
+    except (getopt.GetoptError, ValueError), e:
+        sys.stderr.write("%s\n\n" % e)
+        usage(sys.stderr)
+        return 2
+
+    ballast = "x" * (memory * 1024 * 1024)
+    print "%-12s %10s %10s" % ("method", "total s", "us/proc")
+    for name, fast in (("posix_spawn", True), ("fork", False)):
+        nemu.subprocess_.USE_POSIX_SPAWN = fast
+        t = run(count)
+        print "%-12s %10.3f %10.1f" % (name, t, t * 1e6 / count)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
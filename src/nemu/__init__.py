@@ -27,6 +27,8 @@ and run and test programs in them.
 import os, pwd
 from nemu.node import *
 from nemu.interface import *
+from nemu.collector import *
+from nemu.subprocess_ import PIPE, STDOUT, SPOOL, wait_any, wait_all
 
 class _Config(object):
     """Global configuration singleton for Nemu."""
@@ -0,0 +1,448 @@
+# vim:ts=4:sw=4:et:ai:sts=4
+# -*- coding: utf-8 -*-
+
+# Copyright 2010, 2011 INRIA
+# Copyright 2011 Martina Ferrari <tina@tina.pm>
+#
+# This file is part of Nemu.
+#
+# Nemu is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 2, as published by the Free
+# Software Foundation.
+#
+# Nemu is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nemu.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Event loop based interface to nodes and their processes, built on trollius
+(the Python 2 version of asyncio). Each AsyncNode talks to its node through
+its own connection, read from the event loop, so any number of nodes can be
+driven from a single thread. Coroutines use the trollius syntax:
+
+    proc = yield From(anode.Popen(["ping", "-c1", "10.0.0.2"],
+        stdout = nemu.PIPE))
+    out, err = yield From(proc.communicate())
+"""
+
+import errno, os, passfd, signal, socket
+import trollius as asyncio
+from trollius import From, Return
+import nemu.iproute, nemu.protocol, nemu.subprocess_
+from nemu.environ import *
+from nemu.protocol import _decode_rusage, _encode_args, _frame_hdr, \
+        _pack_args, _reply_hdr, _serialise, _unserialise
+
+__all__ = ['AsyncClient', 'AsyncNode', 'AsyncPopen']
+
+class AsyncClient(object):
+    """Asynchronous counterpart of nemu.protocol.Client: commands return
+    futures, and replies are read by the event loop. Commands are pipelined
+    on the connection in binary mode."""
+    def __init__(self, sock, loop = None):
+        """`sock' is a connection to a node server, freshly opened (e.g. with
+        Client.open_connection()); it is owned by this object from now
+        on."""
+        self._sock = sock
+        self._loop = loop or asyncio.get_event_loop()
+        self._rbuf = bytearray()
+        self._nextid = 1
+        self._futures = {}
+        self._handshake()
+        self._loop.add_reader(sock.fileno(), self._readable)
+
+    def _handshake(self):
+        # Short exchange in text mode; it does not really block.
+        self._read_line(220)
+        self._sock.sendall("MODE BIN\n")
+        self._read_line(200)
+
+    def _read_line(self, expected):
+        while True:
+            line = []
+            while not line or line[-1] != "\n":
+                c = self._sock.recv(1)
+                if not c:
+                    raise RuntimeError("Protocol error, connection closed")
+                line.append(c)
+            line = "".join(line)
+            if line[3] == " ":
+                break
+        if int(line[0:3]) != expected:
+            raise RuntimeError("Error from slave: %s" % line.strip())
+
+    def _readable(self):
+        try:
+            data = self._sock.recv(256 * 1024)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = None
+        if not data:
+            self._fail(RuntimeError("Protocol error, connection closed"))
+            return
+        self._rbuf.extend(data)
+        while len(self._rbuf) >= _frame_hdr.size:
+            size, reqid = _frame_hdr.unpack_from(buffer(self._rbuf))
+            if len(self._rbuf) < _frame_hdr.size + size:
+                break
+            body = str(self._rbuf[_frame_hdr.size:_frame_hdr.size + size])
+            del self._rbuf[:_frame_hdr.size + size]
+            code, tsize = _reply_hdr.unpack_from(body)
+            text = body[_reply_hdr.size:_reply_hdr.size + tsize]
+            payload = body[_reply_hdr.size + tsize:]
+            fut = self._futures.pop(reqid, None)
+            if fut and not fut.cancelled():
+                fut.set_result((code, text, payload))
+
+    def _fail(self, exc):
+        "The connection is gone: fail everything in flight."
+        if self._sock:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+        futures, self._futures = self._futures, {}
+        for fut in futures.values():
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def _send(self, *args):
+        """Send a command, and return a future for its reply as (code, text,
+        payload)."""
+        reqid = self._write(args)
+        fut = self._futures[reqid] = asyncio.Future(loop = self._loop)
+        return fut
+
+    def _write(self, args):
+        if not self._sock:
+            raise RuntimeError("Client already shut down.")
+        reqid = self._nextid
+        self._nextid = (self._nextid % 0xffffffff) + 1
+        body = _pack_args(_encode_args(args, True))
+        # The socket is blocking: writes only wait if the server is not
+        # keeping up, and keep the descriptors passed afterwards in order.
+        self._sock.sendall(_frame_hdr.pack(len(body), reqid) + body)
+        return reqid
+
+    @asyncio.coroutine
+    def call(self, *args):
+        """Run a command in the server; returns the text and the payload of
+        the reply, or raises the error."""
+        code, text, payload = yield From(self._send(*args))
+        raise Return(_check_reply(code, text, payload))
+
+    @asyncio.coroutine
+    def _call_data(self, *args):
+        text, payload = yield From(self.call(*args))
+        raise Return(_unserialise(payload))
+
+    def close(self):
+        "Close the connection; the node and its processes are not affected."
+        self._fail(RuntimeError("Client already shut down."))
+
+    @asyncio.coroutine
+    def spawn(self, argv, executable = None, stdin = None, stdout = None,
+            stderr = None, cwd = None, env = None, user = None,
+            env_template = None):
+        """Start a process in the node; see nemu.protocol.Client.spawn().
+        Returns its pid."""
+        if executable == None:
+            executable = argv[0]
+        flags = 0
+        fds = []
+        for flag, fd in ((nemu.protocol.SPAWN_STDIN, stdin),
+                (nemu.protocol.SPAWN_STDOUT, stdout),
+                (nemu.protocol.SPAWN_STDERR, stderr)):
+            if fd != None:
+                flags |= flag
+                fds.append(fd)
+        envdata = ""
+        if env_template != None:
+            flags |= nemu.protocol.SPAWN_ENV | nemu.protocol.SPAWN_TEMPLATE
+            envdata = _serialise((env_template, env or {}))
+        elif env != None:
+            flags |= nemu.protocol.SPAWN_ENV
+            params = []
+            for k, v in env.items():
+                params.extend([k, v])
+            envdata = _pack_args(_encode_args(params, True))
+        fut = self._send("PROC", "SPAWN", flags, user or "", cwd or "",
+                envdata, executable, *argv)
+        # Nothing can be sent between the command and the descriptors, so
+        # this does not yield until they are all out.
+        error = None
+        for fd in fds:
+            if error == None:
+                try:
+                    passfd.sendfd(self._sock, fd, "F")
+                    continue
+                except Exception, e:
+                    error = e
+            self._sock.sendall("-")
+        code, text, payload = yield From(fut)
+        if error != None:
+            raise error
+        raise Return(int(_check_reply(code, text, payload)[0].split()[0]))
+
+    @asyncio.coroutine
+    def wait(self, pid, rusage = False):
+        """Wait for a process to finish, without blocking the loop. Returns
+        the exit status, or (status, resource usage) if `rusage' is True."""
+        text, payload = yield From(self.call("PROC", "WAIT", pid))
+        if rusage:
+            raise Return((int(text.split()[0]), _decode_rusage(payload)))
+        raise Return(int(text.split()[0]))
+
+    @asyncio.coroutine
+    def poll(self, pid, rusage = False):
+        code, text, payload = yield From(self._send("PROC", "POLL", pid))
+        if code / 100 == 4:
+            raise Return(None)
+        text, payload = _check_reply(code, text, payload)
+        if rusage:
+            raise Return((int(text.split()[0]), _decode_rusage(payload)))
+        raise Return(int(text.split()[0]))
+
+    @asyncio.coroutine
+    def signal(self, pid, sig = signal.SIGTERM):
+        yield From(self.call("PROC", "KILL", pid, sig))
+
+    def get_if_data(self, ifnr = None):
+        if ifnr:
+            return self._call_data("IF", "LIST", ifnr)
+        return self._call_data("IF", "LIST")
+
+    def set_if(self, interface):
+        cmd = ["IF", "SET", interface.index]
+        for k in interface.changeable_attributes:
+            v = getattr(interface, k)
+            if v != None:
+                cmd += [k, str(v)]
+        return self.call(*cmd)
+
+    def get_addr_data(self, ifnr = None):
+        if ifnr:
+            return self._call_data("ADDR", "LIST", ifnr)
+        return self._call_data("ADDR", "LIST")
+
+    def add_addr(self, ifnr, address):
+        if getattr(address, "broadcast", None):
+            return self.call("ADDR", "ADD", ifnr, address.address,
+                    address.prefix_len, address.broadcast)
+        return self.call("ADDR", "ADD", ifnr, address.address,
+                address.prefix_len)
+
+    def del_addr(self, ifnr, address):
+        return self.call("ADDR", "DEL", ifnr, address.address,
+                address.prefix_len)
+
+    def get_route_data(self):
+        return self._call_data("ROUT", "LIST")
+
+    def add_route(self, route):
+        return self._add_del_route("ADD", route)
+
+    def del_route(self, route):
+        return self._add_del_route("DEL", route)
+
+    def _add_del_route(self, action, route):
+        return self.call("ROUT", action, route.tipe, route.prefix,
+                route.prefix_len or 0, route.nexthop, route.interface or 0,
+                route.metric or 0)
+
+def _check_reply(code, text, payload):
+    if code == 550:
+        raise _unserialise(payload)
+    if code / 100 != 2:
+        raise RuntimeError("Error from slave: %d %s" % (code, text))
+    return text, payload
+
+class AsyncNode(object):
+    """Asynchronous interface to a nemu.Node, through a connection of its
+    own. Operations inside the node are coroutines; creating interfaces also
+    needs to run commands in this namespace, which is done in the default
+    executor of the loop."""
+    def __init__(self, node, loop = None):
+        self.node = node
+        self._loop = loop or asyncio.get_event_loop()
+        self._client = AsyncClient(node._slave.open_connection(), self._loop)
+
+    @property
+    def client(self):
+        return self._client
+
+    def close(self):
+        self._client.close()
+
+    @asyncio.coroutine
+    def add_if(self, **kwargs):
+        """Create an interface in the node; see Node.add_if(). The attributes
+        given are set through this connection."""
+        iface = yield From(self._loop.run_in_executor(None, self.node.add_if))
+        if kwargs:
+            data = nemu.iproute.interface(index = iface.index, **kwargs)
+            yield From(self._client.set_if(data))
+        raise Return(iface)
+
+    @asyncio.coroutine
+    def get_interfaces(self):
+        "Return the interfaces of the node, as nemu.iproute.interface objects."
+        ifaces = yield From(self._client.get_if_data())
+        raise Return(sorted(ifaces.values(), key = lambda x: x.index))
+
+    def add_addr(self, iface, address):
+        return self._client.add_addr(getattr(iface, "index", iface), address)
+
+    def route(self, *args, **kwargs):
+        return self.node.route(*args, **kwargs)
+
+    def add_route(self, *args, **kwargs):
+        # Accepts either a route object or all its constructor's parameters
+        if len(args) == 1 and not kwargs:
+            r = args[0]
+        else:
+            r = self.route(*args, **kwargs)
+        return self._client.add_route(r)
+
+    def del_route(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs:
+            r = args[0]
+        else:
+            r = self.route(*args, **kwargs)
+        return self._client.del_route(r)
+
+    def get_routes(self):
+        return self._client.get_route_data()
+
+    @asyncio.coroutine
+    def Popen(self, argv, **kwargs):
+        "Start a process in the node; returns an AsyncPopen."
+        proc = AsyncPopen(self, argv, **kwargs)
+        yield From(proc._start())
+        raise Return(proc)
+
+class AsyncPopen(object):
+    """Asynchronous counterpart of nemu.subprocess_.Popen. PIPE'd descriptors
+    are asyncio streams: `stdout' and `stderr' are StreamReaders and `stdin'
+    is a StreamWriter. Use AsyncNode.Popen() to create it."""
+    def __init__(self, anode, argv, executable = None, stdin = None,
+            stdout = None, stderr = None, shell = False, cwd = None,
+            env = None, user = None, env_template = None):
+        if isinstance(argv, str):
+            argv = [ argv ]
+        if shell:
+            argv = [ '/bin/sh', '-c' ] + argv
+        if user == None:
+            user = nemu.subprocess_.Subprocess.default_user
+        self._anode = anode
+        self._loop = anode._loop
+        self._args = (argv, executable, cwd, env, user, env_template)
+        self._fdmap = { "stdin": stdin, "stdout": stdout, "stderr": stderr }
+        self.stdin = self.stdout = self.stderr = None
+        self.pid = self._returncode = self.rusage = None
+
+    @asyncio.coroutine
+    def _start(self):
+        fdmap = self._fdmap
+        pipes = {}
+        try:
+            for k, v in fdmap.items():
+                if v == nemu.subprocess_.PIPE:
+                    r, w = os.pipe()
+                    pipes[k] = (w, r) if k == "stdin" else (r, w)
+                    fdmap[k] = pipes[k][1]
+                elif v != None and not isinstance(v, int):
+                    fdmap[k] = v.fileno()
+            if fdmap["stderr"] == nemu.subprocess_.STDOUT:
+                fdmap["stderr"] = fdmap["stdout"]
+            argv, executable, cwd, env, user, env_template = self._args
+            self.pid = yield From(self._anode._client.spawn(argv,
+                executable = executable, stdin = fdmap["stdin"],
+                stdout = fdmap["stdout"], stderr = fdmap["stderr"],
+                cwd = cwd, env = env, user = user,
+                env_template = env_template))
+        finally:
+            # Close the ends that were dup()ed to the child
+            for ours, theirs in pipes.values():
+                os.close(theirs)
+            if self.pid == None:
+                for ours, theirs in pipes.values():
+                    os.close(ours)
+        for k, (ours, theirs) in pipes.items():
+            if k == "stdin":
+                f = os.fdopen(ours, "wb", 0)
+                transport, protocol = yield From(
+                        self._loop.connect_write_pipe(
+                            lambda: asyncio.streams.FlowControlMixin(
+                                loop = self._loop), f))
+                self.stdin = asyncio.StreamWriter(transport, protocol, None,
+                        self._loop)
+            else:
+                f = os.fdopen(ours, "rb", 0)
+                reader = asyncio.StreamReader(loop = self._loop)
+                yield From(self._loop.connect_read_pipe(
+                    lambda: asyncio.StreamReaderProtocol(reader,
+                        loop = self._loop), f))
+                setattr(self, k, reader)
+
+    @property
+    def returncode(self):
+        "As in nemu.subprocess_.Popen."
+        if self._returncode == None:
+            return None
+        if os.WIFSIGNALED(self._returncode):
+            return -os.WTERMSIG(self._returncode)
+        return os.WEXITSTATUS(self._returncode)
+
+    @asyncio.coroutine
+    def wait(self):
+        "Wait for the process to finish, and return its exit code."
+        if self._returncode == None:
+            self._returncode, self.rusage = yield From(
+                    self._anode._client.wait(self.pid, rusage = True))
+        raise Return(self.returncode)
+
+    @asyncio.coroutine
+    def poll(self):
+        if self._returncode == None:
+            r = yield From(self._anode._client.poll(self.pid, rusage = True))
+            if r != None:
+                self._returncode, self.rusage = r
+        raise Return(self.returncode)
+
+    def signal(self, sig = signal.SIGTERM):
+        if self._returncode != None:
+            return _done(self._loop)
+        return self._anode._client.signal(self.pid, sig)
+
+    @asyncio.coroutine
+    def communicate(self, input = None):
+        """Send `input' to the process, read all its output and wait for it
+        to finish. Returns (stdout, stderr) as in Popen.communicate()."""
+        @asyncio.coroutine
+        def feed():
+            if input:
+                self.stdin.write(input)
+                yield From(self.stdin.drain())
+            self.stdin.close()
+
+        tasks = []
+        if self.stdin != None:
+            tasks.append(feed())
+        for reader in self.stdout, self.stderr:
+            if reader != None:
+                tasks.append(reader.read())
+        results = yield From(asyncio.gather(*tasks, loop = self._loop))
+        if self.stdin != None:
+            results.pop(0)
+        out = results.pop(0) if self.stdout != None else None
+        err = results.pop(0) if self.stderr != None else None
+        yield From(self.wait())
+        raise Return((out, err))
+
+def _done(loop):
+    fut = asyncio.Future(loop = loop)
+    fut.set_result(None)
+    return fut
@@ -0,0 +1,263 @@
+# vim:ts=4:sw=4:et:ai:sts=4
+# -*- coding: utf-8 -*-
+
+# Copyright 2010, 2011 INRIA
+# Copyright 2011 Martina Ferrari <tina@tina.pm>
+#
+# This file is part of Nemu.
+#
+# Nemu is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 2, as published by the Free
+# Software Foundation.
+#
+# Nemu is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nemu.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections, errno, fcntl, os, os.path, re, select, threading, time
+from nemu.environ import *
+
+__all__ = ['OutputCollector']
+
+class OutputCollector(object):
+    """Collects the output of any number of processes with a single epoll
+    loop, running in its own thread. Each line is timestamped and kept in a
+    bounded ring buffer per process, and optionally appended to a log file;
+    tail() and grep() can be used while the processes are running."""
+    def __init__(self, ring_size = 256 * 1024, directory = None,
+            max_line = 64 * 1024):
+        """`ring_size' is the maximum number of bytes of output kept in memory
+        for each process; older lines are discarded. If `directory' is given,
+        the complete output of each process is also written to
+        `directory'/<name>.log, as lines of "<timestamp> <stream> <text>".
+        Lines longer than `max_line' are split."""
+        self._ring_size = ring_size
+        self._directory = directory
+        self._max_line = max_line
+        self._lock = threading.Lock()
+        self._epoll = select.epoll()
+        self._procs = {}    # name -> _Output
+        self._fds = {}      # fd -> (output, stream name, file)
+        self._closed = False
+        # Pipes and log files are only closed by the loop, which uses them
+        # without holding the lock: removed processes wait here
+        self._removed = []
+        # Wakes up the loop when the set of descriptors changes
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._epoll.register(self._wakeup[0], select.EPOLLIN)
+        self._thread = threading.Thread(target = self._run,
+                name = "nemu-collector")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, popen, name = None):
+        """Start collecting the output of a Popen object, whose stdout and/or
+        stderr must have been created with PIPE. `name' identifies it in the
+        queries, by default its pid. Returns the name."""
+        if name == None:
+            name = popen.pid
+        streams = [(s, getattr(popen, s)) for s in ("stdout", "stderr")
+                if getattr(popen, s) != None]
+        if not streams:
+            raise ValueError("Process has no pipes to collect.")
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Collector already closed.")
+            if name in self._procs:
+                raise ValueError("Name already in use: %s" % name)
+            logfile = None
+            if self._directory:
+                logfile = open(os.path.join(self._directory, "%s.log" % name),
+                        "a")
+            output = self._procs[name] = _Output(name, self._ring_size,
+                    self._max_line, logfile)
+            for stream, f in streams:
+                output.open_streams += 1
+                self._fds[f.fileno()] = (output, stream, f)
+                self._epoll.register(f.fileno(),
+                        select.EPOLLIN | select.EPOLLHUP)
+        return name
+
+    def remove(self, name):
+        """Stop collecting the output of a process, and discard it. Its pipes
+        are closed."""
+        with self._lock:
+            output = self._procs.pop(name)
+            if self._thread.is_alive():
+                self._removed.append(output)
+            else:
+                self._close_output(output)
+        self._wake()
+
+    def names(self):
+        "Return the names of the processes being (or having been) collected."
+        with self._lock:
+            return self._procs.keys()
+
+    def finished(self, name):
+        "Return True if the process has closed all its output."
+        with self._lock:
+            return self._procs[name].open_streams == 0
+
+    def tail(self, name, lines = 10, stream = None):
+        """Return the last `lines' lines of output of a process, as a list of
+        (timestamp, stream, line) tuples. `stream' can be "stdout" or
+        "stderr" to only get one of them."""
+        with self._lock:
+            ring = self._procs[name].ring
+            ret = []
+            for entry in reversed(ring):
+                if len(ret) >= lines:
+                    break
+                if stream == None or entry[1] == stream:
+                    ret.append(entry)
+        ret.reverse()
+        return ret
+
+    def grep(self, pattern, name = None, stream = None):
+        """Search the collected output (of process `name', or of all) for a
+        regular expression. Returns a list of (name, timestamp, stream, line)
+        tuples, in order of arrival for each process."""
+        regex = re.compile(pattern)
+        with self._lock:
+            if name == None:
+                outputs = self._procs.values()
+            else:
+                outputs = [self._procs[name]]
+            ret = []
+            for output in outputs:
+                for ts, s, line in output.ring:
+                    if (stream == None or s == stream) and regex.search(line):
+                        ret.append((output.name, ts, s, line))
+        return ret
+
+    def close(self):
+        "Stop the loop, and close every pipe and log file."
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake()
+        self._thread.join()
+        with self._lock:
+            for output in self._removed + self._procs.values():
+                self._close_output(output)
+            self._removed = []
+        self._epoll.close()
+        for fd in self._wakeup:
+            os.close(fd)
+
+    def _wake(self):
+        try:
+            os.write(self._wakeup[1], "x")
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _unregister(self, fd):
+        "Stop watching a pipe and close it. Must be called with the lock."
+        output, stream, f = self._fds.pop(fd)
+        self._epoll.unregister(fd)
+        f.close()
+        output.open_streams -= 1
+
+    def _close_output(self, output):
+        "Close the pipes and log file of a process; needs the lock."
+        for fd, (o, stream, f) in self._fds.items():
+            if o is output:
+                self._unregister(fd)
+        output.close()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                events = self._epoll.poll()
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            now = time.time()
+            with self._lock:
+                for output in self._removed:
+                    self._close_output(output)
+                self._removed = []
+                ready = [(fd, self._fds[fd]) for fd, event in events
+                        if fd in self._fds]
+            if self._wakeup[0] in [fd for fd, event in events]:
+                try:
+                    while os.read(self._wakeup[0], 4096):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            # The pipes and log files can be used without the lock, as only
+            # this thread closes them; it is only needed for the ring.
+            for fd, (output, stream, f) in ready:
+                data = eintr_wrapper(os.read, fd, 65536)
+                lines = output.feed(now, stream, data)
+                with self._lock:
+                    output.store(lines)
+                    if not data:
+                        self._unregister(fd)
+                output.log(lines)
+
+class _Output(object):
+    "Output of one process: ring buffer of lines, and optional log file."
+    def __init__(self, name, ring_size, max_line, logfile):
+        self.name = name
+        self.ring = collections.deque()
+        self.open_streams = 0
+        self._size = 0
+        self._ring_size = ring_size
+        self._max_line = max_line
+        self._logfile = logfile
+        self._partial = {}
+
+    def feed(self, ts, stream, data):
+        """Split the data in lines, and return them as (timestamp, stream,
+        line) tuples; lines longer than the maximum are split too. Empty data
+        means end of file, and flushes the last incomplete line."""
+        if not data:
+            rest = self._partial.pop(stream, "")
+            return [(ts, stream, rest)] if rest else []
+        lines = (self._partial.pop(stream, "") + data).split("\n")
+        rest = lines.pop()
+        ret = []
+        for line in lines:
+            while len(line) > self._max_line:
+                ret.append((ts, stream, line[:self._max_line]))
+                line = line[self._max_line:]
+            ret.append((ts, stream, line))
+        while len(rest) >= self._max_line:
+            ret.append((ts, stream, rest[:self._max_line]))
+            rest = rest[self._max_line:]
+        if rest:
+            self._partial[stream] = rest
+        return ret
+
+    def store(self, lines):
+        "Add lines to the ring buffer. Must be called with the lock."
+        for entry in lines:
+            self.ring.append(entry)
+            self._size += len(entry[2])
+        while self._size > self._ring_size and len(self.ring) > 1:
+            self._size -= len(self.ring.popleft()[2])
+
+    def log(self, lines):
+        "Append lines to the log file, with a single write."
+        if self._logfile and lines:
+            self._logfile.write("".join("%.6f %s %s\n" % entry
+                for entry in lines))
+            self._logfile.flush()
+
+    def close(self):
+        if self._logfile:
+            self._logfile.close()
+            self._logfile = None
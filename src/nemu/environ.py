@@ -17,13 +17,13 @@
 # You should have received a copy of the GNU General Public License along with
 # Nemu.  If not, see <http://www.gnu.org/licenses/>.
 
-import errno, os, os.path, socket, subprocess, sys, syslog
+import errno, os, os.path, socket, subprocess, sys, syslog, time
 from syslog import LOG_ERR, LOG_WARNING, LOG_NOTICE, LOG_INFO, LOG_DEBUG
 
 
 __all__ = ["IP_PATH", "TC_PATH", "BRCTL_PATH", "SYSCTL_PATH", "HZ"]
 __all__ += ["TCPDUMP_PATH", "NETPERF_PATH", "XAUTH_PATH", "XDPYINFO_PATH"]
-__all__ += ["execute", "backticks", "eintr_wrapper"]
+__all__ += ["execute", "backticks", "eintr_wrapper", "child_times"]
 __all__ += ["find_listen_port"]
 __all__ += ["LOG_ERR", "LOG_WARNING", "LOG_NOTICE", "LOG_INFO", "LOG_DEBUG"]
 __all__ += ["set_log_level", "logger"]
@@ -75,6 +75,23 @@ except:
     raise RuntimeError("Sysfs does not seem to be mounted, impossible to " +
             "continue.")
 
+# Number of runs and time spent in each external command: name -> [n, secs]
+_child_times = {}
+
+def child_times(reset = False):
+    """Return a dictionary with the number of times each external program was
+    run by execute() and backticks(), and the total time spent on them, as
+    (count, seconds) tuples. If `reset' is True, the counters are cleared."""
+    ret = dict((k, tuple(v)) for k, v in _child_times.items())
+    if reset:
+        _child_times.clear()
+    return ret
+
+def _account_child(cmd, start):
+    t = _child_times.setdefault(os.path.basename(cmd[0]), [0, 0.0])
+    t[0] += 1
+    t[1] += time.time() - start
+
 def execute(cmd):
     """Execute a command, if the return value is non-zero, raise an exception.
     
@@ -82,9 +99,11 @@ def execute(cmd):
         RuntimeError: the command was unsuccessful (return code != 0).
     """
     debug("execute(%s)" % cmd)
+    start = time.time()
     null = open("/dev/null", "r+")
     proc = subprocess.Popen(cmd, stdout = null, stderr = subprocess.PIPE)
     _, err = proc.communicate()
+    _account_child(cmd, start)
     if proc.returncode != 0:
         raise RuntimeError("Error executing `%s': %s" % (" ".join(cmd), err))
 
@@ -98,9 +117,11 @@ def backticks(cmd):
         RuntimeError: the command was unsuccessful (return code != 0).
     """
     debug("backticks(%s)" % cmd)
+    start = time.time()
     proc = subprocess.Popen(cmd, stdout = subprocess.PIPE,
             stderr = subprocess.PIPE)
     out, err = proc.communicate()
+    _account_child(cmd, start)
     if proc.returncode != 0:
         raise RuntimeError("Error executing `%s': %s" % (" ".join(cmd), err))
     return out
@@ -678,6 +678,137 @@ def _add_del_route(action, route):
         cmd += ["dev", _get_if_name(route.interface)]
     execute(cmd)
 
+# Netlink change notifications
+
+# Kinds of changes that can be watched, see watch_changes()
+WATCH_LINK = 1
+WATCH_ADDR = 2
+WATCH_ROUTE = 4
+
+_nlmsghdr = struct.Struct("=IHHII")
+_rtattr = struct.Struct("=HH")
+_ifinfomsg = struct.Struct("=BxHiII")
+_ifaddrmsg = struct.Struct("=BBBBI")
+_rtmsg = struct.Struct("=BBBBBBBBI")
+_u32 = struct.Struct("=I")
+
+# rtnetlink multicast groups for each kind of change
+_watch_groups = {
+        WATCH_LINK:     0x1,                # RTMGRP_LINK
+        WATCH_ADDR:     0x10 | 0x100,       # RTMGRP_IPV{4,6}_IFADDR
+        WATCH_ROUTE:    0x40 | 0x400,       # RTMGRP_IPV{4,6}_ROUTE
+        }
+# Message types: RTM_{NEW,DEL}{LINK,ADDR,ROUTE}
+_rtm_types = {
+        16: ("link", "new"), 17: ("link", "del"),
+        20: ("addr", "new"), 21: ("addr", "del"),
+        24: ("route", "new"), 25: ("route", "del"),
+        }
+# Route types, indexed by rtm_type
+_rtn_types = [None, "unicast", "local", "broadcast", None, "multicast",
+        "blackhole", "unreachable", "prohibit", "throw", "nat"]
+_RT_TABLE_MAIN = 254
+_IFF_UP = 0x1
+_IFF_NOARP = 0x80
+_IFF_MULTICAST = 0x1000
+
+def watch_changes(kinds = WATCH_LINK | WATCH_ADDR | WATCH_ROUTE):
+    """Open a netlink socket that receives the changes in links, addresses
+    and/or routes of the current network namespace, as selected by `kinds'.
+    Read the messages with parse_changes()."""
+    groups = 0
+    for kind, group in _watch_groups.items():
+        if kinds & kind:
+            groups |= group
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0) # NETLINK_ROUTE
+    try:
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        sock.bind((0, groups))
+    except:
+        sock.close()
+        raise
+    return sock
+
+def parse_changes(data):
+    """Parse the messages read from a watch_changes() socket. Returns a list
+    of (kind, action, index, obj) tuples: kind is "link", "addr" or "route";
+    action is "new" or "del"; index is the interface affected; and obj is the
+    interface, address or route object described by the message."""
+    ret = []
+    for mtype, body in _split_nlmsgs(data):
+        if mtype not in _rtm_types:
+            continue
+        kind, action = _rtm_types[mtype]
+        if kind == "link":
+            _, _, idx, flags, _ = _ifinfomsg.unpack_from(body)
+            attrs = _parse_rtattrs(body, _ifinfomsg.size)
+            lladdr = broadcast = mtu = None
+            if 1 in attrs and len(attrs[1]) == 6:   # IFLA_ADDRESS
+                lladdr = _format_lladdr(attrs[1])
+            if 2 in attrs and len(attrs[2]) == 6:   # IFLA_BROADCAST
+                broadcast = _format_lladdr(attrs[2])
+            if 4 in attrs:                          # IFLA_MTU
+                mtu = _u32.unpack_from(attrs[4])[0]
+            obj = interface(idx, attrs.get(3, "").rstrip("\0") or None,
+                    bool(flags & _IFF_UP), mtu, lladdr, broadcast,
+                    bool(flags & _IFF_MULTICAST), not flags & _IFF_NOARP)
+        elif kind == "addr":
+            family, plen, _, _, idx = _ifaddrmsg.unpack_from(body)
+            attrs = _parse_rtattrs(body, _ifaddrmsg.size)
+            # IFA_LOCAL is the address, IFA_ADDRESS the peer on p2p links
+            addr = attrs.get(2, attrs.get(1))
+            if family == socket.AF_INET and addr:
+                brd = attrs.get(4)                  # IFA_BROADCAST
+                obj = ipv4address(socket.inet_ntop(family, addr), plen,
+                        socket.inet_ntop(family, brd) if brd else None)
+            elif family == socket.AF_INET6 and addr:
+                obj = ipv6address(socket.inet_ntop(family, addr), plen)
+            else:
+                continue
+        else:
+            family, plen, _, _, table, _, _, rtype, _ = _rtmsg.unpack_from(body)
+            attrs = _parse_rtattrs(body, _rtmsg.size)
+            if 15 in attrs:                         # RTA_TABLE
+                table = _u32.unpack_from(attrs[15])[0]
+            tipe = _rtn_types[rtype] if rtype < len(_rtn_types) else None
+            idx = _u32.unpack_from(attrs[4])[0] if 4 in attrs else None
+            nexthop = attrs.get(5)                  # RTA_GATEWAY
+            if table != _RT_TABLE_MAIN or not tipe or not (nexthop or idx):
+                continue
+            prefix = attrs.get(1)                   # RTA_DST
+            metric = _u32.unpack_from(attrs[6])[0] if 6 in attrs else 0
+            obj = route(tipe,
+                    socket.inet_ntop(family, prefix) if plen else None,
+                    plen, socket.inet_ntop(family, nexthop) if nexthop
+                    else None, idx, metric)
+        ret.append((kind, action, idx, obj))
+    return ret
+
+def _split_nlmsgs(data):
+    "Split a netlink datagram in (type, body) tuples."
+    pos = 0
+    while pos + _nlmsghdr.size <= len(data):
+        length, mtype, _, _, _ = _nlmsghdr.unpack_from(data, pos)
+        if length < _nlmsghdr.size:
+            break
+        yield mtype, data[pos + _nlmsghdr.size:pos + length]
+        pos += (length + 3) & ~3
+
+def _parse_rtattrs(data, pos):
+    "Parse routing attributes into a dictionary of type -> raw value."
+    attrs = {}
+    while pos + _rtattr.size <= len(data):
+        length, atype = _rtattr.unpack_from(data, pos)
+        if length < _rtattr.size:
+            break
+        attrs[atype & 0x3fff] = data[pos + _rtattr.size:pos + length]
+        pos += (length + 3) & ~3
+    return attrs
+
+def _format_lladdr(raw):
+    return ":".join("%02x" % ord(c) for c in raw)
+
 # TC stuff
 
 def get_tc_tree():
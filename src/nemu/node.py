@@ -17,9 +17,10 @@
 # You should have received a copy of the GNU General Public License along with
 # Nemu.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, socket, sys, traceback, unshare, weakref
+import contextlib, fcntl, os, signal, socket, sys, threading, traceback
+import unshare, weakref
 from nemu.environ import *
-import nemu.interface, nemu.protocol, nemu.subprocess_
+import nemu.interface, nemu.iproute, nemu.protocol, nemu.subprocess_
 
 __all__ = ['Node', 'get_nodes', 'import_if']
 
@@ -43,6 +44,10 @@ class Node(object):
         self._processes = weakref.WeakValueDictionary()
         self._interfaces = weakref.WeakValueDictionary()
         self._auto_interfaces = [] # just to keep them alive!
+        # Descriptor of the network name space, for direct launches
+        self._nonetns = nonetns
+        self._netns = None
+        self._netns_lock = threading.Lock()
 
         fd, pid = _start_child(nonetns)
         self._pid = pid
@@ -66,8 +71,17 @@ class Node(object):
         if not self._pid:
             return
         debug("Node(0x%x).destroy()" % id(self))
-        for p in self._processes.values():
-            p.destroy()
+        # Give all the processes KILL_WAIT seconds in total to finish
+        procs = [p for p in self._processes.values()
+                if p._pid != None and p._returncode == None]
+        for p in procs:
+            p.signal()
+        left = nemu.subprocess_.wait_all(procs, nemu.subprocess_.KILL_WAIT)[1]
+        for p in left:
+            sys.stderr.write("WARNING: killing forcefully process %d.\n" %
+                    p.pid)
+            p.signal(signal.SIGKILL)
+        nemu.subprocess_.wait_all(left)
         self._processes.clear()
 
         # Use get_interfaces to force a rescan
@@ -77,6 +91,9 @@ class Node(object):
 
         if self._slave:
             self._slave.shutdown()
+        if self._netns != None:
+            os.close(self._netns)
+            self._netns = None
 
         exitcode = eintr_wrapper(os.waitpid, self._pid, 0)[1]
         if exitcode != 0:
@@ -88,6 +105,19 @@ class Node(object):
     def pid(self):
         return self._pid
 
+    def _get_netns(self):
+        """Return a descriptor of the network name space of the node, opened
+        the first time; None if the node has none of its own."""
+        if self._nonetns:
+            return None
+        with self._netns_lock:
+            if self._netns == None:
+                self._netns = os.open("/proc/%d/ns/net" % self._pid,
+                        os.O_RDONLY)
+                fd = fcntl.fcntl(self._netns, fcntl.F_GETFD)
+                fcntl.fcntl(self._netns, fcntl.F_SETFD, fd | fcntl.FD_CLOEXEC)
+            return self._netns
+
     # Subprocesses
     def _add_subprocess(self, subprocess):
         self._processes[subprocess.pid] = subprocess
@@ -98,6 +128,48 @@ class Node(object):
     def Popen(self, *kargs, **kwargs):
         return nemu.subprocess_.Popen(self, *kargs, **kwargs)
 
+    def spawn_many(self, *kargs, **kwargs):
+        return nemu.subprocess_.spawn_many(self, *kargs, **kwargs)
+
+    def set_env_template(self, name, env):
+        """Store the environment `env' in the node server as `name'. Processes
+        started with env_template = name then only send the changes to it."""
+        self._slave.set_env_template(name, env)
+
+    def del_env_template(self, name):
+        "Remove an environment template from the node server."
+        self._slave.del_env_template(name)
+
+    def flush_user_cache(self):
+        """Make the node forget the users it has resolved to start processes;
+        see nemu.subprocess_.resolve_user()."""
+        self._slave.flush_user_cache()
+
+    def set_user_cache_ttl(self, ttl):
+        "Set for how many seconds the node caches resolved users."
+        self._slave.set_user_cache_ttl(ttl)
+
+    def call(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) inside the node, as root, in a process
+        forked from the node server (or in a pooled worker, see
+        set_workers()), and return the result. Exceptions are raised here,
+        with the traceback in `child_traceback'. The callable, its arguments
+        and the result are pickled: func must be importable from the node,
+        e.g. a module-level function defined before the node was created."""
+        return self._slave.call(func, *args, **kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """Like call(), but does not wait for the result: returns a
+        CallResult object."""
+        return CallResult(self._slave, self._slave.submit(func, *args,
+            **kwargs))
+
+    def set_workers(self, count):
+        """Keep up to `count' worker processes in the node to run call() and
+        submit(), so repeated calls do not fork. With 0 (the default), each
+        call runs in a process of its own."""
+        self._slave.set_call_pool(count)
+
     def system(self, *kargs, **kwargs):
         return nemu.subprocess_.system(self, *kargs, **kwargs)
 
@@ -107,6 +179,38 @@ class Node(object):
     def backticks_raise(self, *kargs, **kwargs):
         return nemu.subprocess_.backticks_raise(self, *kargs, **kwargs)
 
+    # Sockets; socket() is defined last, so it does not hide the module
+    # in the default arguments
+    def create_connection(self, address, timeout = None,
+            source_address = None):
+        """As socket.create_connection(), from inside the node. Names are
+        resolved inside the node too."""
+        if timeout == None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        with nemu.subprocess_._in_netns(self._get_netns()):
+            return socket.create_connection(address, timeout, source_address)
+
+    def bind(self, address, family = socket.AF_INET, type = socket.SOCK_STREAM,
+            proto = 0):
+        """Create a socket in the node and bind it to `address'. The address
+        can be reused right away, as usual for servers."""
+        s = self.socket(family, type, proto)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(address)
+        except:
+            s.close()
+            raise
+        return s
+
+    def socket(self, family = socket.AF_INET, type = socket.SOCK_STREAM,
+            proto = 0):
+        """Create a socket in the network name space of the node, to be used
+        from this process: no process needs to be started to generate or
+        receive traffic."""
+        with nemu.subprocess_._in_netns(self._get_netns()):
+            return socket.socket(family, type, proto)
+
     # Interfaces
     def _add_interface(self, interface):
         self._interfaces[interface.index] = interface
@@ -182,6 +286,87 @@ class Node(object):
     def get_routes(self):
         return self._slave.get_route_data()
 
+    def watch(self, callback, kinds = nemu.iproute.WATCH_LINK |
+            nemu.iproute.WATCH_ADDR | nemu.iproute.WATCH_ROUTE):
+        """Get notified of the changes in links, addresses and routes inside
+        the node; see nemu.protocol.Client.watch()."""
+        self._slave.watch(callback, kinds)
+
+    def unwatch(self):
+        "Stop the change notifications."
+        self._slave.unwatch()
+
+    def process_events(self, timeout = None):
+        """Wait up to `timeout' seconds for notifications from the node and
+        run their callbacks."""
+        return self._slave.process_events(timeout)
+
+    def get_stats(self, reset = False):
+        """Return the statistics of the control plane of this node; see
+        nemu.protocol.Client.get_stats()."""
+        return self._slave.get_stats(reset)
+
+    def start_profiler(self):
+        "Start profiling the node server process."
+        self._slave.start_profiler()
+
+    def stop_profiler(self):
+        "Stop profiling the node server, and return a pstats.Stats object."
+        return self._slave.stop_profiler()
+
+    def listen(self, path, uids = ()):
+        """Accept connections to the control socket of this node on a UNIX
+        socket at `path', so other processes can use it through
+        nemu.protocol.Client.connect(). Names starting with "@" are in the
+        abstract namespace, only reachable from inside the node. Only root,
+        the owner of the node, and the users in `uids' can connect. The
+        latter can configure the network of the node, but do not become root
+        in it: their processes run as them, they can only signal those, and
+        they cannot use call(), environment templates or X11 forwarding."""
+        self._slave.listen(path, uids)
+
+    @contextlib.contextmanager
+    def batch(self, atomic = True):
+        """Context manager that sends all the configuration changes made
+        inside it (interface attributes, addresses and routes) to the node in
+        a single request when the block ends. Querying the node is not
+        possible inside the block.
+
+        If `atomic' is True, the first failure rolls back all the changes and
+        the error is raised."""
+        self._slave.begin_batch()
+        try:
+            yield self
+        except:
+            self._slave.abort_batch()
+            raise
+        self._slave.commit_batch(atomic)
+
+class CallResult(object):
+    "Pending result of Node.submit()."
+    def __init__(self, slave, reqid):
+        self._slave = slave
+        self._reqid = reqid
+        self._done = False
+        self._value = self._error = None
+
+    def done(self):
+        "Return True if the call has finished, without blocking."
+        return self._done or self._slave.reply_ready(self._reqid)
+
+    def result(self):
+        """Wait for the call to finish, and return its result or raise its
+        exception."""
+        if not self._done:
+            try:
+                self._value = self._slave.call_result(self._reqid)
+            except BaseException, e:
+                self._error = e
+            self._done = True
+        if self._error != None:
+            raise self._error
+        return self._value
+
 # Handle the creation of the child; parent gets (fd, pid), child creates and
 # runs a Server(); never returns.
 # Requires CAP_SYS_ADMIN privileges to run.
@@ -198,7 +383,16 @@ def _start_child(nonetns):
     try: # pragma: no cover
         # coverage doesn't seem to understand fork
         s0.close()
+        # Do not count the programs run by the parent
+        child_times(reset = True)
         srv = nemu.protocol.Server(s1, s1)
+        # The default user is resolved once for the whole life of the node
+        if nemu.subprocess_.Subprocess.default_user != None:
+            try:
+                nemu.subprocess_.resolve_user(
+                        nemu.subprocess_.Subprocess.default_user, pin = True)
+            except ValueError:
+                pass # reported when starting processes
         if not nonetns:
             # create new name space
             unshare.unshare(unshare.CLONE_NEWNET)
@@ -17,16 +17,13 @@
 # You should have received a copy of the GNU General Public License along with
 # Nemu.  If not, see <http://www.gnu.org/licenses/>.
 
-import base64, errno, os, passfd, re, select, signal, socket, sys, tempfile
-import time, traceback, unshare
+import base64, bisect, collections, cProfile, errno
+import exceptions, fcntl, itertools, mmap, os, passfd, pickle, pstats, re
+import resource, select, signal
+import socket, struct, sys, tempfile, threading, time, traceback, unshare
 import nemu.subprocess_, nemu.iproute
 from nemu.environ import *
 
-try:
-    from cPickle import loads, dumps
-except:
-    from pickle import loads, dumps
-
 # ============================================================================
 # Server-side protocol implementation
 #
@@ -41,6 +38,31 @@ except:
 _proto_commands = {
         "QUIT": { None: ("", "") },
         "HELP": { None: ("", "") },
+        "MODE": {
+            "BIN":  ("", ""),
+            "SHM":  ("i", "")
+            },
+        "BATCH": { None: ("ib", "b*") },
+        "LSTN": { None: ("b", "i*") },
+        "CONN": { None: ("", "") },
+        "STAT": { None: ("", "i") },
+        "WTCH": { None: ("i", "") },
+        "ENV": {
+            "SET":  ("bb", ""),
+            "DEL":  ("b", "")
+            },
+        "USER": {
+            "FLSH": ("", ""),
+            "TTL":  ("i", "")
+            },
+        "CALL": {
+            "RUN":  ("b", ""),
+            "POOL": ("i", "")
+            },
+        "PROF": {
+            "ON":   ("", ""),
+            "OFF":  ("", "")
+            },
         "X11":  {
             "SET":  ("ss", ""),
             "SOCK": ("", "")
@@ -63,9 +85,14 @@ _proto_commands = {
             },
         "PROC": {
             "CRTE": ("b", "b*"),
+            "SPAWN": ("ibbbb", "b*"),
+            "SPMN": ("b", ""),
             "POLL": ("i", ""),
             "WAIT": ("i", ""),
-            "KILL": ("i", "i")
+            "KILL": ("i", "i"),
+            "EVNT": ("i", ""),
+            "WSET": ("ii", "i*"),
+            "WCAN": ("i", "")
             },
         }
 # Commands valid only after PROC CRTE
@@ -84,7 +111,76 @@ _proc_commands = {
             }
         }
 
+# Commands accepted inside a BATCH; the value says if the effects of the
+# command can be rolled back.
+_batch_commands = {
+        "IF LIST":      True,
+        "IF SET":       True,
+        "IF RTRN":      False,
+        "IF DEL":       False,
+        "ADDR LIST":    True,
+        "ADDR ADD":     True,
+        "ADDR DEL":     True,
+        "ROUT LIST":    True,
+        "ROUT ADD":     True,
+        "ROUT DEL":     True,
+        "PROC POLL":    True,
+        "PROC KILL":    False,
+        }
+
+# Commands refused to connections of users other than root and the owner of
+# the node (see LSTN): they would let them act as root.
+_restricted_commands = set(["CALL RUN", "CALL POOL", "ENV SET", "ENV DEL",
+    "USER FLSH", "USER TTL", "X11 SET", "X11 SOCK", "IF RTRN", "PROF ON",
+    "PROF OFF"])
+
 KILL_WAIT = 3 # seconds
+# How often to check for finished children when SIGCHLD cannot be caught
+# (the server is not running in the main thread).
+REAP_INTERVAL = 0.1 # seconds
+
+# Flags for PROC SPAWN: which file descriptors follow the command, and whether
+# the environment is given.
+SPAWN_STDIN = 1
+SPAWN_STDOUT = 2
+SPAWN_STDERR = 4
+SPAWN_ENV = 8
+# The environment is a template name and the changes to it (see ENV SET)
+SPAWN_TEMPLATE = 16
+
+# Upper bounds (in seconds) of the buckets of the latency histograms; the
+# last bucket counts everything slower.
+LATENCY_BUCKETS = [2 ** i / 1e6 for i in range(4, 25)]
+
+# Code of the unsolicited messages sent when a child exits, with request ID 0.
+EVENT_EXIT = 600
+# Code of the messages sent on link, address or route changes (WTCH).
+EVENT_CHANGE = 601
+_watch_kinds = {
+        "link": nemu.iproute.WATCH_LINK,
+        "addr": nemu.iproute.WATCH_ADDR,
+        "route": nemu.iproute.WATCH_ROUTE,
+        }
+
+# Binary mode framing: every message is preceded by the length of its body and
+# the request ID, which the server copies into the reply. Commands are a
+# sequence of length-prefixed arguments, replies carry the status code and the
+# length of the text, followed by the text and the raw payload (if any).
+_frame_hdr = struct.Struct("!II")
+_arg_hdr = struct.Struct("!I")
+_reply_hdr = struct.Struct("!HI")
+# Set in the length of a reply frame when its payload is not inline, but in a
+# shared memory file passed right after the frame. The body then ends with the
+# size of the payload.
+_FRAME_SHM = 0x80000000
+# Set when the reply carries a file descriptor, passed right after the frame
+# (X11 SOCK); it is the payload of the reply.
+_FRAME_FD = 0x40000000
+_shm_size = struct.Struct("!Q")
+
+# Payloads at least this big are passed in shared memory, unless the client
+# asks otherwise.
+SHM_THRESHOLD = 64 * 1024
 
 class Server(object):
     """Class that implements the communication protocol and dispatches calls
@@ -105,12 +201,72 @@ class Server(object):
         # X11 forwarding info
         self._xfwd = None
         self._xsock = None
+        # Binary framing, negotiated with MODE BIN
+        self._binary = False
+        # Minimum size of payloads sent in shared memory (MODE SHM)
+        self._shm_threshold = 0
+        # Input buffer
+        self._rbuf = ""
+        # ID of the request being processed, in binary mode
+        self._reqid = 0
+        # Replies captured while running a BATCH
+        self._capture = None
+        # Undo actions for an atomic BATCH
+        self._undo = None
+        # Exit status and resource usage of children not collected yet
+        self._exited = {}
+        # Requests waiting for a child to finish: pid -> list of request IDs
+        self._waiting = {}
+        # Requests waiting for any or all of a set of children (PROC WSET):
+        # request ID -> (list of pids, wait for all)
+        self._waitsets = {}
+        # Send exit notifications to the client
+        self._events = False
+        # Kinds of network changes notified to the client (WTCH), and the
+        # netlink socket that receives them (kept in the main connection)
+        self._watch = 0
+        self._nlsock = None
+        self._nlkinds = 0
+        # Self-pipe written to on SIGCHLD, and previous signal set-up
+        self._sigpipe = None
+        self._oldsig = None
+        # Whether all the children have to be checked (SIGCHLD was received),
+        # and when that was last done
+        self._sweep = True
+        self._lastsweep = 0
+        # All the connections being served; the first one is the main one,
+        # the rest share its state and are accepted from the listening socket.
+        self._conns = [self]
+        self._listener = None
+        self._listenpath = None
+        self._allowed = set()
+        # For connections of other users, their uid: their processes run as
+        # them, and some commands are refused
+        self._peer_uid = None
+        # Per-command counters and latencies, and the profiler if enabled
+        self._stats = {}
+        self._started = time.time()
+        self._profiler = None
+        # Code of the last reply sent
+        self._lastcode = None
+        # Processes running callables (CALL), kept in the main connection:
+        # size of the worker pool, idle pooled workers, workers running a
+        # call by descriptor, and calls waiting for a pooled worker
+        self._pool_size = 0
+        self._idle = []
+        self._busy = {}
+        self._calls = collections.deque()
+        # Named environments for PROC SPAWN and PROC SPMN (ENV SET)
+        self._env_templates = {}
 
         self._rfd = _get_file(rfd, "r")
         self._wfd = _get_file(wfd, "w")
 
     def clean(self):
         try:
+            # Already reaped
+            for pid in self._exited:
+                self._children.discard(pid)
             for pid in self._children:
                 # -PID to kill to whole process group
                 os.kill(-pid, signal.SIGTERM)
@@ -147,52 +303,146 @@ class Server(object):
                 except:
                     pass
 
-    def reply(self, code, text):
-        "Send back a reply to the client; handle multiline messages"
+    def reply(self, code, text, payload = None, fd = None):
+        """Send back a reply to the client. Secondary connections that went
+        away are just marked as closed, so they do not take the node down."""
+        try:
+            self._send_reply(code, text, payload, fd)
+        except (IOError, OSError), e:
+            if self is self._conns[0] or e.errno not in (errno.EPIPE,
+                    errno.ECONNRESET):
+                raise
+            self._closed = True
+
+    def _send_reply(self, code, text, payload = None, fd = None):
+        """Send back a reply to the client; handle multiline messages. If
+        `payload' is given, it is sent as raw data in binary mode, or as an
+        extra base64-encoded line in text mode. In binary mode, the file
+        descriptor (or socket) `fd' can be passed instead of a payload."""
+        self._lastcode = code
+        if self._capture != None:
+            if hasattr(text, '__iter__'):
+                text = "\n".join(text)
+            self._capture.append((code, text, payload))
+            return
+        if self._binary:
+            if hasattr(text, '__iter__'):
+                text = "\n".join(text)
+            body = _reply_hdr.pack(code, len(text)) + text
+            if fd != None:
+                _write_all(self._wfd, _frame_hdr.pack(
+                    len(body) | _FRAME_FD, self._reqid) + body)
+                try:
+                    passfd.sendfd(self._wfd, fd, "1")
+                except (IOError, OSError, RuntimeError), e:
+                    # The client expects a message; it gets no descriptor
+                    warning("Error sending file descriptor: %s" % e)
+                    _write_all(self._wfd, "1")
+            elif self._shm_threshold and payload and \
+                    len(payload) >= self._shm_threshold:
+                fd = _make_shm(payload)
+                try:
+                    body += _shm_size.pack(len(payload))
+                    _write_all(self._wfd, _frame_hdr.pack(
+                        len(body) | _FRAME_SHM, self._reqid) + body)
+                    passfd.sendfd(self._wfd, fd, "M")
+                finally:
+                    os.close(fd)
+            else:
+                body += payload or ""
+                _write_all(self._wfd,
+                        _frame_hdr.pack(len(body), self._reqid) + body)
+            debug("<Reply> %d %s" % (code, text))
+            return
+
         if not hasattr(text, '__iter__'):
             text = [ text ]
+        if payload != None:
+            text = list(text) + [ _b64(payload) ]
         clean = []
         # Split lines with embedded \n
         for i in text:
             clean.extend(i.splitlines())
         for i in range(len(clean) - 1):
             s = str(code) + "-" + clean[i] + "\n"
-            self._wfd.write(s)
+            _write_all(self._wfd, s)
             debug("<Reply> %s" % s)
 
         s = str(code) + " " + clean[-1] + "\n"
-        self._wfd.write(s)
+        _write_all(self._wfd, s)
         debug("<Reply> %s" % s)
         return
 
+    def _fill(self, size):
+        """Read from the socket until the input buffer holds at least `size'
+        bytes. Returns False on connection break-up."""
+        while len(self._rbuf) < size:
+            # Never read past the requested size: file descriptors might be
+            # piggybacked on the next message.
+            s = eintr_wrapper(os.read, self._rfd.fileno(),
+                    size - len(self._rbuf))
+            if not s:
+                self._closed = True
+                return False
+            self._rbuf += s
+        return True
+
+    def _read(self, size):
+        "Read exactly `size' bytes from the socket, or None on EOF."
+        if not self._fill(size):
+            return None
+        data, self._rbuf = self._rbuf[0:size], self._rbuf[size:]
+        return data
+
     def readline(self):
         "Read a line from the socket and detect connection break-up."
-        # FIXME: should use the eintr_wrapper from environ; why was I using
-        # readline instead of read?
-        while True:
-            try:
-                line = self._rfd.readline()
-            except IOError, e:
-                line = None
-                if e.errno == errno.EINTR:
-                    continue
-                else:
-                    raise
-            break
-        if not line:
-            self._closed = True
-            return None
+        while "\n" not in self._rbuf:
+            s = eintr_wrapper(os.read, self._rfd.fileno(), 4096)
+            if not s:
+                self._closed = True
+                return None
+            self._rbuf += s
+        line, self._rbuf = self._rbuf.split("\n", 1)
         debug("<Query> %s" % line)
         return line.rstrip()
 
+    def readframe(self):
+        """Read a binary-mode command from the socket and return its list of
+        arguments, or None on connection break-up."""
+        hdr = self._read(_frame_hdr.size)
+        if hdr == None:
+            return None
+        size, self._reqid = _frame_hdr.unpack(hdr)
+        body = self._read(size)
+        if body == None:
+            return None
+        args = _unpack_args(body)
+        debug("<Query> %s" % " ".join(args))
+        return args
+
     def readcmd(self):
         """Main entry point: read and parse a line from the client, handle
         argument validation and return a tuple (function, command_name,
         arguments)"""
-        line = self.readline()
-        if not line:
-            return None
-        args = line.split()
+        if self._binary:
+            args = self.readframe()
+            if args == None:
+                return None
+            if not args:
+                self.reply(500, "Empty command.")
+                return None
+        else:
+            line = self.readline()
+            if not line:
+                return None
+            args = line.split()
+        return self.parsecmd(args, decode = not self._binary)
+
+    def parsecmd(self, args, decode = True):
+        """Validate a command given as a list of tokens, and return a tuple
+        (function, command_name, arguments). Parameters of type "b" are
+        base64-decoded if `decode' is True. Errors are replied to the client,
+        and None is returned."""
         cmd1 = args[0].upper()
         if cmd1 not in self._commands:
             self.reply(500, "Unknown command %s." % cmd1)
@@ -246,11 +496,14 @@ class Server(object):
                             % args[i])
                     return None
             elif argstemplate[j] == 'b':
-                try:
-                    args[i] = _db64(args[i])
-                except TypeError:
-                    self.reply(500, "Invalid parameter: not base-64 encoded.")
-                    return None
+                # Binary mode arguments are not encoded
+                if decode:
+                    try:
+                        args[i] = _db64(args[i])
+                    except TypeError:
+                        self.reply(500,
+                                "Invalid parameter: not base-64 encoded.")
+                        return None
             elif argstemplate[j] != 's': # pragma: no cover
                 raise RuntimeError("Invalid argument template: %s" % _argstmpl)
             # Nothing done for "s" parameters
@@ -262,20 +515,25 @@ class Server(object):
 
     def run(self):
         """Main loop; reads commands until the server is shut down or the
-        connection is terminated."""
+        connection is terminated. Children are reaped as soon as they finish,
+        so waiting for a process does not block other commands."""
         self.reply(220, "Hello.");
-        while not self._closed:
-            cmd = self.readcmd()
-            if cmd == None:
-                continue
-            try:
-                cmd[0](cmd[1], *cmd[2])
-            except:
-                (t, v, tb) = sys.exc_info()
-                v.child_traceback = "".join(
-                        traceback.format_exception(t, v, tb))
-                self.reply(550, ["# Exception data follows:",
-                    _b64(dumps(v, protocol = 2))])
+        self._catch_sigchld()
+        try:
+            while not self._closed:
+                for conn in self._poll():
+                    cmd = conn.readcmd()
+                    if cmd != None:
+                        conn.dispatch(*cmd)
+                    if conn._closed and conn is not self:
+                        self._drop(conn)
+        finally:
+            self._release_sigchld()
+            self._unlisten()
+            for conn in self._conns[1:]:
+                self._drop(conn)
+            self._update_watch()
+            self._stop_workers()
         try:
             self._rfd.close()
             self._wfd.close()
@@ -285,6 +543,310 @@ class Server(object):
         debug("Server(0x%x) exiting" % id(self))
         # FIXME: cleanup
 
+    def dispatch(self, func, cmdname, args):
+        """Run a parsed command, replying with any exception raised. The time
+        taken is accounted in the statistics of the command."""
+        self._lastcode = None
+        start = time.time()
+        try:
+            if self._peer_uid != None and cmdname in _restricted_commands:
+                self.reply(500, "Command not allowed for uid %d." %
+                        self._peer_uid)
+            else:
+                func(cmdname, *args)
+        except:
+            (t, v, tb) = sys.exc_info()
+            v.child_traceback = "".join(
+                    traceback.format_exception(t, v, tb))
+            self.reply(550, "# Exception data follows:",
+                    _serialise_exception(v))
+        _account_latency(self._stats, cmdname, time.time() - start,
+                self._lastcode != None and self._lastcode / 100 in (4, 5))
+
+    def _catch_sigchld(self):
+        """Get woken up by SIGCHLD through a pipe. Signals can only be caught
+        in the main thread; otherwise children are checked periodically."""
+        r, w = os.pipe()
+        for fd in (r, w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            oldfd = signal.set_wakeup_fd(w)
+        except ValueError:
+            os.close(r)
+            os.close(w)
+            return
+        self._oldsig = (oldfd, signal.signal(signal.SIGCHLD, _sigchld_handler))
+        # Do not interrupt system calls
+        signal.siginterrupt(signal.SIGCHLD, False)
+        self._sigpipe = (r, w)
+
+    def _release_sigchld(self):
+        if not self._sigpipe:
+            return
+        oldfd, oldhandler = self._oldsig
+        signal.signal(signal.SIGCHLD, oldhandler)
+        signal.set_wakeup_fd(oldfd)
+        os.close(self._sigpipe[0])
+        os.close(self._sigpipe[1])
+        self._sigpipe = self._oldsig = None
+
+    def _poll(self):
+        """Wait until there are commands to read, reaping children and
+        accepting new connections in the meantime. Returns the list of
+        connections with input available."""
+        # Checking every child is costly with many of them: only do it after
+        # a SIGCHLD, or periodically if signals cannot be caught.
+        if self._sweep or time.time() - self._lastsweep >= REAP_INTERVAL:
+            self._sweep = False
+            self._lastsweep = time.time()
+            self._reap()
+        ready = []
+        fds = []
+        for conn in self._conns:
+            # In text mode, replies must follow the order of commands, so
+            # nothing else is read while a PROC WAIT is pending.
+            if conn._waiting and not conn._binary:
+                continue
+            if conn._rbuf if conn._binary else "\n" in conn._rbuf:
+                ready.append(conn)
+            else:
+                fds.append(conn._rfd.fileno())
+        if ready:
+            return ready
+        if self._sigpipe:
+            fds.append(self._sigpipe[0])
+        if self._listener:
+            fds.append(self._listener.fileno())
+        if self._nlsock:
+            fds.append(self._nlsock.fileno())
+        fds.extend(self._busy.keys())
+        timeout = None
+        if not self._sigpipe and len(self._exited) < len(self._children) and \
+                [c for c in self._conns
+                    if c._waiting or c._waitsets or c._events]:
+            timeout = REAP_INTERVAL
+        try:
+            fds = select.select(fds, [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                self._sweep = True
+                return []
+            raise
+        if not fds:
+            # Timed out
+            self._sweep = True
+        if self._sigpipe and self._sigpipe[0] in fds:
+            self._sweep = True
+            try:
+                while os.read(self._sigpipe[0], 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        if self._listener and self._listener.fileno() in fds:
+            self._accept()
+        if self._nlsock and self._nlsock.fileno() in fds:
+            self._notify_changes()
+        for fd in fds:
+            if fd in self._busy:
+                self._call_ready(self._busy[fd])
+        return [c for c in self._conns if c._rfd.fileno() in fds]
+
+    def _accept(self):
+        "Accept a connection on the listening socket, checking credentials."
+        try:
+            sock = self._listener.accept()[0]
+        except socket.error, e:
+            if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.ECONNABORTED):
+                return
+            raise
+        try:
+            pid, uid, gid = struct.unpack("3i", sock.getsockopt(
+                socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize("3i")))
+            conn = Server(sock, sock)
+        finally:
+            sock.close()
+        if uid not in self._allowed:
+            warning("Rejected connection from pid %d, uid %d." % (pid, uid))
+            conn.reply(530, "Permission denied.")
+            conn._rfd.close()
+            conn._wfd.close()
+            return
+        debug("Accepted connection from pid %d, uid %d." % (pid, uid))
+        if uid not in (0, os.getuid()):
+            conn._peer_uid = uid
+        self._add_conn(conn)
+
+    def _add_conn(self, conn):
+        "Start serving a secondary connection, and send it the banner."
+        # The node state is shared by all the connections
+        main = self._conns[0]
+        conn._children = main._children
+        conn._exited = main._exited
+        conn._xauthfiles = main._xauthfiles
+        conn._conns = main._conns
+        conn._stats = main._stats
+        conn._started = main._started
+        conn._env_templates = main._env_templates
+        self._conns.append(conn)
+        conn.reply(220, "Hello.")
+
+    def _drop(self, conn):
+        "Close a secondary connection; its processes are kept running."
+        self._conns.remove(conn)
+        conn._closed = True
+        try:
+            conn._rfd.close()
+            conn._wfd.close()
+        except:
+            pass
+        self._update_watch()
+
+    def _update_watch(self):
+        """Open or close the netlink socket of the node, depending on whether
+        any connection is watching changes."""
+        main = self._conns[0]
+        kinds = 0
+        for conn in self._conns:
+            if not conn._closed:
+                kinds |= conn._watch
+        if main._nlsock and kinds != main._nlkinds:
+            main._nlsock.close()
+            main._nlsock = None
+        if kinds and not main._nlsock:
+            main._nlsock = nemu.iproute.watch_changes(kinds)
+            main._nlkinds = kinds
+
+    def _notify_changes(self):
+        "Read the pending netlink messages and forward them to the watchers."
+        main = self._conns[0]
+        events = []
+        while True:
+            try:
+                data = main._nlsock.recv(65536, socket.MSG_DONTWAIT)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    break
+                if e.args[0] != errno.ENOBUFS:
+                    raise
+                # Messages were lost; the client needs to re-read everything
+                events.append(("overflow", None, None, None))
+                continue
+            events.extend(nemu.iproute.parse_changes(data))
+        for conn in self._conns:
+            if conn._closed or not conn._watch:
+                continue
+            for event in events:
+                kind = _watch_kinds.get(event[0])
+                if kind and not conn._watch & kind:
+                    continue
+                conn._reply_to(0, EVENT_CHANGE, "%s %s %s." % event[0:3],
+                        _serialise(event))
+
+    def _unlisten(self):
+        if not self._listener:
+            return
+        self._listener.close()
+        self._listener = None
+        if self._listenpath[0] != "\0":
+            try:
+                os.unlink(self._listenpath)
+            except OSError:
+                pass
+        self._listenpath = None
+
+    def _reap(self, pids = None):
+        """Collect the exit status of finished children (or of the ones in
+        `pids'), without blocking; answer the pending PROC WAIT commands and
+        send exit notifications. Each child is waited for by its pid, so the
+        ones started by other means are not collected."""
+        reaped = False
+        if pids == None:
+            pids = list(self._children)
+        for pid in pids:
+            if pid not in self._children:
+                continue
+            if pid in self._exited:
+                continue
+            try:
+                wpid, status, rusage = eintr_wrapper(os.wait4, pid,
+                        os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                continue
+            if not wpid:
+                continue
+            self._exited[pid] = (status, rusage)
+            reaped = True
+            waited = False
+            for conn in self._conns:
+                if conn._closed:
+                    continue
+                if conn._events:
+                    conn._reply_to(0, EVENT_EXIT, "%d exited." % pid,
+                            _serialise((pid, status, tuple(rusage))))
+                if pid in conn._waiting:
+                    for reqid in conn._waiting.pop(pid):
+                        conn._reply_to(reqid, 200, "%d exitcode." % status,
+                                _serialise(tuple(rusage)))
+                    waited = True
+            if waited:
+                self._forget(pid)
+        if reaped:
+            for conn in self._conns:
+                if conn._waitsets and not conn._closed:
+                    conn._check_waitsets()
+
+    def _check_waitsets(self, cancel = None):
+        """Answer the PROC WSET requests that are satisfied, or the one with
+        request ID `cancel'. The reply carries the exit status and resource
+        usage of the processes of the set that have finished, which are
+        then forgotten."""
+        for reqid, (pids, wait_all) in self._waitsets.items():
+            done = [pid for pid in pids if pid in self._exited]
+            # Processes collected meanwhile by another request do not count
+            left = [pid for pid in pids
+                    if pid in self._children and pid not in self._exited]
+            if reqid != cancel and left and (wait_all or not done):
+                continue
+            del self._waitsets[reqid]
+            result = []
+            for pid in done:
+                status, rusage = self._exited[pid]
+                result.append((pid, status, tuple(rusage)))
+                self._forget(pid)
+            self._reply_to(reqid, 200, "%d processes finished." % len(result),
+                    _serialise(result))
+
+    def _forget(self, pid):
+        "Drop all the information about a finished child."
+        self._children.discard(pid)
+        self._exited.pop(pid, None)
+        if pid in self._xauthfiles:
+            try:
+                os.unlink(self._xauthfiles[pid])
+            except:
+                pass
+            del self._xauthfiles[pid]
+
+    def _reply_to(self, reqid, code, text, payload = None):
+        """Send a reply for a request other than the one being processed;
+        request ID 0 is used for unsolicited messages."""
+        saved = (self._reqid, self._capture)
+        self._reqid, self._capture = reqid, None
+        try:
+            self.reply(code, text, payload)
+        finally:
+            self._reqid, self._capture = saved
+
+    def _add_undo(self, func, *args):
+        "Register an action to roll back the current command in a BATCH."
+        if self._undo != None:
+            self._undo.append((func, args))
+
     # Commands implementation
 
     def do_HELP(self, cmdname):
@@ -301,6 +863,153 @@ class Server(object):
         self.reply(221, "Sayounara.");
         self._closed = True
 
+    def do_MODE_BIN(self, cmdname):
+        self.reply(200, "Switching to binary mode.")
+        self._binary = True
+
+    def do_MODE_SHM(self, cmdname, threshold):
+        if not self._binary:
+            self.reply(500, "Shared memory payloads need binary mode.")
+            return
+        self._shm_threshold = max(threshold, 0)
+        if threshold > 0:
+            self.reply(200, "Payloads of %d bytes or more will be sent in " %
+                    threshold + "shared memory.")
+        else:
+            self.reply(200, "Payloads will be sent inline.")
+
+    def do_WTCH(self, cmdname, kinds):
+        if not self._binary:
+            self.reply(500, "Notifications are only sent in binary mode.")
+            return
+        self._watch = kinds
+        self._update_watch()
+        self.reply(200, "Change notifications %s." %
+                ("enabled" if kinds else "disabled"))
+
+    def do_STAT(self, cmdname, reset = 0):
+        stats = {
+                "uptime": time.time() - self._started,
+                "buckets": LATENCY_BUCKETS,
+                "commands": _latency_dict(self._stats),
+                "children": child_times(reset),
+                "rusage": tuple(resource.getrusage(resource.RUSAGE_SELF)),
+                }
+        if reset:
+            self._stats.clear()
+        self.reply(200, "# Statistics follow.", _serialise(stats))
+
+    def do_PROF_ON(self, cmdname):
+        main = self._conns[0]
+        if main._profiler:
+            self.reply(500, "Profiler already running.")
+            return
+        main._profiler = cProfile.Profile()
+        main._profiler.enable()
+        self.reply(200, "Profiler started.")
+
+    def do_PROF_OFF(self, cmdname):
+        main = self._conns[0]
+        if not main._profiler:
+            self.reply(500, "Profiler not running.")
+            return
+        prof, main._profiler = main._profiler, None
+        prof.disable()
+        prof.create_stats()
+        self.reply(200, "# Profiler data follows.", _serialise(prof.stats))
+
+    def do_CONN(self, cmdname):
+        if not self._binary:
+            self.reply(500, "Connections can only be passed in binary mode.")
+            return
+        # The socket follows the command
+        try:
+            fd = passfd.recvfd(self._rfd, 1)[0]
+        except (IOError, OSError, RuntimeError), e:
+            self.reply(500, "Error receiving FD: %s" % str(e))
+            return
+        try:
+            sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        finally:
+            os.close(fd)
+        try:
+            conn = Server(sock, sock)
+        finally:
+            sock.close()
+        conn._peer_uid = self._peer_uid
+        self._add_conn(conn)
+        self.reply(200, "Connection added.")
+
+    def do_LSTN(self, cmdname, path, *uids):
+        if self._conns[0] is not self:
+            self.reply(500, "Only the main connection can do that.")
+            return
+        self._unlisten()
+        if not path:
+            self.reply(200, "Not listening.")
+            return
+        # "@name" is a name in the abstract namespace
+        if path[0] == "@":
+            path = "\0" + path[1:]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            sock.bind(path)
+            if path[0] != "\0":
+                # Anybody can connect: the credentials are checked in
+                # _accept(), so the allowed uids are not stopped here
+                os.chmod(path, 0666)
+            sock.listen(16)
+        except:
+            sock.close()
+            raise
+        self._listener = sock
+        self._listenpath = path
+        self._allowed = set([0, os.getuid()] + list(uids))
+        self.reply(200, "Listening on %s." % path.replace("\0", "@", 1))
+
+    def do_BATCH(self, cmdname, atomic, *cmds):
+        cmds = [_unpack_args(c) for c in cmds]
+        for args in cmds:
+            name = " ".join(args[0:2]).upper()
+            if name not in _batch_commands:
+                self.reply(500, "Command not allowed in BATCH: %s." % name)
+                return
+            if atomic and not _batch_commands[name]:
+                self.reply(500, "Command cannot be rolled back: %s." % name)
+                return
+
+        replies = []
+        failed = False
+        self._capture = replies
+        self._undo = [] if atomic else None
+        try:
+            for args in cmds:
+                cmd = self.parsecmd(args, decode = False)
+                if cmd != None:
+                    self.dispatch(*cmd)
+                if replies[-1][0] / 100 != 2:
+                    failed = True
+                    if atomic:
+                        break
+            if failed and atomic:
+                for func, args in reversed(self._undo):
+                    try:
+                        func(*args)
+                    except BaseException, e:
+                        warning("BATCH rollback failed: %s" % e)
+        finally:
+            self._capture = None
+            self._undo = None
+
+        payload = _pack_args([_reply_hdr.pack(code, len(text)) + text +
+            (data or "") for (code, text, data) in replies])
+        if failed and atomic:
+            self.reply(200, "Batch failed at command %d, rolled back." %
+                    len(replies), payload)
+        else:
+            self.reply(200, "%d command(s) executed." % len(replies), payload)
+
     def do_PROC_CRTE(self, cmdname, executable, *argv):
         self._proc = { 'executable': executable, 'argv': argv }
         self._commands = _proc_commands
@@ -346,11 +1055,266 @@ class Server(object):
     # Same code for the three commands
     do_PROC_SOUT = do_PROC_SERR = do_PROC_SIN
 
+    def do_PROC_SPAWN(self, cmdname, flags, user, cwd, env, executable,
+            *argv):
+        params = { 'executable': executable, 'argv': argv }
+        if user:
+            params['user'] = user
+        if cwd:
+            params['cwd'] = cwd
+        if flags & SPAWN_ENV and not flags & SPAWN_TEMPLATE:
+            env = _unpack_args(env)
+            params['env'] = dict(zip(env[0::2], env[1::2]))
+
+        fdflags = flags & (SPAWN_STDIN | SPAWN_STDOUT | SPAWN_STDERR)
+        if fdflags and not self._binary:
+            self.reply(500, "File descriptors can only be passed with " +
+                    "PROC SPAWN in binary mode.")
+            return
+        # The descriptors follow the command, one per message, in order.
+        error = None
+        for flag, name in ((SPAWN_STDIN, 'stdin'), (SPAWN_STDOUT, 'stdout'),
+                (SPAWN_STDERR, 'stderr')):
+            if not fdflags & flag:
+                continue
+            try:
+                params[name] = passfd.recvfd(self._rfd, 1)[0]
+            except (IOError, OSError, RuntimeError), e:
+                # Keep reading, so the next command is not corrupted
+                error = e
+        if error != None:
+            for name in ('stdin', 'stdout', 'stderr'):
+                if name in params:
+                    os.close(params[name])
+            self.reply(500, "Error receiving FD: %s" % str(error))
+            return
+        if flags & SPAWN_TEMPLATE:
+            try:
+                name, delta = _unserialise(env)
+                params['env'] = self._make_env(name, delta)
+            except:
+                for name in ('stdin', 'stdout', 'stderr'):
+                    if name in params:
+                        os.close(params[name])
+                raise
+        self._run(params)
+
+    def _spawn_params(self, template, specs, received):
+        """Build the parameters of each process of a PROC SPMN. The
+        descriptors are taken from `received'; on error, all of them are
+        closed."""
+        allparams = []
+        fds = []
+        # Identical processes are common: search the PATH once for each
+        paths = {}
+        try:
+            for spec in specs:
+                params = { 'argv': spec['argv'],
+                        'executable': spec.get('executable') or
+                        spec['argv'][0] }
+                for k in ('user', 'cwd'):
+                    v = spec.get(k, template.get(k))
+                    if v != None:
+                        params[k] = v
+                if template.get('env_template') != None:
+                    params['env'] = self._make_env(template['env_template'],
+                            template.get('env'), spec.get('env'))
+                elif template.get('env') != None or spec.get('env') != None:
+                    params['env'] = _apply_env(
+                            template.get('env') or os.environ, spec.get('env'))
+                for k in ('stdin', 'stdout', 'stderr'):
+                    if spec.get(k):
+                        params[k] = received.pop(0)
+                        fds.append(params[k])
+                env = params.get('env') or os.environ
+                key = (params['executable'], env.get("PATH"))
+                if key not in paths:
+                    paths[key] = nemu.subprocess_.find_executable(
+                            params['executable'], env)
+                if paths[key]:
+                    params['executable'] = paths[key]
+                allparams.append(params)
+        except:
+            for fd in fds:
+                os.close(fd)
+            raise
+        return allparams
+
+    def _make_env(self, name, *deltas):
+        "Return the environment template `name' with the changes applied."
+        if name not in self._env_templates:
+            raise ValueError("Unknown environment template: %s" % name)
+        return _apply_env(self._env_templates[name], *deltas)
+
+    def do_ENV_SET(self, cmdname, name, env):
+        env = _unpack_args(env)
+        self._env_templates[name] = dict(zip(env[0::2], env[1::2]))
+        self.reply(200, "Environment template %s set." % name)
+
+    def do_ENV_DEL(self, cmdname, name):
+        if self._env_templates.pop(name, None) == None:
+            self.reply(500, "Unknown environment template: %s" % name)
+            return
+        self.reply(200, "Environment template %s removed." % name)
+
     def do_PROC_RUN(self, cmdname):
         params = self._proc
-        params['close_fds'] = True # forced
         self._proc = None
         self._commands = _proto_commands
+        self._run(params)
+
+    def do_USER_FLSH(self, cmdname):
+        nemu.subprocess_.flush_user_cache()
+        self.reply(200, "User cache flushed.")
+
+    def do_USER_TTL(self, cmdname, ttl):
+        nemu.subprocess_.USER_CACHE_TTL = ttl
+        self.reply(200, "Users cached for %d seconds." % ttl)
+
+    def do_CALL_RUN(self, cmdname, request):
+        if not self._binary:
+            self.reply(500, "Calls are only available in binary mode.")
+            return
+        main = self._conns[0]
+        # Answered by _call_ready() when the worker sends the result
+        main._calls.append((self, self._reqid, request))
+        main._run_calls()
+
+    def do_CALL_POOL(self, cmdname, size):
+        main = self._conns[0]
+        main._pool_size = max(0, size)
+        main._run_calls()
+        self.reply(200, "Worker pool size set to %d." % main._pool_size)
+
+    def _run_calls(self):
+        """Hand the queued calls to idle pooled workers, starting new ones up
+        to the pool size, or to a worker of their own if there is no pool.
+        Extra idle workers are stopped. Called on the main connection."""
+        pooled = len(self._idle) + len([w for w in self._busy.values()
+            if w.pooled])
+        while self._idle and pooled > self._pool_size:
+            self._idle.pop().close()
+            pooled -= 1
+        while self._calls:
+            conn, reqid, request = self._calls[0]
+            if self._idle:
+                worker = self._idle.pop()
+            elif pooled < self._pool_size:
+                worker = _Worker()
+                pooled += 1
+            elif not self._pool_size:
+                worker = _Worker(request)
+            else:
+                break
+            self._calls.popleft()
+            worker.job = (conn, reqid)
+            self._busy[worker.sock.fileno()] = worker
+            if worker.pooled:
+                try:
+                    worker.send(request)
+                except (IOError, OSError, socket.error):
+                    self._call_failed(worker)
+
+    def _call_ready(self, worker):
+        "Read the result sent by a worker, and answer the call when complete."
+        try:
+            result = worker.read()
+        except (IOError, OSError, socket.error, EOFError):
+            self._call_failed(worker)
+            return
+        if result == None:
+            return
+        code, payload = result
+        del self._busy[worker.sock.fileno()]
+        conn, reqid = worker.job
+        worker.job = None
+        if not conn._closed:
+            conn._reply_to(reqid, code, "Call finished." if code == 200
+                    else "# Exception data follows:", payload)
+        if worker.pooled:
+            self._idle.append(worker)
+        else:
+            worker.close()
+        self._run_calls()
+
+    def _call_failed(self, worker):
+        "Answer the call of a worker that went away, and forget it."
+        del self._busy[worker.sock.fileno()]
+        conn, reqid = worker.job
+        if not conn._closed:
+            conn._reply_to(reqid, 500, "Worker process died.")
+        worker.close()
+        self._run_calls()
+
+    def _stop_workers(self):
+        "Stop all the workers; the ones running a call are killed."
+        for worker in self._busy.values():
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for worker in self._idle + self._busy.values():
+            worker.close()
+        self._idle = []
+        self._busy = {}
+        self._calls.clear()
+
+    def do_PROC_SPMN(self, cmdname, data):
+        template, specs = _unserialise(data)
+        # Descriptors of each process, as in PROC SPAWN
+        nfds = sum(len([s for s in ('stdin', 'stdout', 'stderr')
+            if spec.get(s)]) for spec in specs)
+        if nfds and not self._binary:
+            self.reply(500, "File descriptors can only be passed with " +
+                    "PROC SPMN in binary mode.")
+            return
+        error = None
+        received = []
+        for i in xrange(nfds):
+            try:
+                received.append(passfd.recvfd(self._rfd, 1)[0])
+            except (IOError, OSError, RuntimeError), e:
+                error = e
+        if error != None:
+            for fd in received:
+                os.close(fd)
+            self.reply(500, "Error receiving FD: %s" % str(error))
+            return
+
+        try:
+            allparams = self._spawn_params(template, specs, received)
+        except:
+            for fd in received:
+                os.close(fd)
+            raise
+
+        pids = []
+        try:
+            for params in allparams:
+                pids.append(self._start(params))
+        except:
+            # All or nothing: stop the ones already started
+            for params in allparams[len(pids) + 1:]:
+                for k in ('stdin', 'stdout', 'stderr'):
+                    if k in params:
+                        os.close(params[k])
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    eintr_wrapper(os.waitpid, pid, 0)
+                except OSError:
+                    pass
+                self._forget(pid)
+            raise
+        self.reply(200, "%d processes running." % len(pids), _serialise(pids))
+
+    def _run(self, params):
+        "Start a process, with the parameters given by PROC or PROC SPAWN."
+        self.reply(200, "%d running." % self._start(params))
+
+    def _start(self, params):
+        "Start a process and keep track of it; returns its pid."
+        params['close_fds'] = True # forced
 
         if 'env' not in params:
             params['env'] = dict(os.environ) # copy
@@ -385,6 +1349,8 @@ class Server(object):
                 del params['env']['DISPLAY']
 
         try:
+            if self._peer_uid != None:
+                self._check_peer_user(params)
             chld = nemu.subprocess_.spawn(**params)
         finally:
             # I can close the fds now
@@ -394,7 +1360,17 @@ class Server(object):
 
         self._children.add(chld)
         self._xauthfiles[chld] = xauth
-        self.reply(200, "%d running." % chld)
+        return chld
+
+    def _check_peer_user(self, params):
+        """Processes of connections of other users run as them: by default,
+        and only as them."""
+        if params.get('user') == None:
+            params['user'] = self._peer_uid
+        elif nemu.subprocess_.resolve_user(params['user'])[1] != \
+                self._peer_uid:
+            raise ValueError("Processes can only be started as uid %d." %
+                    self._peer_uid)
 
     def do_PROC_ABRT(self, cmdname):
         self._proc = None
@@ -402,38 +1378,65 @@ class Server(object):
         self.reply(200, "Aborted.")
 
     def do_PROC_POLL(self, cmdname, pid):
+        self._reap([pid])
         if pid not in self._children:
             self.reply(500, "Process does not exist.")
             return
-        if cmdname == 'PROC POLL':
-            ret = nemu.subprocess_.poll(pid)
-        else:
-            ret = nemu.subprocess_.wait(pid)
-
-        if ret != None:
-            self._children.remove(pid)
-            if pid in self._xauthfiles:
-                try:
-                    os.unlink(self._xauthfiles[pid])
-                except:
-                    pass
-                del self._xauthfiles[pid]
-            self.reply(200, "%d exitcode." % ret)
-        else:
+        if pid in self._exited:
+            ret, rusage = self._exited[pid]
+            self._forget(pid)
+            self.reply(200, "%d exitcode." % ret, _serialise(tuple(rusage)))
+        elif cmdname == 'PROC POLL':
             self.reply(450, "Not finished yet.")
+        else:
+            # Answered by _reap() when the process finishes
+            self._waiting.setdefault(pid, []).append(self._reqid)
 
     # Same code for the two commands
     do_PROC_WAIT = do_PROC_POLL
 
+    def do_PROC_WSET(self, cmdname, wait_all, *pids):
+        if not self._binary:
+            self.reply(500, "Wait sets are only available in binary mode.")
+            return
+        self._reap(pids)
+        for pid in pids:
+            if pid not in self._children:
+                self.reply(500, "Process does not exist: %d." % pid)
+                return
+        # Answered by _check_waitsets(), maybe right away
+        self._waitsets[self._reqid] = (list(pids), bool(wait_all))
+        self._check_waitsets()
+
+    def do_PROC_WCAN(self, cmdname, reqid):
+        if reqid in self._waitsets:
+            self._reap(self._waitsets[reqid][0])
+            self._check_waitsets(cancel = reqid)
+        self.reply(200, "Cancelled.")
+
+    def do_PROC_EVNT(self, cmdname, enable):
+        if not self._binary:
+            self.reply(500, "Notifications are only sent in binary mode.")
+            return
+        self._events = bool(enable)
+        self.reply(200, "Exit notifications %s." %
+                ("enabled" if enable else "disabled"))
+
     def do_PROC_KILL(self, cmdname, pid, sig):
         if pid not in self._children:
             self.reply(500, "Process does not exist.")
             return
-        if signal:
+        if self._peer_uid != None and pid not in self._exited and \
+                os.stat("/proc/%d" % pid).st_uid != self._peer_uid:
+            self.reply(500, "Process not owned by uid %d." % self._peer_uid)
+            return
+        try:
             # -PID to kill to whole process group
-            os.kill(-pid, sig)
-        else:
-            os.kill(-pid, signal.SIGTERM)
+            os.kill(-pid, sig or signal.SIGTERM)
+        except OSError, e:
+            # The process might have been reaped already
+            if e.errno != errno.ESRCH or pid not in self._exited:
+                raise
         self.reply(200, "Process signalled.")
 
     def do_IF_LIST(self, cmdname, ifnr = None):
@@ -441,8 +1444,8 @@ class Server(object):
             ifdata = nemu.iproute.get_if_data()[0]
         else:
             ifdata = nemu.iproute.get_if(ifnr)
-        self.reply(200, ["# Interface data follows.",
-                _b64(dumps(ifdata, protocol = 2))])
+        self.reply(200, "# Interface data follows.",
+                _serialise(ifdata))
 
     def do_IF_SET(self, cmdname, ifnr, *args):
         if len(args) % 2:
@@ -454,7 +1457,11 @@ class Server(object):
             d[str(args[i * 2])] = args[i * 2 + 1]
 
         iface = nemu.iproute.interface(**d)
+        if self._undo != None:
+            orig = nemu.iproute.get_if(ifnr)
         nemu.iproute.set_if(iface)
+        if self._undo != None:
+            self._add_undo(nemu.iproute.set_if, orig, False)
         self.reply(200, "Done.")
 
     def do_IF_RTRN(self, cmdname, ifnr, ns):
@@ -469,8 +1476,8 @@ class Server(object):
         addrdata = nemu.iproute.get_addr_data()[0]
         if ifnr != None:
             addrdata = addrdata[ifnr]
-        self.reply(200, ["# Address data follows.",
-            _b64(dumps(addrdata, protocol = 2))])
+        self.reply(200, "# Address data follows.",
+                _serialise(addrdata))
 
     def do_ADDR_ADD(self, cmdname, ifnr, address, prefixlen, broadcast = None):
         if address.find(":") < 0: # crude, I know
@@ -478,6 +1485,7 @@ class Server(object):
         else:
             a = nemu.iproute.ipv6address(address, prefixlen)
         nemu.iproute.add_addr(ifnr, a)
+        self._add_undo(nemu.iproute.del_addr, ifnr, a)
         self.reply(200, "Done.")
 
     def do_ADDR_DEL(self, cmdname, ifnr, address, prefixlen):
@@ -485,24 +1493,34 @@ class Server(object):
             a = nemu.iproute.ipv4address(address, prefixlen, None)
         else:
             a = nemu.iproute.ipv6address(address, prefixlen)
+        if self._undo != None:
+            # keep the broadcast address to restore it
+            orig = nemu.iproute.get_addr_data()[0][ifnr]
+            if a in orig:
+                a = orig[orig.index(a)]
         nemu.iproute.del_addr(ifnr, a)
+        self._add_undo(nemu.iproute.add_addr, ifnr, a)
         self.reply(200, "Done.")
 
     def do_ROUT_LIST(self, cmdname):
         rdata = nemu.iproute.get_route_data()
-        self.reply(200, ["# Routing data follows.",
-            _b64(dumps(rdata, protocol = 2))])
+        self.reply(200, "# Routing data follows.",
+                _serialise(rdata))
 
     def do_ROUT_ADD(self, cmdname, tipe, prefix, prefixlen, nexthop, ifnr,
             metric):
-        nemu.iproute.add_route(nemu.iproute.route(tipe, prefix, prefixlen,
-            nexthop, ifnr or None, metric))
+        r = nemu.iproute.route(tipe, prefix, prefixlen, nexthop, ifnr or None,
+                metric)
+        nemu.iproute.add_route(r)
+        self._add_undo(nemu.iproute.del_route, r)
         self.reply(200, "Done.")
 
     def do_ROUT_DEL(self, cmdname, tipe, prefix, prefixlen, nexthop, ifnr,
             metric):
-        nemu.iproute.del_route(nemu.iproute.route(tipe, prefix, prefixlen,
-            nexthop, ifnr or None, metric))
+        r = nemu.iproute.route(tipe, prefix, prefixlen, nexthop, ifnr or None,
+                metric)
+        nemu.iproute.del_route(r)
+        self._add_undo(nemu.iproute.add_route, r)
         self.reply(200, "Done.")
 
     def do_X11_SET(self, cmdname, protoname, hexkey):
@@ -527,12 +1545,19 @@ class Server(object):
         if not self._xsock:
             self.reply(500, "X forwarding not set up.")
             return
+        if self._binary:
+            # The descriptor follows the reply, so the client gets it while
+            # reading replies as usual
+            self.reply(200, "Will set up X forwarding.",
+                    fd = self._xsock.fileno())
+            self._xsock = None
+            return
         # Needs to be a separate command to handle synch & buffering issues
         try:
             passfd.sendfd(self._wfd, self._xsock.fileno(), "1")
         except:
             # need to fill the buffer on the other side, nevertheless
-            self._wfd.write("1")
+            _write_all(self._wfd, "1")
             self.reply(500, "Error sending file descriptor.")
             return
         self._xsock = None
@@ -544,30 +1569,221 @@ class Server(object):
 #
 class Client(object):
     """Client-side implementation of the communication protocol. Acts as a RPC
-    service."""
-    def __init__(self, rfd, wfd):
+    service.
+
+    It is safe to use from several threads at once: requests are sent as soon
+    as they are issued, and replies are matched to them using the request
+    IDs (or their order, in text mode), so many requests can be in flight."""
+    def __init__(self, rfd, wfd, binary = True,
+            shm_threshold = SHM_THRESHOLD):
+        """Connect to a Server through the given descriptors. Unless `binary'
+        is False, the binary framing is negotiated after the banner; the text
+        protocol is mostly useful for debugging. In binary mode, payloads of
+        `shm_threshold' bytes or more are received through shared memory
+        instead of the socket (0 disables it)."""
         debug("Client(0x%x).__init__()" % id(self))
         self._rfd = _get_file(rfd, "r")
         self._wfd = _get_file(wfd, "w")
         self._forwarder = None
+        self._binary = False
+        # Serialises writes, and is held during multi-command transactions.
+        self._lock = threading.RLock()
+        # Protects the following attributes.
+        self._cond = threading.Condition(threading.Lock())
+        self._nextid = 1
+        self._pending = set()   # requests without reply yet
+        self._replies = {}      # replies not yet claimed
+        self._reading = False   # some thread is reading from the socket
+        # ID of the last request sent by each thread.
+        self._local = threading.local()
+        # Called with (pid, status, rusage) on exit notifications.
+        self._exit_callback = None
+        # Called with (kind, action, index, obj) on network changes.
+        self._change_callback = None
+        # Round-trip times: name and time of the requests in flight, and the
+        # statistics per command
+        self._sent = {}
+        self._rtts = {}
+        # Copy of the environment templates set in the server
+        self._env_templates = {}
+
         # Wait for slave to send banner
+        self._local.reqid = self._new_reqid()
         self._read_and_check_reply()
+        if binary:
+            self._send_cmd("MODE", "BIN")
+            self._read_and_check_reply()
+            self._binary = True
+            if shm_threshold:
+                self._send_cmd("MODE", "SHM", shm_threshold)
+                self._read_and_check_reply()
 
     def __del__(self):
         debug("Client(0x%x).__del__()" % id(self))
         self.shutdown()
 
-    def _send_cmd(self, *args):
-        if not self._wfd:
-            raise RuntimeError("Client already shut down.")
-        s = " ".join(map(str, args)) + "\n"
-        self._wfd.write(s)
+    def _new_reqid(self):
+        with self._cond:
+            reqid = self._nextid
+            self._nextid = (self._nextid % 0xffffffff) + 1
+            self._pending.add(reqid)
+        return reqid
 
-    def _read_reply(self):
+    def _send_cmd(self, *args):
+        """Send a command to the server. Arguments are converted to strings,
+        and encoded according to the protocol definition when needed. Returns
+        the request ID, which is also remembered for the calling thread."""
+        batch = getattr(self._local, "batch", None)
+        if batch != None:
+            args = _encode_args(args, True)
+            name = " ".join(args[0:2]).upper()
+            if name not in _batch_commands:
+                raise RuntimeError("%s cannot be used inside a batch." % name)
+            batch.append(args)
+            return None
+        with self._lock:
+            if not self._wfd:
+                raise RuntimeError("Client already shut down.")
+            args = _encode_args(args, self._binary)
+            reqid = self._new_reqid()
+            self._sent[reqid] = (_command_name(args), time.time())
+            if self._binary:
+                body = _pack_args(args)
+                _write_all(self._wfd, _frame_hdr.pack(len(body), reqid) + body)
+            else:
+                _write_all(self._wfd, " ".join(args) + "\n")
+        self._local.reqid = reqid
+        return reqid
+
+    def _receive(self, done):
+        """Read replies until `done()' returns True. Only one thread reads
+        from the socket at a time; the rest wait for it to store their
+        replies. Must be called with self._cond acquired."""
+        while not done():
+            if self._reading:
+                self._cond.wait()
+                continue
+            self._reading = True
+            self._cond.release()
+            try:
+                reqid, reply = self._read_one()
+                while reqid == 0:
+                    self._notification(*reply)
+                    reqid, reply = self._read_one()
+            finally:
+                self._cond.acquire()
+                self._reading = False
+                self._cond.notify_all()
+            self._store_reply(reqid, reply)
+
+    def _store_reply(self, reqid, reply):
+        "Keep a reply for its requester. Must be called with self._cond held."
+        if reqid == None:
+            # text mode: replies come in order
+            reqid = min(self._pending)
+        if reply[0] / 100 != 3:
+            # 3xx replies are followed by a final one
+            self._pending.discard(reqid)
+            if reqid in self._sent:
+                name, start = self._sent.pop(reqid)
+                _account_latency(self._rtts, name, time.time() - start,
+                        reply[0] / 100 in (4, 5))
+        self._replies[reqid] = reply
+
+    def _notification(self, code, text, payload):
+        "Handle an unsolicited message from the server."
+        if code == EVENT_CHANGE:
+            if self._change_callback:
+                self._change_callback(*_unserialise(payload))
+            return
+        if code != EVENT_EXIT:
+            warning("Unknown notification from slave: %d %s" % (code, text))
+            return
+        pid, status, rusage = _unserialise(payload)
+        if self._exit_callback:
+            self._exit_callback(pid, status, resource.struct_rusage(rusage))
+
+    def process_events(self, timeout = None):
+        """Wait up to `timeout' seconds (forever if None) for notifications
+        from the server and run their callbacks. Notifications are otherwise
+        only handled while waiting for replies, so this is needed to get them
+        while the client is idle. Returns False if the time ran out."""
+        with self._cond:
+            if self._reading:
+                # Somebody else is reading and will handle them
+                self._cond.wait(timeout)
+                return True
+            self._reading = True
+        reply = None
+        try:
+            rfd = self._rfd
+            if not rfd:
+                raise RuntimeError("Client already shut down.")
+            try:
+                ready = select.select([rfd], [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                ready = []
+            if not ready:
+                return False
+            while True:
+                reqid, reply = self._read_one()
+                if reqid != 0:
+                    break
+                self._notification(*reply)
+                reply = None
+                if not select.select([rfd], [], [], 0)[0]:
+                    break
+        finally:
+            with self._cond:
+                self._reading = False
+                if reply:
+                    self._store_reply(reqid, reply)
+                self._cond.notify_all()
+        return True
+
+    def _wait_idle(self):
+        "Wait until all the requests in flight have been answered."
+        with self._cond:
+            self._receive(lambda: not self._pending)
+
+    def _read(self, size):
+        "Read exactly `size' bytes from the server."
+        data = []
+        while size:
+            s = eintr_wrapper(os.read, self._rfd.fileno(), size)
+            if not s:
+                raise RuntimeError("Protocol error, connection closed")
+            data.append(s)
+            size -= len(s)
+        return "".join(data)
+
+    def _read_one(self):
         """Reads a (possibly multi-line) response from the server. Returns a
-        tuple containing (code, text)"""
+        tuple containing the request ID (None in text mode) and the reply as
+        (code, text, payload); the payload is only available in binary mode,
+        otherwise it is None."""
         if not self._rfd:
             raise RuntimeError("Client already shut down.")
+        if self._binary:
+            size, reqid = _frame_hdr.unpack(self._read(_frame_hdr.size))
+            body = self._read(size & ~(_FRAME_SHM | _FRAME_FD))
+            code, tsize = _reply_hdr.unpack_from(body)
+            text = body[_reply_hdr.size:_reply_hdr.size + tsize]
+            if size & _FRAME_FD:
+                try:
+                    payload = passfd.recvfd(self._rfd, 1)[0]
+                except RuntimeError:
+                    # The server could not send it
+                    payload = None
+            elif size & _FRAME_SHM:
+                payload = _map_shm(passfd.recvfd(self._rfd, 1)[0],
+                        _shm_size.unpack_from(body, _reply_hdr.size + tsize)[0])
+            else:
+                payload = body[_reply_hdr.size + tsize:]
+            return reqid, (code, text, payload)
+
         text = []
         while True:
             line = eintr_wrapper(self._rfd.readline).rstrip()
@@ -581,35 +1797,139 @@ class Client(object):
             text.append(m.group(3))
             if m.group(2) == " ":
                 break
-        return (int(status), "\n".join(text))
-
-    def _read_and_check_reply(self, expected = 2):
-        """Reads a response and raises an exception if the first digit of the
-        code is not the expected value. If expected is not specified, it
-        defaults to 2."""
-        code, text = self._read_reply()
+        return None, (int(status), "\n".join(text), None)
+
+    def _read_reply(self, reqid = None):
+        """Waits for the response to the given request, by default the last
+        one sent by this thread. Returns a tuple containing (code, text,
+        payload); the payload is only available in binary mode, otherwise it
+        is None."""
+        if getattr(self._local, "batch", None) != None:
+            raise RuntimeError("Replies are not available inside a batch.")
+        if reqid == None:
+            reqid = self._local.reqid
+        with self._cond:
+            self._receive(lambda: reqid in self._replies)
+            return self._replies.pop(reqid)
+
+    def _check_reply(self, code, text, payload, expected):
+        """Raises an exception if the reply is an error. Returns the payload,
+        decoded from the text if in text mode."""
+        if payload == None and (code == 550 or code / 100 == expected):
+            payload = _db64(text.partition("\n")[2])
         if code == 550: # exception
-            e = loads(_db64(text.partition("\n")[2]))
+            e = _unserialise(payload)
             raise e
         if code / 100 != expected:
             raise RuntimeError("Error from slave: %d %s" % (code, text))
+        return payload
+
+    def _read_and_check_reply(self, expected = 2):
+        """Reads a response and raises an exception if the first digit of the
+        code is not the expected value. If expected is not specified, it
+        defaults to 2. Inside a batch, the command is only queued."""
+        if getattr(self._local, "batch", None) != None:
+            return ""
+        code, text, payload = self._read_reply()
+        self._check_reply(code, text, payload, expected)
         return text
 
+    def _read_and_check_data(self):
+        """Reads a response carrying serialised data, and returns the
+        unserialised object."""
+        code, text, payload = self._read_reply()
+        return _unserialise(self._check_reply(code, text, payload, 2))
+
+    def batch(self, commands, atomic = True):
+        """Run a list of commands (each one a sequence of arguments) in a
+        single round-trip, returning a list with one reply per command
+        executed, as (code, text, payload) tuples.
+
+        If `atomic' is True, execution stops at the first failure, the changes
+        already made are rolled back, and the error is raised. Not all the
+        commands can be rolled back; see _batch_commands."""
+        cmds = [_pack_args(_encode_args(c, True)) for c in commands]
+        self._send_cmd("BATCH", int(bool(atomic)), *cmds)
+        code, text, payload = self._read_reply()
+        payload = self._check_reply(code, text, payload, 2)
+        replies = []
+        for r in _unpack_args(payload):
+            code, tsize = _reply_hdr.unpack_from(r)
+            replies.append((code, r[_reply_hdr.size:_reply_hdr.size + tsize],
+                r[_reply_hdr.size + tsize:]))
+        if atomic and replies and replies[-1][0] / 100 != 2:
+            self._check_reply(*(replies[-1] + (2, )))
+        return replies
+
+    def begin_batch(self):
+        """Start queueing the commands issued by this thread, instead of
+        sending them. Only commands that do not return data can be used, and
+        they are sent by commit_batch()."""
+        self._local.batch = []
+
+    def commit_batch(self, atomic = True):
+        """Send the commands queued since begin_batch() in a single BATCH; see
+        batch()."""
+        cmds, self._local.batch = self._local.batch, None
+        if not cmds:
+            return []
+        return self.batch(cmds, atomic)
+
+    def abort_batch(self):
+        "Discard the commands queued since begin_batch()."
+        self._local.batch = None
+
+    @classmethod
+    def connect(cls, path, binary = True):
+        """Connect to the control socket of a node, as created by listen();
+        path can be a file name, or a name in the abstract namespace prefixed
+        by "@"."""
+        if path[0] == "@":
+            path = "\0" + path[1:]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return cls(sock, sock, binary)
+        finally:
+            sock.close()
+
+    def listen(self, path, uids = ()):
+        """Make the server accept other connections on a UNIX socket at
+        `path' (a file name, or a name in the abstract namespace prefixed by
+        "@"; abstract names are only reachable from inside the node). Only
+        root, the owner of the node, and the users in `uids' can connect. The
+        latter can configure the network of the node, but their processes run
+        as them, and the commands that would let them act as root are refused
+        (see docs/protocol.txt). An empty path stops listening."""
+        self._send_cmd("LSTN", path, *uids)
+        self._read_and_check_reply()
+
     def shutdown(self):
         "Tell the client to quit."
-        if not self._wfd:
-            return
-        debug("Client(0x%x).shutdown()" % id(self))
+        with self._lock:
+            if not self._wfd:
+                return
+            debug("Client(0x%x).shutdown()" % id(self))
 
-        self._send_cmd("QUIT")
-        self._read_and_check_reply()
-        self._rfd.close()
-        self._rfd = None
-        self._wfd.close()
-        self._wfd = None
-        if self._forwarder:
-            os.kill(self._forwarder, signal.SIGTERM)
-            self._forwarder = None
+            try:
+                self._send_cmd("QUIT")
+                self._read_and_check_reply()
+            except (IOError, OSError), e:
+                # The server might be gone already, e.g. a secondary
+                # connection after the node finished
+                if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                    raise
+            except RuntimeError, e:
+                if not str(e).startswith("Protocol error"):
+                    raise
+            finally:
+                self._rfd.close()
+                self._rfd = None
+                self._wfd.close()
+                self._wfd = None
+            if self._forwarder:
+                os.kill(self._forwarder, signal.SIGTERM)
+                self._forwarder = None
 
     def _send_fd(self, name, fd):
         "Pass a file descriptor"
@@ -619,7 +1939,7 @@ class Client(object):
             passfd.sendfd(self._wfd, fd, "PROC " + name)
         except:
             # need to fill the buffer on the other side, nevertheless
-            self._wfd.write("=" * (len(name) + 5) + "\n")
+            _write_all(self._wfd, "=" * (len(name) + 5) + "\n")
             # And also read the expected error
             self._read_and_check_reply(5)
             raise
@@ -627,75 +1947,364 @@ class Client(object):
 
     def spawn(self, argv, executable = None,
             stdin = None, stdout = None, stderr = None,
-            cwd = None, env = None, user = None):
+            cwd = None, env = None, user = None, env_template = None):
         """Start a subprocess in the slave; the interface resembles
         subprocess.Popen, but with less functionality. In particular
         stdin/stdout/stderr can only be None or a open file descriptor.
+        If `env_template' names a template set with set_env_template(),
+        `env' holds the changes to it (see expand_env()).
         See nemu.subprocess_.spawn for details."""
 
         if executable == None:
             executable = argv[0]
-        params = ["PROC", "CRTE", _b64(executable)]
-        for i in argv:
-            params.append(_b64(i))
 
-        self._send_cmd(*params)
-        self._read_and_check_reply()
+        fds = [fd for fd in (stdin, stdout, stderr) if fd != None]
+        if self._binary or not fds:
+            return self._spawn_one(argv, executable, stdin, stdout, stderr,
+                    cwd, env, user, env_template)
+        if env_template != None:
+            env = self.expand_env(env_template, env)
 
-        # After this, if we get an error, we have to abort the PROC
-        try:
-            if user != None:
-                self._send_cmd("PROC", "USER", _b64(user))
-                self._read_and_check_reply()
+        params = ["PROC", "CRTE", executable] + list(argv)
 
-            if cwd != None:
-                self._send_cmd("PROC", "CWD", _b64(cwd))
-                self._read_and_check_reply()
+        # The whole transaction must not be interleaved with other commands.
+        with self._lock:
+            self._send_cmd(*params)
+            self._read_and_check_reply()
 
-            if env != None:
-                params = []
-                for k, v in env.items():
-                    params.extend([_b64(k), _b64(v)])
-                self._send_cmd("PROC", "ENV", *params)
+            # After this, if we get an error, we have to abort the PROC
+            try:
+                if user != None:
+                    self._send_cmd("PROC", "USER", user)
+                    self._read_and_check_reply()
+
+                if cwd != None:
+                    self._send_cmd("PROC", "CWD", cwd)
+                    self._read_and_check_reply()
+
+                if env != None:
+                    params = []
+                    for k, v in env.items():
+                        params.extend([k, v])
+                    self._send_cmd("PROC", "ENV", *params)
+                    self._read_and_check_reply()
+
+                if stdin != None:
+                    self._send_fd("SIN", stdin)
+                if stdout != None:
+                    self._send_fd("SOUT", stdout)
+                if stderr != None:
+                    self._send_fd("SERR", stderr)
+            except:
+                self._send_cmd("PROC", "ABRT")
                 self._read_and_check_reply()
+                raise
 
-            if stdin != None:
-                self._send_fd("SIN", stdin)
-            if stdout != None:
-                self._send_fd("SOUT", stdout)
-            if stderr != None:
-                self._send_fd("SERR", stderr)
-        except:
-            self._send_cmd("PROC", "ABRT")
-            self._read_and_check_reply()
-            raise
-
-        self._send_cmd("PROC", "RUN")
-        pid = int(self._read_and_check_reply().split()[0])
+            self._send_cmd("PROC", "RUN")
+            pid = int(self._read_and_check_reply().split()[0])
 
         return pid
 
-    def poll(self, pid):
+    def _spawn_one(self, argv, executable, stdin, stdout, stderr, cwd, env,
+            user, env_template = None):
+        "Start a subprocess with a single PROC SPAWN command."
+        flags = 0
+        fds = []
+        for flag, fd in ((SPAWN_STDIN, stdin), (SPAWN_STDOUT, stdout),
+                (SPAWN_STDERR, stderr)):
+            if fd != None:
+                flags |= flag
+                fds.append(fd)
+        envdata = ""
+        if env_template != None:
+            # Only the changes are sent
+            flags |= SPAWN_ENV | SPAWN_TEMPLATE
+            envdata = _serialise((env_template, env or {}))
+        elif env != None:
+            flags |= SPAWN_ENV
+            params = []
+            for k, v in env.items():
+                params.extend([k, v])
+            envdata = _pack_args(_encode_args(params, True))
+
+        # Nothing else can be sent between the command and the descriptors.
+        with self._lock:
+            self._send_cmd("PROC", "SPAWN", flags, user or "", cwd or "",
+                    envdata, executable, *argv)
+            self._send_fds(fds)
+        return int(self._read_and_check_reply().split()[0])
+
+    def spawn_many(self, specs, cwd = None, env = None, user = None,
+            env_template = None):
+        """Start several processes with a single PROC SPMN command. Each
+        spec is a dictionary with the `argv' of the process, and optionally
+        `executable', `cwd', `env', `user', `stdin', `stdout' and `stderr', as
+        in spawn(). The `cwd', `env' and `user' arguments are the defaults
+        for all of them; the environment of a spec is added to `env'. If
+        `env_template' is given, both are changes to that template. Either
+        all the processes are started, or none. Returns the list of pids."""
+        template = { 'cwd': cwd, 'env': env, 'user': user }
+        if env_template != None:
+            template['env_template'] = env_template
+        wire = []
+        fds = []
+        for spec in specs:
+            w = dict((k, spec[k]) for k in ('executable', 'cwd', 'env', 'user')
+                    if spec.get(k) != None)
+            w['argv'] = list(spec['argv'])
+            for k in ('stdin', 'stdout', 'stderr'):
+                if spec.get(k) != None:
+                    w[k] = 1
+                    fds.append(spec[k])
+            wire.append(w)
+        with self._lock:
+            self._send_cmd("PROC", "SPMN", _serialise((template, wire)))
+            self._send_fds(fds)
+        return self._read_and_check_data()
+
+    def _send_fds(self, fds):
+        """Pass descriptors after a command, one per message. On error, the
+        reply to the command is read and the error raised. Must be called
+        with the lock held."""
+        error = None
+        for fd in fds:
+            if error == None:
+                try:
+                    passfd.sendfd(self._wfd, fd, "F")
+                    continue
+                except:
+                    error = sys.exc_info()
+            # The server expects a message for each descriptor
+            _write_all(self._wfd, "-")
+        if error != None:
+            try:
+                self._read_and_check_reply()
+            except:
+                pass
+            raise error[0], error[1], error[2]
+
+    def poll(self, pid, rusage = False):
         """Equivalent to Popen.poll(), checks if the process has finished.
-        Returns the exitcode if finished, None otherwise."""
+        Returns the exitcode if finished, None otherwise. If `rusage' is
+        True, returns a tuple (exitcode, resource usage) instead, the latter
+        being a resource.struct_rusage as returned by os.wait4()."""
         self._send_cmd("PROC", "POLL", pid)
-        code, text = self._read_reply()
+        code, text, payload = self._read_reply()
         if code / 100 == 2:
             exitcode = int(text.split()[0])
+            if rusage:
+                return exitcode, _decode_rusage(
+                        self._check_reply(code, text, payload, 2))
             return exitcode
         if code / 100 == 4:
             return None
         else:
             raise RuntimeError("Error on command: %d %s" % (code, text))
 
-    def wait(self, pid):
+    def wait(self, pid, rusage = False):
         """Equivalent to Popen.wait(). Waits for the process to finish and
-        returns the exitcode."""
+        returns the exitcode, or a tuple (exitcode, resource usage) if
+        `rusage' is True."""
         self._send_cmd("PROC", "WAIT", pid)
-        text = self._read_and_check_reply()
+        code, text, payload = self._read_reply()
+        payload = self._check_reply(code, text, payload, 2)
         exitcode = int(text.split()[0])
+        if rusage:
+            return exitcode, _decode_rusage(payload)
         return exitcode
 
+    def set_env_template(self, name, env):
+        """Store an environment in the server under `name', so processes can
+        be started with only the changes to it (see spawn())."""
+        params = []
+        for k, v in env.items():
+            params.extend([k, v])
+        self._send_cmd("ENV", "SET", name, _pack_args(_encode_args(params,
+            True)))
+        self._read_and_check_reply()
+        self._env_templates[name] = dict(env)
+
+    def del_env_template(self, name):
+        "Remove an environment template from the server."
+        self._env_templates.pop(name, None)
+        self._send_cmd("ENV", "DEL", name)
+        self._read_and_check_reply()
+
+    def expand_env(self, name, delta = None):
+        """Return the complete environment of the template `name' with the
+        changes in `delta' applied: its values replace the ones of the
+        template, and a value of None removes the variable."""
+        if name not in self._env_templates:
+            raise ValueError("Unknown environment template: %s" % name)
+        return _apply_env(self._env_templates[name], delta)
+
+    def flush_user_cache(self):
+        """Make the server forget the users and groups it has resolved, e.g.
+        after changing the user database."""
+        self._send_cmd("USER", "FLSH")
+        self._read_and_check_reply()
+
+    def set_user_cache_ttl(self, ttl):
+        "Set for how many seconds the server caches resolved users."
+        self._send_cmd("USER", "TTL", ttl)
+        self._read_and_check_reply()
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in a process forked from the server, or
+        in a pooled worker (see set_call_pool()), without waiting for it.
+        The callable and its arguments are pickled, so they must be
+        importable from the server. Returns the request ID, to be used with
+        call_result() and reply_ready(). Only available in binary mode."""
+        return self._send_cmd("CALL", "RUN", pickle.dumps((func, args, kwargs),
+            pickle.HIGHEST_PROTOCOL))
+
+    def call_result(self, reqid):
+        """Wait for the result of a call made with submit(), and return it;
+        the exception raised by the callable is raised here, with its
+        `child_traceback'."""
+        code, text, payload = self._read_reply(reqid)
+        return pickle.loads(self._check_reply(code, text, payload, 2)[:])
+
+    def call(self, func, *args, **kwargs):
+        "Run func(*args, **kwargs) in the server and return the result."
+        return self.call_result(self.submit(func, *args, **kwargs))
+
+    def set_call_pool(self, size):
+        """Keep up to `size' worker processes to run calls, instead of forking
+        one for each; 0 (the default) stops the pool."""
+        self._send_cmd("CALL", "POOL", size)
+        self._read_and_check_reply()
+
+    def wait_set(self, pids, wait_all = False):
+        """Ask the server to reply when any (or all, if `wait_all') of the
+        processes has finished, without waiting for the reply. Returns the
+        request ID, to be used with reply_ready(), wait_set_result() and
+        cancel_wait_set(). Only available in binary mode."""
+        return self._send_cmd("PROC", "WSET", int(bool(wait_all)), *pids)
+
+    def wait_set_result(self, reqid):
+        """Read the reply to wait_set(), blocking if needed. Returns a list of
+        (pid, exit status, resource usage) for the processes that have
+        finished; the server forgets about them."""
+        code, text, payload = self._read_reply(reqid)
+        return [(pid, status, resource.struct_rusage(rusage))
+                for pid, status, rusage in
+                _unserialise(self._check_reply(code, text, payload, 2))]
+
+    def cancel_wait_set(self, reqid):
+        """Make the server answer a pending wait_set() right away, with the
+        processes that have finished so far."""
+        self._send_cmd("PROC", "WCAN", reqid)
+        self._read_and_check_reply()
+
+    def reply_ready(self, reqid):
+        """Read what the server has already sent, without blocking, and
+        return True if the reply to `reqid' has arrived. fileno() can be used
+        to wait for more data."""
+        with self._cond:
+            if reqid in self._replies:
+                return True
+        self.process_events(0)
+        with self._cond:
+            return reqid in self._replies
+
+    def fileno(self):
+        "Descriptor of the connection, to wait for replies with select()."
+        return self._rfd.fileno()
+
+    def open_connection(self):
+        """Open another connection to the server, which shares the processes
+        of the node with this one, and return its socket. The server sends the
+        banner and starts in text mode, like on any new connection. Only
+        available in binary mode."""
+        if not self._binary:
+            raise RuntimeError("Connections can only be passed in binary mode.")
+        s0, s1 = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+        try:
+            # Nothing else can be sent between the command and the socket.
+            with self._lock:
+                self._send_cmd("CONN")
+                try:
+                    passfd.sendfd(self._wfd, s1.fileno(), "C")
+                except:
+                    # The server expects a message anyway
+                    _write_all(self._wfd, "-")
+                    try:
+                        self._read_and_check_reply()
+                    except:
+                        pass
+                    raise
+            self._read_and_check_reply()
+        except:
+            s0.close()
+            raise
+        finally:
+            s1.close()
+        return s0
+
+    def get_stats(self, reset = False):
+        """Return a dictionary with the statistics of the server: for each
+        command, number of calls, errors, total and maximum time, and a
+        histogram of latencies ("commands"); number of runs and time spent
+        in external programs like ip and tc ("children"); uptime and resource
+        usage of the server process. The round-trip times seen by this client
+        are added in "client". If `reset' is True, the counters are
+        cleared."""
+        self._send_cmd("STAT", int(bool(reset)))
+        stats = self._read_and_check_data()
+        with self._cond:
+            stats["client"] = _latency_dict(self._rtts)
+            if reset:
+                self._rtts.clear()
+        return stats
+
+    def start_profiler(self):
+        "Start profiling the server with cProfile."
+        self._send_cmd("PROF", "ON")
+        self._read_and_check_reply()
+
+    def stop_profiler(self):
+        "Stop the profiler in the server, and return a pstats.Stats object."
+        self._send_cmd("PROF", "OFF")
+        return pstats.Stats(_ProfileData(self._read_and_check_data()))
+
+    def subscribe(self, callback):
+        """Ask the server to notify the exit of each process as soon as it
+        happens; `callback' is called with the pid, the exit status, and the
+        resource usage (as returned by os.wait4). It runs in the thread
+        that happens to be reading from the server, so it should not block
+        or issue commands. Only available in binary mode."""
+        self._exit_callback = callback
+        self._send_cmd("PROC", "EVNT", 1)
+        self._read_and_check_reply()
+
+    def unsubscribe(self):
+        "Stop the exit notifications."
+        self._send_cmd("PROC", "EVNT", 0)
+        self._read_and_check_reply()
+        self._exit_callback = None
+
+    def watch(self, callback, kinds = nemu.iproute.WATCH_LINK |
+            nemu.iproute.WATCH_ADDR | nemu.iproute.WATCH_ROUTE):
+        """Ask the server to notify the changes in the links, addresses and
+        routes of the node, as they happen. `kinds' selects which ones, as a
+        combination of nemu.iproute.WATCH_*. `callback' is called with the
+        kind ("link", "addr" or "route"), the action ("new" or "del"), the
+        interface index and the interface, address or route object. If the
+        server lost some messages, it is called with ("overflow", None, None,
+        None) and any cached state should be refreshed. Like subscribe(),
+        callbacks run in the thread reading from the server; see
+        process_events(). Only available in binary mode."""
+        self._change_callback = callback
+        self._send_cmd("WTCH", kinds)
+        self._read_and_check_reply()
+
+    def unwatch(self):
+        "Stop the change notifications."
+        self._send_cmd("WTCH", 0)
+        self._read_and_check_reply()
+        self._change_callback = None
+
     def signal(self, pid, sig = signal.SIGTERM):
         """Equivalent to Popen.send_signal(). Sends a signal to the child
         process; signal defaults to SIGTERM."""
@@ -710,8 +2319,7 @@ class Client(object):
             self._send_cmd("IF", "LIST", ifnr)
         else:
             self._send_cmd("IF", "LIST")
-        data = self._read_and_check_reply()
-        return loads(_db64(data.partition("\n")[2]))
+        return self._read_and_check_data()
 
     def set_if(self, interface):
         cmd = ["IF", "SET", interface.index]
@@ -736,8 +2344,7 @@ class Client(object):
             self._send_cmd("ADDR", "LIST", ifnr)
         else:
             self._send_cmd("ADDR", "LIST")
-        data = self._read_and_check_reply()
-        return loads(_db64(data.partition("\n")[2]))
+        return self._read_and_check_data()
 
     def add_addr(self, ifnr, address):
         if hasattr(address, "broadcast") and address.broadcast:
@@ -754,8 +2361,7 @@ class Client(object):
 
     def get_route_data(self):
         self._send_cmd("ROUT", "LIST")
-        data = self._read_and_check_reply()
-        return loads(_db64(data.partition("\n")[2]))
+        return self._read_and_check_data()
 
     def add_route(self, route):
         self._add_del_route("ADD", route)
@@ -764,8 +2370,8 @@ class Client(object):
         self._add_del_route("DEL", route)
 
     def _add_del_route(self, action, route):
-        args = ["ROUT", action, _b64(route.tipe), _b64(route.prefix),
-                route.prefix_len or 0, _b64(route.nexthop),
+        args = ["ROUT", action, route.tipe, route.prefix,
+                route.prefix_len or 0, route.nexthop,
                 route.interface or 0, route.metric or 0]
         self._send_cmd(*args)
         self._read_and_check_reply()
@@ -774,14 +2380,39 @@ class Client(object):
         # Returns a socket ready to accept() connections
         self._send_cmd("X11", "SET", protoname, hexkey)
         self._read_and_check_reply()
-        # Receive the socket
-        self._send_cmd("X11", "SOCK")
-        fd, payload = passfd.recvfd(self._rfd, 1)
-        self._read_and_check_reply()
+        if self._binary:
+            # The socket comes with the reply
+            self._send_cmd("X11", "SOCK")
+            code, text, payload = self._read_reply()
+            fd = self._check_reply(code, text, payload, 2)
+            if fd == None:
+                raise RuntimeError("Error receiving file descriptor.")
+        else:
+            fd = self._recv_x11_sock()
         skt = socket.fromfd(fd, socket.AF_INET, socket.SOCK_DGRAM)
         os.close(fd) # fromfd dup()'s
         return skt
 
+    def _recv_x11_sock(self):
+        """Get the X11 socket in text mode, where it is sent before the
+        reply: nothing else can be in flight, and this thread has to be the
+        only one reading, without blocking the others while it waits."""
+        with self._lock:
+            self._wait_idle()
+            self._send_cmd("X11", "SOCK")
+            with self._cond:
+                while self._reading:
+                    self._cond.wait()
+                self._reading = True
+            try:
+                fd = passfd.recvfd(self._rfd, 1)[0]
+            finally:
+                with self._cond:
+                    self._reading = False
+                    self._cond.notify_all()
+            self._read_and_check_reply()
+        return fd
+
     def enable_x11_forwarding(self):
         xinfo = _parse_display()
         if not xinfo:
@@ -815,6 +2446,643 @@ def _db64(text):
         return text
     return base64.b64decode(text[1:])
 
+def _pack_args(args):
+    return "".join(_arg_hdr.pack(len(a)) + a for a in args)
+
+def _unpack_args(data):
+    args = []
+    offset = 0
+    while offset < len(data):
+        size = _arg_hdr.unpack_from(data, offset)[0]
+        offset += _arg_hdr.size
+        args.append(data[offset:offset + size])
+        offset += size
+    return args
+
+def _encode_args(args, binary):
+    """Convert command arguments to strings; in text mode, the ones declared
+    as "b" in the protocol definition are base64-encoded if needed."""
+    args = ["" if x == None else str(x) for x in args]
+    if binary or not args:
+        return args
+    cmd1 = args[0].upper()
+    for commands in (_proto_commands, _proc_commands):
+        if cmd1 not in commands:
+            continue
+        subcommands = commands[cmd1]
+        if subcommands.keys() == [ None ]:
+            cmd2, start = None, 1
+        elif len(args) > 1:
+            cmd2, start = args[1].upper(), 2
+        else:
+            break
+        if cmd2 not in subcommands:
+            continue
+        argstemplate = "".join(subcommands[cmd2])
+        j = 0
+        for i in range(start, len(args)):
+            if j >= len(argstemplate):
+                break # let the server complain
+            if argstemplate[j] == '*':
+                j = j - 1
+            if argstemplate[j] == 'b':
+                args[i] = _b64(args[i])
+            j += 1
+        break
+    return args
+
+# memfd_create(2) is bound in nemu.subprocess_; older systems use a temporary
+# file instead.
+MFD_ALLOW_SEALING = 2
+F_ADD_SEALS = 1033
+F_SEAL_SEAL, F_SEAL_SHRINK, F_SEAL_GROW, F_SEAL_WRITE = 1, 2, 4, 8
+
+def _make_shm(data):
+    """Return a descriptor for a memory file holding `data'. If supported, it
+    is sealed, so the receiver can rely on it not changing."""
+    fd = -1
+    if nemu.subprocess_._memfd_create:
+        fd = nemu.subprocess_._memfd_create("nemu-payload",
+                nemu.subprocess_.MFD_CLOEXEC | MFD_ALLOW_SEALING)
+    if fd < 0:
+        f = tempfile.TemporaryFile()
+        fd = os.dup(f.fileno())
+        f.close()
+    try:
+        _write_all(fd, data)
+        try:
+            fcntl.fcntl(fd, F_ADD_SEALS, F_SEAL_SEAL | F_SEAL_SHRINK |
+                    F_SEAL_GROW | F_SEAL_WRITE)
+        except IOError:
+            pass # not a memfd
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def _map_shm(fd, size):
+    "Map read-only the memory file received from the server, and close it."
+    try:
+        return mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+    finally:
+        os.close(fd)
+
+def _write_all(fd, data):
+    "Write the whole string to the file descriptor, bypassing any buffering."
+    if hasattr(fd, "fileno"):
+        fd = fd.fileno()
+    while data:
+        n = eintr_wrapper(os.write, fd, data)
+        data = data[n:]
+
+# ============================================================================
+#
+# Serialisation of payloads.
+#
+# A compact typed encoding that replaces pickle: it is cheaper to decode for
+# the usual payloads (lots of small records), and decoding it cannot run
+# arbitrary code.
+#
+# Layout: version (1 byte), flags (1 byte), number of strings (4 bytes), the
+# string table, and a single tagged value. Strings are stored only once and
+# referenced by their position in the table (index 0 stands for None). If
+# none of them contains a NUL character, the table is stored as its size (4
+# bytes) followed by the NUL-separated strings; otherwise, as the size of
+# each string followed by the strings.
+#
+# Sequences of integers, strings, or records of the same kind are stored as
+# arrays, and decoded with a single unpack per array. Records are stored by
+# columns: one array per attribute. Lists, dictionaries and records that
+# appear more than once are stored once and referenced afterwards, so shared
+# objects are preserved (as pickle does).
+
+_WIRE_VERSION = 1
+_WIRE_NULSEP = 1
+_wire_hdr = struct.Struct("!BBI")
+_u32 = struct.Struct("!I")
+_i64 = struct.Struct("!q")
+_I64_MIN = -2 ** 63
+_I64_MAX = 2 ** 63 - 1
+_double = struct.Struct("!d")
+_rec_hdr = struct.Struct("!BII")
+
+_tribools = (None, False, True)
+
+# The build functions receive the string table and the raw fields.
+def _build_interface(st, index, name, up, mtu, lladdr, broadcast, mc, arp):
+    o = nemu.iproute.interface.__new__(nemu.iproute.interface)
+    o.__dict__ = { "_index": index or None, "name": st[name],
+            "_up": _tribools[up], "_mtu": mtu or None, "_lladdr": st[lladdr],
+            "broadcast": st[broadcast], "_mc": _tribools[mc],
+            "_arp": _tribools[arp] }
+    return o
+
+def _build_address(st, family, address, prefix_len, broadcast):
+    if family == 4:
+        o = nemu.iproute.ipv4address.__new__(nemu.iproute.ipv4address)
+        o.__dict__ = { "address": st[address], "prefix_len": prefix_len,
+                "broadcast": st[broadcast], "family": socket.AF_INET }
+    else:
+        o = nemu.iproute.ipv6address.__new__(nemu.iproute.ipv6address)
+        o.__dict__ = { "address": st[address], "prefix_len": prefix_len,
+                "family": socket.AF_INET6 }
+    return o
+
+def _build_route(st, tipe, prefix, prefix_len, nexthop, interface, metric):
+    o = nemu.iproute.route.__new__(nemu.iproute.route)
+    o.__dict__ = { "_tipe": tipe, "_prefix": st[prefix], "_plen": prefix_len,
+            "_nexthop": st[nexthop], "_interface": interface or None,
+            "_metric": metric }
+    return o
+
+# Record types: tag -> (struct format, kind of each field, function returning
+# the fields of an object, build function). Field kinds are: `i' for integers
+# (None is stored as 0), `s' for strings, and `b' for booleans that can be
+# None.
+_records = {
+        1: ("iIBiIIBB", "isbissbb", lambda i: (i.index, i.name, i.up, i.mtu,
+            i.lladdr, i.broadcast, i.multicast, i.arp), _build_interface),
+        2: ("BIiI", "isis", lambda a: (
+            4 if a.family == socket.AF_INET else 6, a.address, a.prefix_len,
+            getattr(a, "broadcast", None)), _build_address),
+        3: ("BIiIiI", "isisii", lambda r: (r._tipe, r.prefix, r.prefix_len,
+            r.nexthop, r.interface, r.metric), _build_route),
+        }
+_record_tags = {
+        nemu.iproute.interface: 1,
+        nemu.iproute.ipv4address: 2,
+        nemu.iproute.ipv6address: 2,
+        nemu.iproute.route: 3,
+        }
+_scalars = (type(None), bool, int, long, float, basestring)
+
+def _serialise(obj):
+    """Encode a payload. Supported values are None, booleans, numbers,
+    strings, lists, tuples, dictionaries, exceptions, and the interface,
+    address and route objects from nemu.iproute."""
+    strings = {}
+    def sidx(s):
+        if s == None:
+            return 0
+        if isinstance(s, unicode):
+            s = s.encode("utf-8")
+        return strings.setdefault(str(s), len(strings) + 1)
+    out = []
+    _encode_value(obj, out, sidx, {})
+    table = sorted(strings, key = strings.get)
+    joined = "\0".join(table)
+    if joined.count("\0") == max(len(table) - 1, 0):
+        head = [_wire_hdr.pack(_WIRE_VERSION, _WIRE_NULSEP, len(table)),
+                _u32.pack(len(joined)), joined]
+    else:
+        head = [_wire_hdr.pack(_WIRE_VERSION, 0, len(table)),
+                struct.pack("!%dI" % len(table), *map(len, table))] + table
+    return "".join(head + out)
+
+def _serialise_exception(e):
+    """Encode an exception for a 550 reply. If that fails (e.g. because of
+    its arguments), a RuntimeError with its representation is sent, so the
+    error is still reported."""
+    try:
+        return _serialise(e)
+    except:
+        try:
+            text = repr(e)
+        except:
+            text = e.__class__.__name__
+        error = RuntimeError(text)
+        error.child_traceback = getattr(e, "child_traceback", None)
+        try:
+            return _serialise(error)
+        except:
+            error.child_traceback = None
+            return _serialise(error)
+
+def _encode_value(obj, out, sidx, memo):
+    # `memo' maps the id of lists, dictionaries and records already encoded
+    # to their position in the object table that the decoder builds.
+    if obj is None:
+        out.append("N")
+    elif obj is True:
+        out.append("T")
+    elif obj is False:
+        out.append("F")
+    elif isinstance(obj, (int, long)):
+        if _I64_MIN <= obj <= _I64_MAX:
+            out.append("q" + _i64.pack(obj))
+        else:
+            out.append("L" + _u32.pack(sidx(str(obj))))
+    elif isinstance(obj, float):
+        out.append("d" + _double.pack(obj))
+    elif isinstance(obj, unicode):
+        out.append("u" + _u32.pack(sidx(obj)))
+    elif isinstance(obj, str):
+        out.append("s" + _u32.pack(sidx(obj)))
+    elif id(obj) in memo:
+        out.append("o" + _u32.pack(memo[id(obj)]))
+    elif type(obj) in _record_tags:
+        tag = _record_tags[type(obj)]
+        out.append("r" + chr(tag) + _pack_records(tag, [obj], sidx))
+        memo[id(obj)] = len(memo)
+    elif isinstance(obj, list):
+        _encode_seq(obj, out, sidx, memo, id(obj))
+    elif isinstance(obj, tuple):
+        out.append("t")
+        _encode_seq(obj, out, sidx, memo)
+    elif isinstance(obj, dict):
+        out.append("m")
+        items = obj.items()
+        _encode_seq([k for k, v in items], out, sidx, memo)
+        _encode_seq([v for k, v in items], out, sidx, memo)
+        memo[id(obj)] = len(memo)
+    elif isinstance(obj, BaseException):
+        args = tuple(x if isinstance(x, _scalars) else str(x)
+                for x in obj.args)
+        cls = obj.__class__
+        name = cls.__name__
+        if cls.__module__ != "exceptions":
+            name = "%s.%s" % (cls.__module__, name)
+        out.append("E" + _u32.pack(sidx(name)))
+        _encode_value(args, out, sidx, memo)
+        _encode_value(getattr(obj, "filename", None), out, sidx, memo)
+        _encode_value(getattr(obj, "child_traceback", None), out, sidx, memo)
+    else:
+        raise TypeError("Cannot serialise object of type %s" % type(obj))
+
+def _encode_seq(seq, out, sidx, memo, key = None):
+    """Encode a sequence as a list, and register it in `memo' with `key'.
+    Temporary lists (key is None) still take a position in the table."""
+    _encode_items(seq, out, sidx, memo)
+    if key == None:
+        key = ("tmp", len(memo))
+    memo[key] = len(memo)
+
+def _encode_items(seq, out, sidx, memo):
+    types = set(map(type, seq))
+    if not seq:
+        out.append("l" + _u32.pack(0))
+    elif types <= set((int, long)) and _I64_MIN <= min(seq) and \
+            max(seq) <= _I64_MAX:
+        out.append("Q" + _u32.pack(len(seq)) +
+                struct.pack("!%dq" % len(seq), *seq))
+    elif types == set([str]):
+        out.append("S" + _u32.pack(len(seq)) +
+                struct.pack("!%dI" % len(seq), *map(sidx, seq)))
+    elif types <= set(_record_tags) and \
+            len(set(_record_tags[t] for t in types)) == 1:
+        tag = _record_tags[types.pop()]
+        idxs = []
+        new = []
+        for x in seq:
+            i = memo.get(id(x))
+            if i == None:
+                i = memo[id(x)] = len(memo)
+                new.append(x)
+            idxs.append(i)
+        out.append("R" + _rec_hdr.pack(tag, len(seq), len(new)))
+        if len(new) != len(seq):
+            # Some records were seen before: store all the references
+            out.append(struct.pack("!%dI" % len(seq), *idxs))
+        out.append(_pack_records(tag, new, sidx))
+    elif all(id(x) in memo for x in seq):
+        out.append("O" + _u32.pack(len(seq)) +
+                struct.pack("!%dI" % len(seq), *[memo[id(x)] for x in seq]))
+    elif types == set([list]) and _record_lists(seq, memo):
+        # A list of lists of new records, as in the address data: store the
+        # lengths of the lists, and all the records together.
+        tag = _record_tags[type(seq[0][0])]
+        records = sum(seq, [])
+        out.append("P" + _rec_hdr.pack(tag, len(seq), len(records)) +
+                struct.pack("!%dI" % len(seq), *map(len, seq)) +
+                _pack_records(tag, records, sidx))
+        for x in records + seq:
+            memo[id(x)] = len(memo)
+    else:
+        out.append("l" + _u32.pack(len(seq)))
+        for x in seq:
+            _encode_value(x, out, sidx, memo)
+
+def _record_lists(seq, memo):
+    """Check whether all the items in `seq' are different, non-empty lists of
+    records of the same kind, and none of the records was encoded before."""
+    if len(set(map(id, seq))) != len(seq):
+        return False
+    seen = set()
+    tags = set()
+    for x in seq:
+        if not x or id(x) in memo:
+            return False
+        for r in x:
+            if id(r) in memo or id(r) in seen:
+                return False
+            seen.add(id(r))
+            tags.add(_record_tags.get(type(r)))
+    return len(tags) == 1 and None not in tags
+
+def _pack_records(tag, records, sidx):
+    fmt, kinds, fields = _records[tag][0:3]
+    convert = { "i": lambda x: x or 0, "s": sidx,
+            "b": lambda x: 0 if x == None else int(x) + 1 }
+    convert = [convert[k] for k in kinds]
+    ret = []
+    for r in records:
+        ret.extend([f(x) for f, x in zip(convert, fields(r))])
+    return struct.pack("!" + fmt * len(records), *ret)
+
+_record_structs = {}
+
+def _unpack_records(tag, count, data, offset, st):
+    "Decode `count' records; returns a tuple (records, next offset)."
+    if not count:
+        return [], offset
+    fmt, kinds, fields, build = _records[tag]
+    s = _record_structs.get((tag, count))
+    if not s:
+        if len(_record_structs) > 100:
+            _record_structs.clear()
+        s = _record_structs[(tag, count)] = struct.Struct("!" + fmt * count)
+    values = s.unpack_from(data, offset)
+    if count == 1:
+        return [build(st, *values)], offset + s.size
+    n = len(fmt)
+    return (map(build, itertools.repeat(st, count),
+        *[values[i::n] for i in xrange(n)]), offset + s.size)
+
+def _unserialise(data):
+    "Decode a payload created by _serialise()."
+    version, flags, nstrings = _wire_hdr.unpack_from(data)
+    if version != _WIRE_VERSION:
+        raise RuntimeError("Unsupported serialisation version: %d" % version)
+    offset = _wire_hdr.size
+    st = [None]
+    if flags & _WIRE_NULSEP:
+        size = _u32.unpack_from(data, offset)[0]
+        offset += 4
+        if nstrings:
+            st.extend(data[offset:offset + size].split("\0"))
+        offset += size
+    else:
+        sizes = struct.unpack_from("!%dI" % nstrings, data, offset)
+        offset += 4 * nstrings
+        for size in sizes:
+            st.append(data[offset:offset + size])
+            offset += size
+    return _decode_value(data, offset, st, [])[0]
+
+def _apply_env(base, *deltas):
+    """Return a copy of the environment `base' with the changes applied, in
+    order; a value of None removes the variable."""
+    env = dict(base)
+    for delta in deltas:
+        for k, v in (delta or {}).items():
+            if v == None:
+                env.pop(k, None)
+            else:
+                env[k] = v
+    return env
+
+def _decode_rusage(payload):
+    """Rebuild the resource usage sent with the exit status of a process, or
+    return None if the server did not send it."""
+    if not payload:
+        return None
+    return resource.struct_rusage(_unserialise(payload))
+
+def _decode_value(data, offset, st, objs):
+    """Decode the value at `offset'; returns a tuple (value, next offset).
+    `objs' is the table of lists, dictionaries and records decoded so far."""
+    tag = data[offset]
+    offset += 1
+    if tag == "s":
+        return st[_u32.unpack_from(data, offset)[0]], offset + 4
+    if tag == "q":
+        return _i64.unpack_from(data, offset)[0], offset + 8
+    if tag == "u":
+        s = st[_u32.unpack_from(data, offset)[0]]
+        return s.decode("utf-8"), offset + 4
+    if tag == "L":
+        return long(st[_u32.unpack_from(data, offset)[0]]), offset + 4
+    if tag == "o":
+        return objs[_u32.unpack_from(data, offset)[0]], offset + 4
+    if tag == "N":
+        return None, offset
+    if tag == "T":
+        return True, offset
+    if tag == "F":
+        return False, offset
+    if tag == "d":
+        return _double.unpack_from(data, offset)[0], offset + 8
+    if tag == "R":
+        rtag, count, new = _rec_hdr.unpack_from(data, offset)
+        offset += _rec_hdr.size
+        idxs = None
+        if new != count:
+            idxs = struct.unpack_from("!%dI" % count, data, offset)
+            offset += 4 * count
+        ret, offset = _unpack_records(rtag, new, data, offset, st)
+        objs.extend(ret)
+        if idxs != None:
+            ret = map(objs.__getitem__, idxs)
+    elif tag == "m":
+        keys, offset = _decode_value(data, offset, st, objs)
+        values, offset = _decode_value(data, offset, st, objs)
+        ret = dict(zip(keys, values))
+    elif tag == "S":
+        count = _u32.unpack_from(data, offset)[0]
+        ret = map(st.__getitem__,
+                struct.unpack_from("!%dI" % count, data, offset + 4))
+        offset += 4 + 4 * count
+    elif tag == "Q":
+        count = _u32.unpack_from(data, offset)[0]
+        ret = list(struct.unpack_from("!%dq" % count, data, offset + 4))
+        offset += 4 + 8 * count
+    elif tag == "O":
+        count = _u32.unpack_from(data, offset)[0]
+        ret = map(objs.__getitem__,
+                struct.unpack_from("!%dI" % count, data, offset + 4))
+        offset += 4 + 4 * count
+    elif tag == "l":
+        count = _u32.unpack_from(data, offset)[0]
+        offset += 4
+        ret = []
+        for i in xrange(count):
+            v, offset = _decode_value(data, offset, st, objs)
+            ret.append(v)
+    elif tag == "t":
+        ret, offset = _decode_value(data, offset, st, objs)
+        return tuple(ret), offset
+    elif tag == "P":
+        rtag, count, total = _rec_hdr.unpack_from(data, offset)
+        offset += _rec_hdr.size
+        sizes = struct.unpack_from("!%dI" % count, data, offset)
+        records, offset = _unpack_records(rtag, total, data,
+                offset + 4 * count, st)
+        objs.extend(records)
+        ret = []
+        start = 0
+        for size in sizes:
+            ret.append(records[start:start + size])
+            start += size
+        objs.extend(ret)
+    elif tag == "r":
+        ret, offset = _unpack_records(ord(data[offset]), 1, data, offset + 1,
+                st)
+        ret = ret[0]
+    elif tag == "E":
+        name = st[_u32.unpack_from(data, offset)[0]]
+        args, offset = _decode_value(data, offset + 4, st, objs)
+        filename, offset = _decode_value(data, offset, st, objs)
+        tb, offset = _decode_value(data, offset, st, objs)
+        # Only standard exceptions, and the ones defined in modules already
+        # loaded here, are re-created: nothing is imported
+        if "." in name:
+            module, clsname = name.rsplit(".", 1)
+            cls = getattr(sys.modules.get(module), clsname, None)
+        else:
+            cls = getattr(exceptions, name, None)
+        try:
+            if not (isinstance(cls, type) and issubclass(cls, BaseException)):
+                raise TypeError
+            e = cls(*args)
+        except:
+            e = RuntimeError("%s: %s" % (name, ", ".join(map(str, args))))
+        if filename != None:
+            e.filename = filename
+        if tb != None:
+            e.child_traceback = tb
+        return e, offset
+    else:
+        raise RuntimeError("Invalid serialised data: unknown tag %r" % tag)
+    # Lists, dictionaries, and records can be referenced later
+    objs.append(ret)
+    return ret, offset
+
+class _Worker(object):
+    """A process forked from the server to run callables (CALL RUN). Pooled
+    workers run the calls sent through their socket until it is closed; the
+    others run the one they are given and exit."""
+    def __init__(self, request = None):
+        ours, theirs = socket.socketpair()
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            try:
+                ours.close()
+                _worker_main(theirs.fileno(), request)
+            finally:
+                os._exit(0)
+        theirs.close()
+        self.pid = pid
+        self.sock = ours
+        self.pooled = request == None
+        # (connection, request ID) of the call being run
+        self.job = None
+        self._chunks = []
+        self._size = 0
+
+    def send(self, request):
+        _write_all(self.sock, _u32.pack(len(request)) + request)
+
+    def read(self):
+        """Read what the worker has sent. Returns (code, payload) when the
+        whole result has arrived, None otherwise."""
+        data = eintr_wrapper(self.sock.recv, 1 << 20)
+        if not data:
+            raise EOFError("Worker process died.")
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size < _reply_hdr.size:
+            return None
+        data = "".join(self._chunks)
+        self._chunks = [data]
+        code, size = _reply_hdr.unpack_from(data)
+        if len(data) < _reply_hdr.size + size:
+            return None
+        self._chunks = []
+        self._size = 0
+        return code, data[_reply_hdr.size:_reply_hdr.size + size]
+
+    def close(self):
+        self.sock.close()
+        eintr_wrapper(os.waitpid, self.pid, 0)
+
+def _worker_main(fd, request): # pragma: no cover
+    """Body of a worker process: run the pickled (func, args, kwargs) calls
+    and send back the pickled result, or the exception as in a 550 reply."""
+    # The wakeup pipe of the server is closed below: signals must not write
+    # to whatever descriptor gets its number later
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    nemu.subprocess_._close_fds_from(3, fd)
+    pooled = request == None
+    while True:
+        if pooled:
+            data = _read_exact(fd, _u32.size)
+            if not data:
+                return
+            request = _read_exact(fd, _u32.unpack(data)[0])
+        try:
+            func, args, kwargs = pickle.loads(request)
+            payload = pickle.dumps(func(*args, **kwargs),
+                    pickle.HIGHEST_PROTOCOL)
+            code = 200
+        except:
+            (t, v, tb) = sys.exc_info()
+            v.child_traceback = "".join(
+                    traceback.format_exception(t, v, tb))
+            payload = _serialise_exception(v)
+            code = 550
+        _write_all(fd, _reply_hdr.pack(code, len(payload)) + payload)
+        if not pooled:
+            return
+
+def _read_exact(fd, size):
+    "Read `size' bytes from a descriptor, or return None on end of file."
+    data = []
+    while size:
+        s = eintr_wrapper(os.read, fd, size)
+        if not s:
+            return None
+        data.append(s)
+        size -= len(s)
+    return "".join(data)
+
+class _ProfileData(object):
+    "Wraps profiler data received from the server, to build pstats.Stats."
+    def __init__(self, stats):
+        self.stats = stats
+    def create_stats(self):
+        pass
+
+def _command_name(args):
+    "Return the name of a command as used by the server, e.g. `IF SET'."
+    cmd1 = args[0].upper()
+    if None in _proto_commands.get(cmd1, {None: None}):
+        return cmd1
+    return " ".join(args[0:2]).upper()
+
+def _account_latency(stats, name, elapsed, error = False):
+    """Add a call to `name' to the statistics in `stats': a dictionary of
+    [count, errors, total time, max time, histogram]."""
+    s = stats.get(name)
+    if s == None:
+        s = stats[name] = [0, 0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+    s[0] += 1
+    s[1] += int(error)
+    s[2] += elapsed
+    s[3] = max(s[3], elapsed)
+    s[4][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+def _latency_dict(stats):
+    return dict((name, { "count": s[0], "errors": s[1], "time": s[2],
+        "max": s[3], "histogram": list(s[4]) }) for name, s in stats.items())
+
+# Not exported by the socket module in Python 2
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+def _sigchld_handler(signum, frame):
+    # Nothing to do: set_wakeup_fd() makes the server loop wake up.
+    pass
+
 def _get_file(fd, mode):
     # Since fdopen insists on closing the fd on destruction, I need to dup()
     if hasattr(fd, "fileno"):
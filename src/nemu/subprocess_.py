@@ -17,11 +17,15 @@
 # You should have received a copy of the GNU General Public License along with
 # Nemu.  If not, see <http://www.gnu.org/licenses/>.
 
-import fcntl, grp, os, pickle, pwd, signal, select, sys, time, traceback
+import contextlib, ctypes, ctypes.util, errno, fcntl, grp, io, math, mmap, os
+import pickle, platform, pwd
+import signal, select, sys, tempfile, time, traceback, unshare
 from nemu.environ import eintr_wrapper
 
-__all__ = [ 'PIPE', 'STDOUT', 'Popen', 'Subprocess', 'spawn', 'wait', 'poll',
-        'get_user', 'system', 'backticks', 'backticks_raise' ]
+__all__ = [ 'PIPE', 'STDOUT', 'SPOOL', 'Popen', 'Subprocess', 'spawn', 'wait', 'poll',
+        'get_user', 'resolve_user', 'flush_user_cache', 'system', 'backticks',
+        'backticks_raise', 'TimeoutExpired', 'spawn_many', 'wait_any',
+        'wait_all' ]
 
 # User-facing interfaces
 
@@ -35,7 +39,8 @@ class Subprocess(object):
     default_user = None
     def __init__(self, node, argv, executable = None,
             stdin = None, stdout = None, stderr = None,
-            shell = False, cwd = None, env = None, user = None):
+            shell = False, cwd = None, env = None, user = None,
+            direct = False, env_template = None):
         self._slave = node._slave
         """Forks and execs a program, with stdio redirection and user
         switching.
@@ -54,13 +59,22 @@ class Subprocess(object):
         should be set in `cwd'.
 
         If specified, `env' replaces the caller's environment with the
-        dictionary provided.
+        dictionary provided. If `env_template' names an environment stored in
+        the node with Node.set_env_template(), `env' only has the changes to
+        it instead: variables to set, or to remove if their value is None.
+        Only these changes are sent to the node server.
 
         The standard input, output, and error of the created process will be
         redirected to the file descriptors specified by `stdin`, `stdout`, and
         `stderr`, respectively. These parameters must be open file objects,
         integers, or None (for no redirection). Note that the descriptors will
         not be closed by this class.
+
+        If `direct' is True, the process is started by this process, after
+        joining the network name space of the node, instead of by the node
+        server: launches from many threads or for many nodes do not wait for
+        each other. The process is still registered with the node, to be
+        killed when the node is destroyed. X11 forwarding is not available.
         
         Exceptions occurred while trying to set up the environment or executing
         the program are propagated to the parent."""
@@ -75,16 +89,41 @@ class Subprocess(object):
         
         # Initialize attributes that would be used by the destructor if spawn
         # fails
-        self._pid = self._returncode = None
+        self._pid = self._returncode = self._rusage = None
+        self._direct = direct
+        if direct:
+            if env_template != None:
+                env = self._slave.expand_env(env_template, env)
+            elif env == None:
+                # As done by the server when not forwarding X
+                env = dict(os.environ)
+                env.pop('DISPLAY', None)
+            self._pid = spawn(executable or argv[0], argv, cwd = cwd,
+                    env = env, close_fds = True, stdin = stdin,
+                    stdout = stdout, stderr = stderr, user = user,
+                    netns = node._get_netns())
+            node._add_subprocess(self)
+            return
         # confusingly enough, to go to the function at the top of this file,
         # I need to call it thru the communications protocol: remember that
         # happens in another process!
         self._pid = self._slave.spawn(argv, executable = executable,
                 stdin = stdin, stdout = stdout, stderr = stderr,
-                cwd = cwd, env = env, user = user)
+                cwd = cwd, env = env, user = user, env_template = env_template)
 
         node._add_subprocess(self)
 
+    @classmethod
+    def _adopt(cls, node, pid):
+        "Create the object for a process already started in the node."
+        self = cls.__new__(cls)
+        self._slave = node._slave
+        self._pid = pid
+        self._returncode = self._rusage = None
+        self._direct = False
+        node._add_subprocess(self)
+        return self
+
     @property
     def pid(self):
         """The real process ID of this subprocess."""
@@ -93,20 +132,33 @@ class Subprocess(object):
     def poll(self):
         """Checks status of program, returns exitcode or None if still running.
         See Popen.poll."""
-        if self._returncode == None:
-            self._returncode = self._slave.poll(self._pid)
+        if self._returncode == None and self._direct:
+            pid, status, rusage = os.wait4(self._pid, os.WNOHANG)
+            if pid:
+                self._returncode, self._rusage = status, rusage
+        elif self._returncode == None:
+            r = self._slave.poll(self._pid, rusage = True)
+            if r != None:
+                self._returncode, self._rusage = r
         return self.returncode
 
     def wait(self):
         """Waits for program to complete and returns the exitcode.
         See Popen.wait"""
-        if self._returncode == None:
-            self._returncode = self._slave.wait(self._pid)
+        if self._returncode == None and self._direct:
+            pid, self._returncode, self._rusage = eintr_wrapper(os.wait4,
+                    self._pid, 0)
+        elif self._returncode == None:
+            self._returncode, self._rusage = self._slave.wait(self._pid,
+                    rusage = True)
         return self.returncode
 
     def signal(self, sig = signal.SIGTERM):
         """Sends a signal to the process."""
-        if self._returncode == None:
+        if self._returncode == None and self._direct:
+            # -PID to kill to whole process group, as the server does
+            os.kill(-self._pid, sig or signal.SIGTERM)
+        elif self._returncode == None:
             self._slave.signal(self._pid, sig)
 
     @property
@@ -123,48 +175,84 @@ class Subprocess(object):
             return os.WEXITSTATUS(self._returncode)
         raise RuntimeError("Invalid return code") # pragma: no cover
 
+    @property
+    def rusage(self):
+        """When the program has finished (and has been waited for), the
+        resources it used, as a resource.struct_rusage: CPU time (ru_utime,
+        ru_stime), maximum resident set size in KiB (ru_maxrss), context
+        switches (ru_nvcsw, ru_nivcsw), etc. None otherwise."""
+        return self._rusage
+
     def __del__(self):
         self.destroy()
     def destroy(self):
         if self._returncode != None or self._pid == None:
             return
         self.signal()
-        now = time.time()
-        while time.time() - now < KILL_WAIT:
-            if self.poll() != None:
-                return
-            time.sleep(0.1)
+        if wait_any([self], KILL_WAIT)[0]:
+            return
         sys.stderr.write("WARNING: killing forcefully process %d.\n" %
                 self._pid)
         self.signal(signal.SIGKILL)
         self.wait()
 
+class TimeoutExpired(RuntimeError):
+    """Raised by Popen.communicate() when the timeout expires before the
+    process finishes. The output collected so far is in `output' and
+    `stderr'."""
+    def __init__(self, pid, timeout, output = None, stderr = None):
+        self.pid = pid
+        self.timeout = timeout
+        self.output = output
+        self.stderr = stderr
+        RuntimeError.__init__(self,
+                "Process %d timed out after %s seconds." % (pid, timeout))
+
 PIPE = -1
 STDOUT = -2
+SPOOL = -3
 class Popen(Subprocess):
     """Higher-level interface for executing processes, that tries to emulate
     the stdlib's subprocess.Popen as much as possible."""
 
     def __init__(self, node, argv, executable = None,
             stdin = None, stdout = None, stderr = None, bufsize = 0,
-            shell = False, cwd = None, env = None, user = None):
+            shell = False, cwd = None, env = None, user = None,
+            direct = False, env_template = None, pipesize = -1):
         """As in Subprocess, `node' specifies the nemu Node to run in.
 
         The `stdin', `stdout', and `stderr' parameters also accept the special
         values subprocess.PIPE or subprocess.STDOUT. Check the stdlib's
         subprocess module for more details. `bufsize' specifies the buffer size
-        for the buffered IO provided for PIPE'd descriptors.
+        for the buffered IO provided for PIPE'd descriptors. If `pipesize' is
+        positive, the capacity of the pipes created for PIPE is changed to it,
+        when the system allows it; otherwise the system default is kept.
+
+        `stdout' and `stderr' can also be SPOOL: the process then writes
+        directly to a memory file (or an unlinked temporary file, if memfd is
+        not available), which communicate() returns mapped in memory once the
+        process has finished. The output never goes through this process.
         """
 
         self.stdin = self.stdout = self.stderr = None
-        self._pid = self._returncode = None
+        self._pid = self._returncode = self._rusage = None
+        self._spooled = set()
         fdmap = { "stdin": stdin, "stdout": stdout, "stderr": stderr }
         # if PIPE: all should be closed at the end
         for k, v in fdmap.items():
             if v == None:
                 continue
-            if v == PIPE:
+            if v == SPOOL:
+                if k == "stdin":
+                    raise ValueError("SPOOL cannot be used for stdin.")
+                f = _make_spool()
+                setattr(self, k, f)
+                self._spooled.add(f)
+                fdmap[k] = f.fileno()
+            elif v == PIPE:
                 r, w = os.pipe()
+                if pipesize > 0:
+                    _set_pipe_size(r, pipesize)
                 if k == "stdin":
                     self.stdin = os.fdopen(w, 'wb', bufsize)
                     fdmap[k] = r
@@ -181,64 +269,349 @@ class Popen(Subprocess):
         super(Popen, self).__init__(node, argv, executable = executable,
                 stdin = fdmap['stdin'], stdout = fdmap['stdout'],
                 stderr = fdmap['stderr'],
-                shell = shell, cwd = cwd, env = env, user = user)
+                shell = shell, cwd = cwd, env = env, user = user,
+                direct = direct, env_template = env_template)
 
         # Close pipes, they have been dup()ed to the child
         for k, v in fdmap.items():
-            if getattr(self, k) != None:
+            if getattr(self, k) != None and getattr(self, k) not in \
+                    self._spooled:
                 eintr_wrapper(os.close, v)
 
-    def communicate(self, input = None):
-        """See Popen.communicate."""
-        # FIXME: almost verbatim from stdlib version, need to be removed or
-        # something
-        wset = []
-        rset = []
-        err = None
-        out = None
-        if self.stdin != None:
-            self.stdin.flush()
-            if input:
-                wset.append(self.stdin)
-            else:
-                self.stdin.close()
-        if self.stdout != None:
-            rset.append(self.stdout)
-            out = []
-        if self.stderr != None:
-            rset.append(self.stderr)
-            err = []
-
-        offset = 0
-        while rset or wset:
-            r, w, x = select.select(rset, wset, [])
-            if self.stdin in w:
-                wrote = os.write(self.stdin.fileno(),
-                        #buffer(input, offset, select.PIPE_BUF))
-                        buffer(input, offset, 512)) # XXX: py2.7
-                offset += wrote
-                if offset >= len(input):
+        # State of communicate(), kept between calls that time out
+        self._input = None
+        self._input_offset = 0
+        self._buffers = None
+        # Incomplete lines, for iter_lines()
+        self._partial = {}
+
+    def iter_chunks(self, size = None, timeout = None):
+        """Generator that yields the output of the process as it arrives, as
+        (name, data) tuples, where name is "stdout" or "stderr". Only the
+        descriptors created with PIPE are read, and they are closed at end of
+        file.
+
+        Nothing more is read until the previous chunk has been consumed, so
+        a slow consumer makes the process block instead of using memory. Each
+        chunk is at most `size' bytes (by default, the capacity of the pipe).
+        If `timeout' is given and no output arrives for that many seconds,
+        TimeoutExpired is raised; the iteration can be started again later."""
+        files = {}
+        poller = select.poll()
+        for name in "stdout", "stderr":
+            f = getattr(self, name)
+            if f != None and not f.closed and f not in self._spooled:
+                files[f.fileno()] = (name, f,
+                        size or _get_pipe_size(f.fileno()))
+                poller.register(f, select.POLLIN)
+        if timeout != None:
+            timeout = int(math.ceil(timeout * 1000))
+
+        while files:
+            try:
+                events = poller.poll(timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not events:
+                raise TimeoutExpired(self._pid, timeout / 1000.0)
+            for fd, event in events:
+                name, f, chunk = files[fd]
+                data = eintr_wrapper(os.read, fd, chunk)
+                if data:
+                    yield name, data
+                    continue
+                poller.unregister(fd)
+                del files[fd]
+                f.close()
+
+    def iter_lines(self, max_line = 64 * 1024, timeout = None):
+        """Like iter_chunks(), but yields the output line by line, keeping
+        the line terminators. Lines longer than `max_line' are split, so the
+        memory used does not depend on the output."""
+        for name, data in self.iter_chunks(timeout = timeout):
+            lines = (self._partial.pop(name, "") + data).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield name, line + "\n"
+            while len(rest) >= max_line:
+                yield name, rest[:max_line]
+                rest = rest[max_line:]
+            if rest:
+                self._partial[name] = rest
+        for name in "stdout", "stderr":
+            if name in self._partial:
+                yield name, self._partial.pop(name)
+
+    def stream_output(self, callback, lines = False, timeout = None):
+        """Callback mode: call `callback' with (name, data) for each chunk of
+        output (or each line, if `lines' is True) until the process closes its
+        output, then wait for it and return its exit code. See iter_chunks()
+        and iter_lines()."""
+        if lines:
+            output = self.iter_lines(timeout = timeout)
+        else:
+            output = self.iter_chunks(timeout = timeout)
+        for name, data in output:
+            callback(name, data)
+        return self.wait()
+
+    def communicate(self, input = None, timeout = None):
+        """See Popen.communicate. The pipes are handled with poll(), in
+        chunks of the size of each pipe. If `timeout' is given and the process
+        does not finish in that many seconds, TimeoutExpired is raised; the
+        output is not lost, and communicate() can be called again to
+        continue.
+
+        Spooled outputs are returned as read-only mmap objects (or empty
+        strings, if nothing was written), and are not part of the partial
+        output of TimeoutExpired."""
+        deadline = None if timeout == None else time.time() + timeout
+        if self._buffers == None:
+            self._buffers = {}
+            if self.stdin != None:
+                self.stdin.flush()
+                if input:
+                    self._input = input
+                    self._input_chunk = _get_pipe_size(self.stdin.fileno())
+                    fcntl.fcntl(self.stdin.fileno(), fcntl.F_SETFL,
+                            fcntl.fcntl(self.stdin.fileno(), fcntl.F_GETFL) |
+                            os.O_NONBLOCK)
+                else:
                     self.stdin.close()
-                    wset = []
-            for i in self.stdout, self.stderr:
-                if i in r:
-                    d = os.read(i.fileno(), 1024) # No need for eintr wrapper
-                    if d == "":
-                        i.close
-                        rset.remove(i)
-                    else:
-                        if i == self.stdout:
-                            out.append(d)
-                        else:
-                            err.append(d)
-
-        if out != None:
-            out = ''.join(out)
-        if err != None:
-            err = ''.join(err)
-        self.wait()
+            for f in self.stdout, self.stderr:
+                if f != None and f not in self._spooled:
+                    self._buffers[f] = _ReadBuffer(f.fileno())
+
+        finished = self._communicate(deadline)
+        out = err = None
+        if self.stdout in self._buffers:
+            out = self._buffers[self.stdout].getvalue()
+        if self.stderr in self._buffers:
+            err = self._buffers[self.stderr].getvalue()
+        if finished:
+            finished = self._wait_until(deadline)
+        if not finished:
+            raise TimeoutExpired(self._pid, timeout, out, err)
+        if self.stdout in self._spooled:
+            out = _map_spool(self.stdout)
+        if self.stderr in self._spooled:
+            err = _map_spool(self.stderr)
         return (out, err)
 
+    def _communicate(self, deadline):
+        """Feed the input and collect the output until all the pipes are
+        closed or the deadline passes; returns False in the latter case."""
+        poller = select.poll()
+        files = {}
+        if self.stdin != None and not self.stdin.closed:
+            files[self.stdin.fileno()] = self.stdin
+            poller.register(self.stdin, select.POLLOUT)
+        for f in self._buffers:
+            if not f.closed:
+                files[f.fileno()] = f
+                poller.register(f, select.POLLIN)
+
+        while files:
+            timeout = None
+            if deadline != None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return False
+                timeout = int(math.ceil(timeout * 1000))
+            try:
+                events = poller.poll(timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                f = files[fd]
+                if f is self.stdin:
+                    if not self._write_input(fd):
+                        continue
+                elif self._buffers[f].fill():
+                    continue
+                poller.unregister(fd)
+                del files[fd]
+                f.close()
+        return True
+
+    def _write_input(self, fd):
+        "Write a chunk of input; returns True when it is all written."
+        try:
+            self._input_offset += os.write(fd, buffer(self._input,
+                self._input_offset, self._input_chunk))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return False
+            if e.errno != errno.EPIPE:
+                raise
+            # The process does not want more input
+            self._input_offset = len(self._input)
+        return self._input_offset >= len(self._input)
+
+    def _wait_until(self, deadline):
+        """Wait for the process to finish, if it does before the deadline.
+        Returns True if it did."""
+        if deadline == None:
+            self.wait()
+            return True
+        # A single wait request to the node, answered when the process exits
+        done, pending = wait_any([self], max(deadline - time.time(), 0))
+        return bool(done)
+
+def _make_spool():
+    "Create an anonymous file to hold the output of a process."
+    if _memfd_create:
+        fd = _memfd_create("nemu-spool", MFD_CLOEXEC)
+        if fd >= 0:
+            return os.fdopen(fd, "r+b", 0)
+    return tempfile.TemporaryFile()
+
+def _map_spool(f):
+    "Map the contents of a spool file, and close it."
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return ""
+        return mmap.mmap(f.fileno(), size, mmap.MAP_SHARED, mmap.PROT_READ)
+    finally:
+        f.close()
+
+class _ReadBuffer(object):
+    """Collects the data read from a pipe, reading it directly into a
+    growing bytearray, in chunks of the size of the pipe."""
+    def __init__(self, fd):
+        self._file = io.FileIO(fd, "r", closefd = False)
+        self._chunk = _get_pipe_size(fd)
+        self._data = bytearray(self._chunk)
+        self._size = 0
+
+    def fill(self):
+        "Read once from the pipe; returns False on end of file."
+        if len(self._data) - self._size < self._chunk:
+            # Double the size, to keep the number of copies low
+            self._data.extend(bytearray(max(len(self._data), self._chunk)))
+        n = eintr_wrapper(self._file.readinto,
+                memoryview(self._data)[self._size:self._size + self._chunk])
+        self._size += n or 0
+        return n != 0
+
+    def getvalue(self):
+        return str(buffer(self._data, 0, self._size))
+
+def spawn_many(node, specs, cwd = None, env = None, user = None,
+        env_template = None):
+    """Start many processes in a node with a single request, and return a
+    list of Subprocess objects. Each spec is the argv of a process, or a
+    dictionary with `argv' and optionally `executable', `shell', `cwd',
+    `env', `user', `stdin', `stdout' and `stderr', with the same meaning as
+    for Subprocess. `cwd', `env' and `user' apply to all the processes that
+    do not give their own, and the `env' of a spec is added to the common
+    one; with `env_template', both are changes to that template, as in
+    Subprocess. If any process cannot be started, none is."""
+    if user == None:
+        user = Subprocess.default_user
+    wire = []
+    for spec in specs:
+        if not isinstance(spec, dict):
+            spec = { 'argv': spec }
+        spec = dict(spec)
+        argv = spec.pop('argv')
+        if isinstance(argv, str):
+            argv = [ argv ]
+        if spec.pop('shell', False):
+            argv = [ '/bin/sh', '-c' ] + argv
+        spec['argv'] = argv
+        for k in ('stdin', 'stdout', 'stderr'):
+            if spec.get(k) != None and not isinstance(spec[k], int):
+                spec[k] = spec[k].fileno()
+        wire.append(spec)
+    pids = node._slave.spawn_many(wire, cwd = cwd, env = env, user = user,
+            env_template = env_template)
+    return [Subprocess._adopt(node, pid) for pid in pids]
+
+def wait_any(procs, timeout = None):
+    """Wait until any of the given processes (Subprocess or Popen objects,
+    which can belong to different nodes) has finished, or until `timeout'
+    seconds have passed. Returns a tuple (done, pending) of lists of
+    processes; the finished ones have their returncode and rusage set."""
+    return _wait_many(procs, timeout, False)
+
+def wait_all(procs, timeout = None):
+    """Wait until all the given processes have finished, or until `timeout'
+    seconds have passed. Returns a tuple (done, pending) as wait_any()."""
+    return _wait_many(procs, timeout, True)
+
+def _wait_many(procs, timeout, wait_all):
+    """Send one wait request per node for all its processes, and wait for
+    the replies of all the nodes at once. Processes started directly are
+    waited for through pidfds, where available; those, and the ones of nodes
+    reached through a text mode connection (which has no wait requests), are
+    polled otherwise."""
+    procs = list(procs)
+    deadline = None if timeout == None else time.time() + timeout
+    pending = [p for p in procs if p._returncode == None]
+    if pending and (wait_all or len(pending) == len(procs)):
+        polled = [p for p in pending if p._direct or not p._slave._binary]
+        bynode = {}
+        for p in pending:
+            if p not in polled:
+                bynode.setdefault(p._slave, {})[p.pid] = p
+        reqs = {}
+        pidfds = {}
+        delay = 0.0005
+        try:
+            for p in polled:
+                if p._direct:
+                    fd = _pidfd_open(p.pid)
+                    if fd != None:
+                        pidfds[fd] = p
+            for slave, ps in bynode.items():
+                reqs[slave] = slave.wait_set(ps.keys(), wait_all)
+            while True:
+                ready = [s for s, reqid in reqs.items() if s.reply_ready(reqid)]
+                for slave in ready:
+                    _wait_result(slave, reqs.pop(slave), bynode[slave])
+                left = [p for p in polled if p.poll() == None]
+                if wait_all and not reqs and not left:
+                    break
+                if not wait_all and (ready or len(left) < len(polled)):
+                    break
+                wait = None
+                if deadline != None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        break
+                # Another thread might be reading the replies for us, or
+                # there might be processes that cannot be waited for
+                if [s for s in reqs if s._reading]:
+                    wait = 0.1 if wait == None else min(wait, 0.1)
+                if len(pidfds) < len(polled):
+                    wait = delay if wait == None else min(wait, delay)
+                    delay = min(delay * 2, 0.05)
+                try:
+                    select.select(reqs.keys() + [fd for fd, p in
+                        pidfds.items() if p._returncode == None], [], [], wait)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+        finally:
+            for fd in pidfds:
+                os.close(fd)
+            for slave, reqid in reqs.items():
+                slave.cancel_wait_set(reqid)
+                _wait_result(slave, reqid, bynode[slave])
+    return ([p for p in procs if p._returncode != None],
+            [p for p in procs if p._returncode == None])
+
+def _wait_result(slave, reqid, procs):
+    for pid, status, rusage in slave.wait_set_result(reqid):
+        procs[pid]._returncode = status
+        procs[pid]._rusage = rusage
+
 def system(node, args):
     """Emulates system() function, if `args' is an string, it uses `/bin/sh' to
     exexecute it, otherwise is interpreted as the argv array to call execve."""
@@ -270,7 +643,7 @@ def backticks_raise(node, args):
 # Server-side code, called from nemu.protocol.Server
 
 def spawn(executable, argv = None, cwd = None, env = None, close_fds = False,
-        stdin = None, stdout = None, stderr = None, user = None):
+        stdin = None, stdout = None, stderr = None, user = None, netns = None):
     """Internal function that performs all the dirty work for Subprocess, Popen
     and friends. This is executed in the slave process, directly from the
     protocol.Server class.
@@ -286,6 +659,14 @@ def spawn(executable, argv = None, cwd = None, env = None, close_fds = False,
 
     Note that 'std{in,out,err}' must be None, integers, or file objects, PIPE
     is not supported here. Also, the original descriptors are not closed.
+
+    When possible (no user change, and a C library that can do the rest of
+    the set-up), the process is started with posix_spawn(3), which avoids
+    copying the page tables of the server; otherwise it falls back to
+    fork and exec.
+
+    If `netns' is given, it is a descriptor of the network name space to
+    start the process in (see Subprocess, with direct = True).
     """
     userfd = [stdin, stdout, stderr]
     filtered_userfd = filter(lambda x: x != None and x >= 0, userfd)
@@ -297,25 +678,34 @@ def spawn(executable, argv = None, cwd = None, env = None, close_fds = False,
     assert not (set([0, 1, 2]) & set(filtered_userfd))
 
     if user != None:
-        user, uid, gid = get_user(user)
-        home = pwd.getpwuid(uid)[5]
-        groups = [x[2] for x in grp.getgrall() if user in x[3]]
+        user, uid, gid, home, groups = resolve_user(user)
         if not env:
             env = dict(os.environ)
         env['HOME'] = home
         env['USER'] = user
+    elif USE_POSIX_SPAWN:
+        if netns != None:
+            pid = _spawn_fast_netns(netns, executable, argv, cwd, env,
+                    close_fds, userfd)
+        else:
+            pid = _spawn_fast(executable, argv, cwd, env, close_fds, userfd)
+        if pid:
+            return pid
 
     (r, w) = os.pipe()
     pid = os.fork()
     if pid == 0: # pragma: no cover
         # coverage doesn't seem to understand fork
         try:
+            if netns != None:
+                unshare.setns(netns, unshare.CLONE_NEWNET)
             # Set up stdio piping
             for i in range(3):
                 if userfd[i] != None and userfd[i] >= 0:
                     os.dup2(userfd[i], i)
-                    if userfd[i] != i and userfd[i] not in userfd[0:i]:
-                        eintr_wrapper(os.close, userfd[i]) # only in child!
+            for fd in set(userfd):
+                if fd != None and fd > 2:
+                    eintr_wrapper(os.close, fd) # only in child!
 
             # Set up special control pipe
             eintr_wrapper(os.close, r)
@@ -323,12 +713,7 @@ def spawn(executable, argv = None, cwd = None, env = None, close_fds = False,
             fcntl.fcntl(w, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
 
             if close_fds == True:
-                for i in xrange(3, MAXFD):
-                    if i != w:
-                        try:
-                            os.close(i)
-                        except:
-                            pass
+                _close_fds_from(3, keep = w)
             elif close_fds != False:
                 for i in close_fds:
                     os.close(i)
@@ -404,27 +789,257 @@ def wait(pid):
     """Wait for process to die and return the exit code."""
     return eintr_wrapper(os.waitpid, pid, 0)[1]
 
+def find_executable(executable, env = None):
+    """Search `executable' in the PATH of `env' (by default, the current
+    environment) as execvp() would, and return its full path, or None if
+    not found. Names containing a slash are returned unchanged."""
+    if '/' in executable:
+        return executable
+    if env == None:
+        env = os.environ
+    for d in env.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(d or os.curdir, executable)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
 def get_user(user):
     "Take either an username or an uid, and return a tuple (user, uid, gid)."
+    return resolve_user(user)[0:3]
+
+def resolve_user(user, pin = False):
+    """Take either an username or an uid, and return a tuple (user, uid, gid,
+    home, groups), where groups are the supplementary groups of the user.
+    Results are cached for USER_CACHE_TTL seconds, as the lookups can be slow
+    with network-backed databases; if `pin' is True, they are kept until
+    flush_user_cache() is called."""
+    key = str(user)
+    entry = _user_cache.get(key)
+    if entry and (entry[0] == None or entry[0] > time.time()):
+        if pin:
+            _user_cache[key] = (None, entry[1])
+        return entry[1]
     if str(user).isdigit():
-        uid = int(user)
         try:
-            user = pwd.getpwuid(uid)[0]
+            pw = pwd.getpwuid(int(user))
         except KeyError:
             raise ValueError("UID %d does not exist" % int(user))
     else:
         try:
-            uid = pwd.getpwnam(str(user))[2]
+            pw = pwd.getpwnam(str(user))
         except KeyError:
             raise ValueError("User %s does not exist" % str(user))
-    gid = pwd.getpwuid(uid)[3]
-    return user, uid, gid
+    groups = [x[2] for x in grp.getgrall() if pw[0] in x[3]]
+    result = (pw[0], pw[2], pw[3], pw[5], groups)
+    _user_cache[key] = (None if pin else time.time() + USER_CACHE_TTL, result)
+    return result
+
+def flush_user_cache():
+    "Forget all the users resolved by resolve_user()."
+    _user_cache.clear()
 
 # internal stuff, do not look!
 
+# Set to False to always use fork and exec in spawn()
+USE_POSIX_SPAWN = True
+
+# Seconds that resolved users are cached, see resolve_user()
+USER_CACHE_TTL = 60
+# str(user) -> (expiry time, or None if pinned; resolved user)
+_user_cache = {}
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+_posix_spawn = getattr(_libc, "posix_spawn", None)
+# GNU extensions, might not be available
+_addchdir = getattr(_libc, "posix_spawn_file_actions_addchdir_np", None)
+_addclosefrom = getattr(_libc, "posix_spawn_file_actions_addclosefrom_np",
+        None)
+_memfd_create = getattr(_libc, "memfd_create", None)
+if _memfd_create:
+    _memfd_create.argtypes = [ctypes.c_char_p, ctypes.c_uint]
+    _memfd_create.restype = ctypes.c_int
+MFD_CLOEXEC = 1
+POSIX_SPAWN_SETPGROUP = 2
+# Opaque types, with room to spare
+_file_actions_t = ctypes.c_char * 256
+_spawnattr_t = ctypes.c_char * 1024
+
+def _spawn_fast(executable, argv, cwd, env, close_fds, userfd):
+    """Start a process with posix_spawn(3), doing the same set-up as the
+    fork path in spawn(). Returns None if it cannot be done this way."""
+    if not _posix_spawn:
+        return None
+    if (cwd != None and not _addchdir) or (close_fds == True and
+            not _addclosefrom):
+        return None
+    if env == None:
+        env = os.environ
+    # posix_spawnp would use the PATH of the server, not the one in env
+    path = find_executable(executable, env)
+    if path == None:
+        # Let the fork path report the error
+        return None
+    if not argv:
+        argv = [ executable ]
+
+    actions = _file_actions_t()
+    attr = _spawnattr_t()
+    _check_spawn(_libc.posix_spawn_file_actions_init(actions))
+    try:
+        _check_spawn(_libc.posix_spawnattr_init(attr))
+        try:
+            # Set up stdio piping; the originals are closed afterwards
+            for i in range(3):
+                if userfd[i] != None and userfd[i] >= 0:
+                    _check_spawn(_libc.posix_spawn_file_actions_adddup2(
+                        actions, userfd[i], i))
+            for fd in set(userfd):
+                if fd != None and fd > 2:
+                    _check_spawn(_libc.posix_spawn_file_actions_addclose(
+                        actions, fd))
+            if close_fds == True:
+                _check_spawn(_addclosefrom(actions, 3))
+            elif close_fds != False:
+                for fd in close_fds:
+                    _check_spawn(_libc.posix_spawn_file_actions_addclose(
+                        actions, fd))
+            if cwd != None:
+                _check_spawn(_addchdir(actions, str(cwd)))
+            # changing process group id
+            # (it is necessary to kill the forked subprocesses)
+            _check_spawn(_libc.posix_spawnattr_setflags(attr,
+                POSIX_SPAWN_SETPGROUP))
+            _check_spawn(_libc.posix_spawnattr_setpgroup(attr, 0))
+
+            c_argv = (ctypes.c_char_p * (len(argv) + 1))(*map(str, argv))
+            c_env = (ctypes.c_char_p * (len(env) + 1))(
+                    *["%s=%s" % (k, v) for k, v in env.items()])
+            pid = ctypes.c_int()
+            err = _posix_spawn(ctypes.byref(pid), str(path), actions, attr,
+                    c_argv, c_env)
+        finally:
+            _libc.posix_spawnattr_destroy(attr)
+    finally:
+        _libc.posix_spawn_file_actions_destroy(actions)
+    if err:
+        raise OSError(err, os.strerror(err))
+    return pid.value
+
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+def _set_pipe_size(fd, size):
+    "Try to change the capacity of a pipe; the system may not allow it."
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except IOError:
+        pass
+
+def _get_pipe_size(fd):
+    try:
+        return fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except IOError:
+        return 65536
+
+def _spawn_fast_netns(netns, *args):
+    """Call _spawn_fast() with the calling thread switched to the network name
+    space `netns'; the child inherits it."""
+    if not _posix_spawn:
+        return None
+    with _in_netns(netns):
+        return _spawn_fast(*args)
+
+@contextlib.contextmanager
+def _in_netns(netns):
+    """Switch the calling thread to the network name space `netns' (a
+    descriptor; None means the current one) for the duration of the block.
+    Name spaces are per thread, so other threads are not affected; processes
+    started and sockets created meanwhile belong to `netns'."""
+    if netns == None:
+        yield
+        return
+    orig = os.open("/proc/thread-self/ns/net", os.O_RDONLY)
+    try:
+        unshare.setns(netns, unshare.CLONE_NEWNET)
+        try:
+            yield
+        finally:
+            unshare.setns(orig, unshare.CLONE_NEWNET)
+    finally:
+        os.close(orig)
+
+def _pidfd_open(pid):
+    """Return a descriptor that becomes readable when the process exits, or
+    None if the system does not support it."""
+    if _NR_pidfd_open == None:
+        return None
+    fd = _libc.syscall(_NR_pidfd_open, pid, 0)
+    if fd < 0:
+        return None
+    return fd
+
+def _check_spawn(err):
+    if err:
+        raise OSError(err, os.strerror(err))
+
 try:
     MAXFD = os.sysconf("SC_OPEN_MAX")
 except: # pragma: no cover
     MAXFD = 256
 
+# close_range(2) is only in recent C libraries, but the system call might
+# still be there.
+_close_range = getattr(_libc, "close_range", None)
+# Recent system calls have the same number in the architectures that use the
+# common table; others (e.g. alpha, ia64, mips, or x32) have their own, and
+# these are not used there, so no arbitrary system call is ever made.
+_common_syscalls = ("x86_64", "i386", "i486", "i586", "i686", "aarch64",
+        "arm64", "armv6l", "armv7l", "armv8l", "ppc", "ppc64", "ppc64le",
+        "s390x", "riscv64", "loongarch64")
+_machine = platform.machine()
+if _machine in _common_syscalls and not (_machine == "x86_64" and
+        ctypes.sizeof(ctypes.c_void_p) == 4):
+    _NR_close_range = 436
+    _NR_pidfd_open = 434
+else: # pragma: no cover
+    _NR_close_range = _NR_pidfd_open = None
+
+def _close_fds_from(lowfd, keep = None):
+    """Close all file descriptors from `lowfd' upwards, except `keep'. Uses
+    close_range(2) if available, otherwise the descriptors listed in
+    /proc/self/fd; trying every possible descriptor up to MAXFD is the last
+    resort, as it can take a million system calls."""
+    ranges = [(lowfd, 0xffffffff)]
+    if keep != None and keep >= lowfd:
+        ranges = [(lowfd, keep - 1), (keep + 1, 0xffffffff)]
+    try:
+        for first, last in ranges:
+            if first <= last:
+                _sys_close_range(first, last)
+        return
+    except OSError:
+        pass
+    try:
+        fds = [int(x) for x in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = xrange(lowfd, MAXFD)
+    for fd in fds:
+        if fd >= lowfd and fd != keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def _sys_close_range(first, last):
+    if _close_range:
+        ret = _close_range(ctypes.c_uint(first), ctypes.c_uint(last), 0)
+    elif _NR_close_range == None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    else:
+        ret = _libc.syscall(_NR_close_range, ctypes.c_uint(first),
+                ctypes.c_uint(last), 0)
+    if ret != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
 
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+# vim:ts=4:sw=4:et:ai:sts=4
+
+import nemu, test_util
+import os, unittest
+
+try:
+    import trollius
+    from trollius import From, Return
+    import nemu.asyncio_
+except ImportError:
+    trollius = None
+
+class TestAsyncio(unittest.TestCase):
+    @test_util.skipUnless(trollius, "Test requires trollius")
+    def test_processes(self):
+        loop = trollius.new_event_loop()
+        nodes = [nemu.Node(nonetns = True) for i in range(5)]
+        anodes = [nemu.asyncio_.AsyncNode(n, loop) for n in nodes]
+
+        @trollius.coroutine
+        def run(anode, i):
+            p = yield From(anode.Popen(['sh', '-c', 'cat; echo err%d >&2' % i],
+                stdin = nemu.PIPE, stdout = nemu.PIPE, stderr = nemu.PIPE))
+            out, err = yield From(p.communicate("hello %d\n" % i * 1000))
+            line = None
+            p2 = yield From(anode.Popen(['echo', 'line'], stdout = nemu.PIPE))
+            line = yield From(p2.stdout.readline())
+            yield From(p2.wait())
+            raise Return((out, err, p.returncode, line))
+
+        results = loop.run_until_complete(trollius.gather(
+            *[run(a, i) for i, a in enumerate(anodes)], loop = loop))
+        for i, (out, err, code, line) in enumerate(results):
+            self.assertEquals(out, "hello %d\n" % i * 1000)
+            self.assertEquals(err, "err%d\n" % i)
+            self.assertEquals(code, 0)
+            self.assertEquals(line, "line\n")
+
+        @trollius.coroutine
+        def failures(anode):
+            p = yield From(anode.Popen(['sh', '-c', 'exit 3']))
+            code = yield From(p.wait())
+            self.assertTrue(p.rusage.ru_maxrss > 0)
+            try:
+                yield From(anode.Popen(['/nonexistent']))
+            except OSError:
+                raise Return(code)
+        self.assertEquals(loop.run_until_complete(failures(anodes[0])), 3)
+
+        for a in anodes:
+            a.close()
+        # The synchronous client still works
+        self.assertEquals(nodes[0].backticks("echo ok"), "ok\n")
+        loop.close()
+
+    @test_util.skipUnless(trollius, "Test requires trollius")
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_network(self):
+        loop = trollius.new_event_loop()
+        node = nemu.Node()
+        anode = nemu.asyncio_.AsyncNode(node, loop)
+
+        @trollius.coroutine
+        def build():
+            iface = yield From(anode.add_if(mtu = 1400, up = True))
+            yield From(anode.add_addr(iface, nemu.iproute.ipv4address(
+                "10.0.0.1", 24, None)))
+            yield From(anode.add_route(prefix = "10.1.0.0", prefix_len = 16,
+                nexthop = "10.0.0.2"))
+            ifaces = yield From(anode.get_interfaces())
+            routes = yield From(anode.get_routes())
+            raise Return((iface, ifaces, routes))
+
+        iface, ifaces, routes = loop.run_until_complete(build())
+        data = [i for i in ifaces if i.index == iface.index][0]
+        self.assertEquals((data.mtu, data.up), (1400, True))
+        self.assertTrue(nemu.iproute.route(prefix = "10.1.0.0",
+            prefix_len = 16, nexthop = "10.0.0.2",
+            interface = iface.index) in routes)
+        anode.close()
+        loop.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python2
+# vim:ts=4:sw=4:et:ai:sts=4
+
+import nemu, test_util
+import os, shutil, tempfile, time, unittest
+
+class TestCollector(unittest.TestCase):
+    def wait_finished(self, collector, names):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if all(collector.finished(n) for n in names):
+                return
+            time.sleep(0.05)
+        self.fail("Output not collected")
+
+    def test_collector(self):
+        node = nemu.Node(nonetns = True)
+        logdir = tempfile.mkdtemp()
+        collector = nemu.OutputCollector(ring_size = 1000, directory = logdir)
+        try:
+            procs = []
+            for i in range(50):
+                p = node.Popen(['sh', '-c',
+                    'for j in 1 2 3; do echo proc%d line $j; done; ' % i +
+                    'echo error >&2; printf last'],
+                    stdout = nemu.PIPE, stderr = nemu.PIPE)
+                procs.append(p)
+                self.assertEquals(collector.add(p, "p%d" % i), "p%d" % i)
+            # No log file is left open on errors
+            nfds = len(os.listdir("/proc/self/fd"))
+            self.assertRaises(ValueError, collector.add, procs[0], "p0")
+            self.assertEquals(len(os.listdir("/proc/self/fd")), nfds)
+            self.wait_finished(collector, ["p%d" % i for i in range(50)])
+            for p in procs:
+                self.assertEquals(p.wait(), 0)
+
+            # The order between the streams is not guaranteed
+            tail = collector.tail("p7", 2)
+            self.assertEquals(sorted((x[1], x[2]) for x in tail),
+                    [("stderr", "error"), ("stdout", "last")])
+            self.assertEquals([x[2] for x in
+                collector.tail("p7", 2, stream = "stdout")],
+                ["proc7 line 3", "last"])
+            self.assertTrue(tail[0][0] <= tail[1][0] <= time.time())
+
+            found = collector.grep(r"line 2$")
+            self.assertEquals(sorted(x[0] for x in found),
+                    sorted("p%d" % i for i in range(50)))
+            self.assertEquals(collector.grep("proc1 ", name = "p1")[0][3],
+                    "proc1 line 1")
+            self.assertEquals(collector.grep("error", stream = "stdout"), [])
+
+            # Bounded ring buffer, complete log file
+            p = node.Popen(['sh', '-c', 'for i in $(seq 1000); do ' +
+                'echo line $i; done'], stdout = nemu.PIPE)
+            collector.add(p, "long")
+            self.wait_finished(collector, ["long"])
+            p.wait()
+            ring = collector.tail("long", 2000)
+            self.assertTrue(sum(len(x[2]) for x in ring) <= 1000)
+            self.assertEquals(ring[-1][2], "line 1000")
+            collector.remove("long")
+            self.assertRaises(KeyError, collector.tail, "long")
+        finally:
+            collector.close()
+        log = open(os.path.join(logdir, "long.log")).readlines()
+        self.assertEquals(len(log), 1000)
+        self.assertEquals(log[-1].split(" ", 2)[1:], ["stdout", "line 1000\n"])
+        shutil.rmtree(logdir)
+
+    def test_max_line(self):
+        node = nemu.Node(nonetns = True)
+        collector = nemu.OutputCollector(max_line = 10)
+        try:
+            # Both complete and incomplete lines are split
+            p = node.Popen(['sh', '-c', 'echo 0123456789abcdefghij; ' +
+                'echo short; printf 0123456789abc'], stdout = nemu.PIPE)
+            collector.add(p, "p")
+            self.wait_finished(collector, ["p"])
+            p.wait()
+            self.assertEquals([x[2] for x in collector.tail("p", 10)],
+                    ["0123456789", "abcdefghij", "short", "0123456789",
+                        "abc"])
+        finally:
+            collector.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -166,6 +166,42 @@ class TestInterfaces(unittest.TestCase):
         self.assertTrue(len(if0.get_addresses()) >= 2)
         self.assertEquals(if0.get_addresses(), devs[if0.name]['addr'])
 
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_batch(self):
+        node0 = nemu.Node()
+        if0 = node0.add_if()
+        with node0.batch():
+            if0.mtu = 1492
+            if0.up = True
+            if0.add_v4_address(address = '10.0.0.1', prefix_len = 24)
+            node0.add_route(prefix = '10.1.0.0', prefix_len = 16,
+                    nexthop = '10.0.0.2')
+            # Queries are not possible inside a batch
+            self.assertRaises(RuntimeError, getattr, if0, 'mtu')
+        self.assertEquals(if0.mtu, 1492)
+        self.assertTrue(if0.up)
+        self.assertEquals([x['address'] for x in if0.get_addresses()],
+                ['10.0.0.1'])
+        self.assertEquals(len(node0.get_routes()), 2)
+
+        # Failure in the middle: everything is rolled back
+        def fail():
+            with node0.batch():
+                if0.mtu = 1400
+                if0.add_v4_address(address = '10.0.1.1', prefix_len = 24)
+                if0.add_v4_address(address = '10.0.0.1', prefix_len = 24)
+        self.assertRaises(AssertionError, fail)
+        self.assertEquals(if0.mtu, 1492)
+        self.assertEquals([x['address'] for x in if0.get_addresses()],
+                ['10.0.0.1'])
+
+        # Without atomicity, every command is tried
+        replies = node0._slave.batch([
+            ("ADDR", "ADD", if0.index, "10.0.0.1", 24),
+            ("IF", "SET", if0.index, "mtu", 1400)], atomic = False)
+        self.assertEquals([x[0] for x in replies], [550, 200])
+        self.assertEquals(if0.mtu, 1400)
+
 class TestWithDummy(unittest.TestCase):
     def setUp(self):
         self.cleanup = []
@@ -2,9 +2,23 @@
 # vim:ts=4:sw=4:et:ai:sts=4
 
 import nemu, nemu.environ, test_util
-import os, signal, subprocess, sys, time
+import os, signal, socket, subprocess, sys, time
 import unittest
 
+def _interfaces():
+    return sorted(l.split(":")[0].strip()
+            for l in open("/proc/net/dev").readlines()[2:])
+
+def _fail(msg):
+    raise ValueError(msg)
+
+def _wakeup_fd():
+    return signal.set_wakeup_fd(-1)
+
+def _slow_add(a, b):
+    time.sleep(0.2)
+    return a + b
+
 class TestNode(unittest.TestCase):
     @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
     def test_node(self):
@@ -19,6 +33,93 @@ class TestNode(unittest.TestCase):
 
         self.assertTrue(node.get_interface("lo").up)
 
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_watch(self):
+        node = nemu.Node()
+        events = []
+        node.watch(lambda *args: events.append(args))
+        lo = node.get_interface("lo")
+        lo.up = False
+        lo.add_v4_address("10.0.0.1", 24)
+
+        def wait_for(kind, action):
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                found = [e for e in events if e[0:2] == (kind, action)]
+                if found:
+                    return found
+                node.process_events(deadline - time.time())
+            self.fail("No %s %s event received" % (kind, action))
+        link = wait_for("link", "new")[-1]
+        self.assertEquals((link[2], link[3].name), (lo.index, "lo"))
+        addr = wait_for("addr", "new")[-1]
+        self.assertEquals(addr[3].address, "10.0.0.1")
+
+        node.unwatch()
+        del events[:]
+        lo.up = True
+        self.assertFalse(node.process_events(0.2))
+        self.assertEquals(events, [])
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_call(self):
+        node = nemu.Node()
+        self.assertEquals(node.call(_interfaces), ["lo"])
+        self.assertNotEquals(node.call(os.getpid), node.pid)
+        self.assertEquals(node.call(max, [1, 3], key = abs), 3)
+        try:
+            node.call(_fail, "oops")
+            self.fail("No exception raised")
+        except ValueError, e:
+            self.assertEquals(str(e), "oops")
+            self.assertTrue("_fail" in e.child_traceback)
+        self.assertRaises(RuntimeError, node.call, os._exit, 1)
+        # The signal wakeup pipe of the server is not inherited
+        self.assertEquals(node.call(_wakeup_fd), -1)
+
+        r = node.submit(_slow_add, 2, 3)
+        self.assertFalse(r.done())
+        self.assertEquals(r.result(), 5)
+        self.assertTrue(r.done())
+        self.assertEquals(r.result(), 5)
+
+        # One-shot workers are forked for each call, pooled ones are reused
+        self.assertEquals(len(set(node.call(os.getpid) for i in range(3))), 3)
+        node.set_workers(2)
+        self.assertEquals(len(set(node.call(os.getpid) for i in range(3))), 1)
+        results = [node.submit(_slow_add, i, 1) for i in range(4)]
+        t = time.time()
+        self.assertEquals([r.result() for r in results], [1, 2, 3, 4])
+        self.assertTrue(0.3 < time.time() - t < 2)
+        self.assertRaises(RuntimeError, node.call, os._exit, 1)
+        self.assertEquals(node.call(_slow_add, 1, 1), 2)
+        node.set_workers(0)
+        self.assertEquals(node.call(_slow_add, 1, 1), 2)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_sockets(self):
+        node = nemu.Node()
+        srv = node.bind(("127.0.0.1", 0))
+        srv.listen(1)
+        addr = srv.getsockname()
+        # Not reachable from outside the node
+        self.assertRaises(socket.error, socket.create_connection, addr, 1)
+        cli = node.create_connection(addr, 5)
+        conn = srv.accept()[0]
+        cli.sendall("hello")
+        self.assertEquals(conn.recv(5), "hello")
+        for s in (cli, conn, srv):
+            s.close()
+
+        udp = node.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.bind(("127.0.0.1", 0))
+        udp.sendto("x", udp.getsockname())
+        self.assertEquals(udp.recv(1), "x")
+        udp.close()
+        # The calling thread is back in its own name space
+        self.assertEquals(os.readlink("/proc/thread-self/ns/net"),
+                os.readlink("/proc/self/ns/net"))
+
     @test_util.skip("Not implemented")
     def test_detect_fork(self):
         # Test that nemu recognises a fork
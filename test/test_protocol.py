@@ -1,8 +1,11 @@
 #!/usr/bin/env python2
 # vim:ts=4:sw=4:et:ai:sts=4
 
-import nemu.protocol
-import os, socket, sys, threading, unittest
+import nemu.iproute, nemu.protocol
+import mmap, os, signal, socket, struct, sys, threading, time, unittest
+
+class _TestError(Exception):
+    pass
 
 class TestServer(unittest.TestCase):
     def test_server_startup(self):
@@ -88,6 +91,411 @@ class TestServer(unittest.TestCase):
 
         t.join()
 
+    def test_binary_mode(self):
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+
+        def run_server():
+            nemu.protocol.Server(s0, s0).run()
+        t = threading.Thread(target = run_server)
+        t.start()
+
+        s = os.fdopen(s1.fileno(), "r+", 1)
+        self.assertEquals(s.readline()[0:4], "220 ")
+        s.write("MODE BIN\n")
+        self.assertEquals(s.readline()[0:4], "200 ")
+
+        def query(*args):
+            body = "".join(struct.pack("!I", len(x)) + x for x in args)
+            s.write(struct.pack("!II", len(body), 42) + body)
+            s.flush()
+            size, reqid = struct.unpack("!II", s.read(8))
+            self.assertEquals(reqid, 42)
+            body = s.read(size)
+            code, tsize = struct.unpack("!HI", body[0:6])
+            return code, body[6:6 + tsize], body[6 + tsize:]
+
+        code, text, payload = query("IF", "LIST", "1")
+        self.assertEquals(code, 200)
+        self.assertEquals(nemu.protocol._unserialise(payload).index, 1)
+        # Arguments can contain spaces and are not base64-decoded
+        self.assertEquals(query("PROC", "CRTE", "=/bin/true x")[0], 200)
+        self.assertEquals(query("PROC", "ABRT")[0], 200)
+        self.assertEquals(query("PROC")[0], 500)
+        self.assertEquals(query("QUIT")[0], 221)
+        s.close()
+        t.join()
+
+    def test_serialisation(self):
+        iface = nemu.iproute.interface(index = 3, name = "eth0", up = True,
+                mtu = 1500, lladdr = "12:34:56:78:9a:bc", arp = False)
+        addrs = [nemu.iproute.ipv4address("10.0.0.1", 24, "10.0.0.255"),
+                nemu.iproute.ipv6address("fe80::1", 64)]
+        routes = [nemu.iproute.route(prefix = "10.1.0.0", prefix_len = 16,
+            nexthop = "10.0.0.2", metric = 10),
+            nemu.iproute.route(tipe = "unreachable", interface = 3)]
+        data = [None, True, False, -5, 2 ** 40, 2 ** 64, -2 ** 70, 1.5, "",
+                "foo", u"caf\xe9", [u"a", "b"], [1, 2 ** 64], (1, "foo"),
+                {"a": [1, 2], 3: {}}, ({3: iface}, {"eth0": iface}),
+                [iface, iface], addrs, routes]
+        for obj in data:
+            dec = nemu.protocol._unserialise(nemu.protocol._serialise(obj))
+            self.assertEquals(repr(dec), repr(obj))
+            self.assertEquals(type(dec), type(obj))
+        self.assertEquals(nemu.protocol._unserialise(
+            nemu.protocol._serialise(addrs)), addrs)
+        self.assertEquals(nemu.protocol._unserialise(
+            nemu.protocol._serialise(routes)), routes)
+
+        e = OSError(2, "No such file or directory")
+        e.filename = "/foo"
+        e.child_traceback = "trace"
+        dec = nemu.protocol._unserialise(nemu.protocol._serialise(e))
+        self.assertEquals(type(dec), OSError)
+        self.assertEquals((dec.errno, dec.filename, dec.child_traceback),
+                (2, "/foo", "trace"))
+        # Unknown exceptions are not re-created
+        class FooError(Exception):
+            pass
+        dec = nemu.protocol._unserialise(nemu.protocol._serialise(
+            FooError("bar")))
+        self.assertEquals(type(dec), RuntimeError)
+        # Those from a module loaded here are
+        dec = nemu.protocol._unserialise(nemu.protocol._serialise(
+            _TestError(u"caf\xe9")))
+        self.assertEquals((type(dec), dec.args), (_TestError, (u"caf\xe9",)))
+        # If an exception cannot be encoded, its representation is sent
+        class Unprintable(object):
+            def __str__(self):
+                raise ValueError
+        e = ValueError(Unprintable())
+        e.child_traceback = "trace"
+        self.assertRaises(ValueError, nemu.protocol._serialise, e)
+        dec = nemu.protocol._unserialise(
+                nemu.protocol._serialise_exception(e))
+        self.assertEquals(type(dec), RuntimeError)
+        self.assertEquals(dec.args[0], repr(e))
+        self.assertEquals(dec.child_traceback, "trace")
+        self.assertRaises(TypeError, nemu.protocol._serialise, object())
+        self.assertRaises(RuntimeError, nemu.protocol._unserialise,
+                "\xff" + nemu.protocol._serialise(None)[1:])
+
+    def test_pipelining(self):
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+
+        def run_server():
+            nemu.protocol.Server(s0, s0).run()
+        t = threading.Thread(target = run_server)
+        t.start()
+
+        cli = nemu.protocol.Client(s1, s1)
+        # Several requests in flight, replies claimed in any order
+        ids = [cli._send_cmd("IF", "LIST", 1), cli._send_cmd("PROC", "POLL", 1),
+                cli._send_cmd("IF", "LIST", -1)]
+        self.assertEquals(cli._read_reply(ids[2])[0], 550)
+        self.assertEquals(cli._read_reply(ids[1])[0], 500)
+        self.assertEquals(cli._read_reply(ids[0])[0], 200)
+
+        # Concurrent use from many threads
+        errors = []
+        def worker():
+            try:
+                for i in range(20):
+                    self.assertEquals(cli.get_if_data(1).index, 1)
+                    r, w = os.pipe()
+                    pid = cli.spawn(["/bin/true"], stdout = w)
+                    os.close(w)
+                    os.close(r)
+                    self.assertEquals(cli.wait(pid), 0)
+            except BaseException, e:
+                errors.append(e)
+        workers = [threading.Thread(target = worker) for i in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEquals(errors, [])
+        cli.shutdown()
+        t.join()
+
+    def test_spawn_single_command(self):
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+
+        def run_server():
+            nemu.protocol.Server(s0, s0).run()
+        t = threading.Thread(target = run_server)
+        t.start()
+
+        cli = nemu.protocol.Client(s1, s1)
+        r0, w0 = os.pipe()
+        r1, w1 = os.pipe()
+        r2, w2 = os.pipe()
+        pid = cli.spawn(["/bin/sh", "-c", "cat; echo $FOO >&2; pwd >&2"],
+                stdin = r0, stdout = w1, stderr = w2, cwd = "/",
+                env = {"FOO": "bar baz"})
+        os.close(r0)
+        os.close(w1)
+        os.close(w2)
+        os.write(w0, "hello\n")
+        os.close(w0)
+        self.assertEquals(os.read(r1, 100), "hello\n")
+        self.assertEquals(cli.wait(pid), 0)
+        # Two separate writes: read until the end of file
+        self.assertEquals(os.fdopen(r2).read(), "bar baz\n/\n")
+        os.close(r1)
+
+        # A bad descriptor does not break the connection
+        r, w = os.pipe()
+        os.close(w)
+        self.assertRaises(OSError, cli.spawn, ["/bin/true"], stdin = r,
+                stdout = w)
+        os.close(r)
+        pid = cli.spawn(["/bin/true"])
+        self.assertEquals(cli.wait(pid), 0)
+        cli.shutdown()
+        t.join()
+
+    def test_x11_sock(self):
+        def x11_sock():
+            skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            skt.bind(("127.0.0.1", 0))
+            return skt
+        def same_socket(fd, skt):
+            peer = socket.fromfd(fd, socket.AF_INET, socket.SOCK_DGRAM)
+            os.close(fd)
+            return peer.getsockname() == skt.getsockname()
+
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+        srv = nemu.protocol.Server(s0, s0)
+        t = threading.Thread(target = srv.run)
+        t.start()
+        cli = nemu.protocol.Client(s1, s1)
+        events = []
+        cli.subscribe(lambda *args: events.append(args))
+        pid = cli.spawn(["/bin/true"])
+        # The exit notification is left unread before the reply
+        time.sleep(0.2)
+        srv._xsock = skt = x11_sock()
+        cli._send_cmd("X11", "SOCK")
+        code, text, fd = cli._read_reply()
+        self.assertEquals(code, 200)
+        self.assertTrue(same_socket(fd, skt))
+        self.assertEquals([e[0:2] for e in events], [(pid, 0)])
+        self.assertEquals(cli.wait(pid), 0)
+        cli.shutdown()
+        t.join()
+
+        # In text mode, it is sent before the reply
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+        srv = nemu.protocol.Server(s0, s0)
+        t = threading.Thread(target = srv.run)
+        t.start()
+        cli = nemu.protocol.Client(s1, s1, binary = False)
+        srv._xsock = skt = x11_sock()
+        self.assertTrue(same_socket(cli._recv_x11_sock(), skt))
+        cli.shutdown()
+        t.join()
+
+    def test_async_wait(self):
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+
+        def run_server():
+            nemu.protocol.Server(s0, s0).run()
+        t = threading.Thread(target = run_server)
+        t.start()
+
+        cli = nemu.protocol.Client(s1, s1)
+        events = []
+        cli.subscribe(lambda *args: events.append(args))
+        pid = cli.spawn(["/bin/sh", "-c", "sleep 0.3; exit 3"])
+        # The server keeps answering while a process is being waited on
+        wait_id = cli._send_cmd("PROC", "WAIT", pid)
+        self.assertEquals(cli.get_if_data(1).index, 1)
+        self.assertEquals(cli.poll(pid), None)
+        self.assertEquals(events, [])
+        code, text, payload = cli._read_reply(wait_id)
+        self.assertEquals((code, int(text.split()[0])), (200, 3 << 8))
+        self.assertEquals(len(events), 1)
+        self.assertEquals(events[0][0:2], (pid, 3 << 8))
+        self.assertTrue(events[0][2].ru_utime >= 0)
+        # Already collected
+        self.assertRaises(RuntimeError, cli.poll, pid)
+
+        cli.unsubscribe()
+        pid = cli.spawn(["/bin/true"])
+        self.assertEquals(cli.wait(pid), 0)
+        self.assertEquals(len(events), 1)
+        cli.shutdown()
+        t.join()
+
+    def test_listen(self):
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+
+        def run_server():
+            nemu.protocol.Server(s0, s0).run()
+        t = threading.Thread(target = run_server)
+        t.start()
+
+        cli = nemu.protocol.Client(s1, s1)
+        path = "/tmp/nemu-test-%d.ctl" % os.getpid()
+        cli.listen(path, [65534])
+        self.assertEquals(os.stat(path).st_mode & 0777, 0666)
+        cli2 = nemu.protocol.Client.connect(path)
+        cli3 = nemu.protocol.Client.connect(path, binary = False)
+        # Processes are shared by all the connections
+        pid = cli2.spawn(["/bin/sh", "-c", "sleep 0.2"])
+        wait_id = cli._send_cmd("PROC", "WAIT", pid)
+        self.assertEquals(cli3.get_if_data(1).index, 1)
+        self.assertRaises(RuntimeError, cli2.listen, "")
+        self.assertEquals(cli._read_reply(wait_id)[0], 200)
+        self.assertRaises(RuntimeError, cli3.poll, pid)
+        cli3.shutdown()
+        self.assertEquals(cli2.get_if_data(1).index, 1)
+        if os.getuid() == 0:
+            # An allowed user other than root can connect, but does not get
+            # root privileges in the node
+            rootpid = cli.spawn(["sleep", "10"])
+            pid = os.fork()
+            if not pid:
+                step = 1
+                try:
+                    os.setuid(65534)
+                    c = nemu.protocol.Client.connect(path)
+                    assert c.get_if_data(1).index == 1
+                    step = 2
+                    p = c.spawn(["/bin/sh", "-c", 'test "$(id -u)" = 65534'])
+                    assert c.wait(p) == 0
+                    step = 3
+                    for func, args in ((c.spawn, (["true"], None, None, None,
+                        None, None, None, "root")), (c.call, (os.getpid,)),
+                            (c.set_env_template, ("x", {})),
+                            (c.signal, (rootpid,))):
+                        try:
+                            func(*args)
+                        except (RuntimeError, ValueError):
+                            step += 1
+                            continue
+                        raise AssertionError
+                    os._exit(0)
+                except:
+                    pass
+                os._exit(step)
+            self.assertEquals(os.waitpid(pid, 0)[1], 0)
+            cli.signal(rootpid)
+            self.assertEquals(os.WTERMSIG(cli.wait(rootpid)), signal.SIGTERM)
+
+        # Abstract namespace, and credentials check
+        name = "@nemu-test-%d" % os.getpid()
+        cli.listen(name)
+        self.assertFalse(os.path.exists(path))
+        cli4 = nemu.protocol.Client.connect(name)
+        self.assertEquals(cli4.get_if_data(1).index, 1)
+        if os.getuid() == 0:
+            pid = os.fork()
+            if not pid:
+                try:
+                    os.setuid(65534)
+                    nemu.protocol.Client.connect(name)
+                except RuntimeError:
+                    os._exit(0)
+                except:
+                    pass
+                os._exit(1)
+            self.assertEquals(os.waitpid(pid, 0)[1], 0)
+
+        # The secondary connections are closed with the main one
+        cli.shutdown()
+        t.join()
+        self.assertRaises((RuntimeError, OSError), cli2.get_if_data, 1)
+        # Shutting them down afterwards just closes them
+        cli2.shutdown()
+        cli4.shutdown()
+        self.assertEquals((cli4._rfd, cli4._wfd), (None, None))
+
+    def test_shm_payloads(self):
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+
+        def run_server():
+            nemu.protocol.Server(s0, s0).run()
+        t = threading.Thread(target = run_server)
+        t.start()
+
+        cli = nemu.protocol.Client(s1, s1, shm_threshold = 1)
+        cli._send_cmd("IF", "LIST")
+        code, text, payload = cli._read_reply()
+        self.assertEquals(code, 200)
+        self.assertTrue(isinstance(payload, mmap.mmap))
+        ifdata = nemu.protocol._unserialise(payload)
+        self.assertEquals(ifdata[1].index, 1)
+        self.assertEquals(cli.get_if_data(1).index, 1)
+        # Small replies and exceptions still work
+        self.assertRaises(KeyError, cli.get_if_data, -1)
+        pid = cli.spawn(["/bin/true"])
+        self.assertEquals(cli.wait(pid), 0)
+        replies = cli.batch([("IF", "LIST", 1), ("ADDR", "LIST", 1)])
+        self.assertEquals([r[0] for r in replies], [200, 200])
+        cli._send_cmd("MODE", "SHM", 0)
+        cli._read_and_check_reply()
+        cli._send_cmd("IF", "LIST")
+        self.assertEquals(type(cli._read_reply()[2]), str)
+        cli.shutdown()
+        t.join()
+
+        fd = nemu.protocol._make_shm("foo" * 1000)
+        m = nemu.protocol._map_shm(fd, 3000)
+        self.assertEquals(m[0:6], "foofoo")
+        self.assertRaises(OSError, os.fstat, fd)
+
+    def test_text_client(self):
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+
+        def run_server():
+            nemu.protocol.Server(s0, s0).run()
+        t = threading.Thread(target = run_server)
+        t.start()
+
+        cli = nemu.protocol.Client(s1, s1, binary = False)
+        self.assertEquals(cli.get_if_data(1).index, 1)
+        r, w = os.pipe()
+        pid = cli.spawn(["/bin/echo", "hello  world"], stdout = w)
+        os.close(w)
+        self.assertEquals(os.read(r, 100), "hello  world\n")
+        self.assertEquals(cli.wait(pid), 0)
+        os.close(r)
+        cli.shutdown()
+        t.join()
+
+    def test_stats(self):
+        (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+
+        def run_server():
+            nemu.protocol.Server(s0, s0).run()
+        t = threading.Thread(target = run_server)
+        t.start()
+
+        cli = nemu.protocol.Client(s1, s1)
+        cli.get_stats(reset = True)
+        cli.start_profiler()
+        self.assertEquals(cli.get_if_data(1).index, 1)
+        self.assertRaises(KeyError, cli.get_if_data, -1)
+        prof = cli.stop_profiler()
+        self.assertTrue(prof.total_calls > 0)
+        self.assertRaises(RuntimeError, cli.stop_profiler)
+
+        stats = cli.get_stats()
+        self.assertTrue(stats["uptime"] > 0)
+        ifl = stats["commands"]["IF LIST"]
+        self.assertEquals((ifl["count"], ifl["errors"]), (2, 1))
+        self.assertEquals(sum(ifl["histogram"]), 2)
+        self.assertEquals(len(ifl["histogram"]), len(stats["buckets"]) + 1)
+        self.assertTrue(ifl["max"] <= ifl["time"])
+        self.assertEquals(stats["commands"]["PROF ON"]["count"], 1)
+        self.assertTrue(stats["children"]["ip"][0] > 0)
+        self.assertEquals(stats["client"]["IF LIST"]["count"], 2)
+        self.assertEquals(stats["client"]["PROF OFF"]["errors"], 1)
+        self.assertEquals(stats["client"]["STAT"]["count"], 1)
+        cli.shutdown()
+        t.join()
+
     def test_basic_stuff(self):
         (s0, s1) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
         srv = nemu.protocol.Server(s0, s0)
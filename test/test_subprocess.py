@@ -3,7 +3,7 @@
 
 import nemu, test_util
 import nemu.subprocess_ as sp
-import grp, os, pwd, signal, socket, sys, time, unittest
+import grp, mmap, os, pwd, signal, socket, sys, time, unittest
 
 def _stat(path):
     try:
@@ -76,6 +76,47 @@ class TestSubprocess(unittest.TestCase):
         os.kill(pid, signal.SIGTERM)
         self.assertEquals(sp.wait(pid), signal.SIGTERM)
 
+    def test_user_cache(self):
+        sp.flush_user_cache()
+        calls = []
+        orig = pwd.getpwnam
+        def getpwnam(name):
+            calls.append(name)
+            return orig(name)
+        pwd.getpwnam = getpwnam
+        ttl = sp.USER_CACHE_TTL
+        try:
+            nobody = sp.resolve_user('nobody')
+            self.assertEquals(nobody[0:4], ('nobody',) + orig('nobody')[2:4] +
+                (orig('nobody')[5],))
+            self.assertEquals(sp.get_user('nobody'), nobody[0:3])
+            self.assertEquals(calls, ['nobody'])
+            self.assertRaises(ValueError, sp.resolve_user, self.nouser)
+            self.assertRaises(ValueError, sp.resolve_user, self.nouid)
+            # Errors are not cached
+            self.assertRaises(ValueError, sp.resolve_user, self.nouser)
+            self.assertEquals(len(calls), 3)
+
+            sp.flush_user_cache()
+            sp.resolve_user('nobody')
+            self.assertEquals(len(calls), 4)
+            sp.flush_user_cache()
+            sp.USER_CACHE_TTL = -1
+            sp.resolve_user('nobody')
+            sp.resolve_user('nobody', pin = True)
+            self.assertEquals(len(calls), 6)
+            # Pinned entries do not expire
+            sp.resolve_user('nobody')
+            self.assertEquals(len(calls), 6)
+        finally:
+            pwd.getpwnam = orig
+            sp.USER_CACHE_TTL = ttl
+            sp.flush_user_cache()
+
+        node = nemu.Node(nonetns = True)
+        node.set_user_cache_ttl(30)
+        node.flush_user_cache()
+
     @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
     def test_Subprocess_chuser(self):
         node = nemu.Node(nonetns = True)
@@ -131,6 +172,63 @@ class TestSubprocess(unittest.TestCase):
         os.close(r0)
         self.assertEquals(sp.wait(p), 0)
 
+    def test_spawn_paths(self):
+        # The posix_spawn and fork paths must set up processes the same way
+        script = 'echo $$ $(ps -o pgid= -p $$) $(pwd) $FOO; echo err >&2'
+        results = []
+        try:
+            for fast in (True, False):
+                sp.USE_POSIX_SPAWN = fast
+                r, w = os.pipe()
+                p = sp.spawn('sh', ['sh', '-c', script], stdout = w,
+                        stderr = w, cwd = '/', close_fds = True,
+                        env = {'FOO': 'bar', 'PATH': '/bin:/usr/bin'})
+                os.close(w)
+                out = _readall(r).split()
+                os.close(r)
+                self.assertEquals(sp.wait(p), 0)
+                self.assertEquals(out[0:2], [str(p), str(p)])
+                results.append(out[2:])
+                self.assertRaises(OSError, sp.spawn, self.nofile)
+                self.assertRaises(OSError, sp.spawn, '/bin/true',
+                        cwd = self.nofile)
+        finally:
+            sp.USE_POSIX_SPAWN = True
+        self.assertEquals(results, [['/', 'bar', 'err']] * 2)
+
+    def test_close_fds_from(self):
+        # The second time, as in an architecture with unknown system call
+        # numbers: /proc/self/fd is used
+        for unknown in (False, True):
+            r, w = os.pipe()
+            extra = [os.dup(r) for i in range(3)] + [r]
+            pid = os.fork()
+            if pid == 0: # pragma: no cover
+                if unknown:
+                    sp._close_range = sp._NR_close_range = None
+                sp._close_fds_from(3, keep = w)
+                still_open = []
+                for fd in [0, 1, 2] + extra:
+                    try:
+                        os.fstat(fd)
+                        still_open.append(str(fd))
+                    except OSError:
+                        pass
+                os.write(w, " ".join(still_open))
+                os._exit(0)
+            os.close(w)
+            self.assertEquals(_readall(r), "0 1 2")
+            os.waitpid(pid, 0)
+            for fd in extra:
+                os.close(fd)
+
+        nr = sp._NR_pidfd_open
+        sp._NR_pidfd_open = None
+        try:
+            self.assertEquals(sp._pidfd_open(os.getpid()), None)
+        finally:
+            sp._NR_pidfd_open = nr
+
     def test_Subprocess_basic(self):
         node = nemu.Node(nonetns = True)
         # User does not exist
@@ -305,6 +403,290 @@ class TestSubprocess(unittest.TestCase):
                 stdin = sp.PIPE, stdout = sp.PIPE, stderr = sp.PIPE)
         self.assertEquals(p.communicate(_longstring), (_longstring, ) * 2)
 
+        # Pipes keep the system capacity unless asked otherwise
+        r, w = os.pipe()
+        default = sp._get_pipe_size(r)
+        os.close(r)
+        os.close(w)
+        p = node.Popen('cat', stdin = sp.PIPE, stdout = sp.PIPE)
+        self.assertEquals(sp._get_pipe_size(p.stdout.fileno()), default)
+        p.communicate()
+        p = node.Popen('cat', stdin = sp.PIPE, stdout = sp.PIPE,
+                pipesize = default * 2)
+        self.assertEquals(sp._get_pipe_size(p.stdout.fileno()), default * 2)
+        self.assertEquals(sp._get_pipe_size(p.stdin.fileno()), default * 2)
+        self.assertEquals(p.communicate(_longstring), (_longstring, None))
+
+    def test_communicate_timeout(self):
+        node = nemu.Node(nonetns = True)
+        data = "0123456789abcdef" * (512 * 1024)
+        p = node.Popen('cat', stdin = sp.PIPE, stdout = sp.PIPE,
+                stderr = sp.PIPE)
+        out, err = p.communicate(data, timeout = 30)
+        self.assertTrue(out == data)
+        self.assertEquals(err, "")
+
+        p = node.Popen(['sh', '-c', 'echo foo; sleep 1; echo bar'],
+                stdout = sp.PIPE)
+        try:
+            p.communicate(timeout = 0.3)
+            self.fail("TimeoutExpired not raised")
+        except sp.TimeoutExpired, e:
+            self.assertEquals(e.output, "foo\n")
+        self.assertEquals(p.communicate(timeout = 5), ("foo\nbar\n", None))
+        self.assertEquals(p.returncode, 0)
+
+        # Output closed, but the process keeps running
+        p = node.Popen(['sh', '-c', 'exec >&-; sleep 1'], stdout = sp.PIPE)
+        self.assertRaises(sp.TimeoutExpired, p.communicate, timeout = 0.3)
+        self.assertEquals(p.communicate(), ("", None))
+
+        # Timed waits do not poll the node
+        p = node.Popen(['sh', '-c', 'exec >&-; sleep 0.5'], stdout = sp.PIPE)
+        polls = []
+        orig = node._slave.poll
+        node._slave.poll = lambda *args, **kwargs: polls.append(args) or \
+                orig(*args, **kwargs)
+        try:
+            self.assertEquals(p.communicate(timeout = 5), ("", None))
+        finally:
+            node._slave.poll = orig
+        self.assertEquals((p.returncode, polls), (0, []))
+
+    def test_iter_output(self):
+        node = nemu.Node(nonetns = True)
+        script = 'for i in 1 2 3; do echo $i; echo e$i >&2; done; printf end'
+        p = node.Popen(['sh', '-c', script], stdout = sp.PIPE,
+                stderr = sp.PIPE)
+        lines = {"stdout": [], "stderr": []}
+        for name, line in p.iter_lines():
+            lines[name].append(line)
+        self.assertEquals(lines["stdout"], ["1\n", "2\n", "3\n", "end"])
+        self.assertEquals(lines["stderr"], ["e1\n", "e2\n", "e3\n"])
+        self.assertEquals(p.wait(), 0)
+
+        # Long lines are split
+        p = node.Popen(['sh', '-c', 'head -c 10000 /dev/zero; echo'],
+                stdout = sp.PIPE)
+        lines = [l for n, l in p.iter_lines(max_line = 4096)]
+        self.assertEquals(map(len, lines), [4096, 4096, 1809])
+
+        # Chunks are bounded, and nothing is buffered beyond them
+        p = node.Popen(['head', '-c', '10000000', '/dev/zero'],
+                stdout = sp.PIPE)
+        sizes = [len(d) for n, d in p.iter_chunks(size = 65536)]
+        self.assertEquals(sum(sizes), 10000000)
+        self.assertTrue(max(sizes) <= 65536)
+
+        p = node.Popen(['sh', '-c', 'echo a; sleep 1; echo b'],
+                stdout = sp.PIPE)
+        it = p.iter_lines(timeout = 0.3)
+        self.assertEquals(it.next(), ("stdout", "a\n"))
+        self.assertRaises(sp.TimeoutExpired, it.next)
+
+        got = []
+        self.assertEquals(p.stream_output(
+            lambda n, l: got.append(l), lines = True), 0)
+        self.assertEquals(got, ["b\n"])
+
+    def test_spool(self):
+        node = nemu.Node(nonetns = True)
+        p = node.Popen(['sh', '-c', 'head -c 3000000 /dev/zero; echo err >&2'],
+                stdout = nemu.SPOOL, stderr = sp.PIPE)
+        out, err = p.communicate()
+        self.assertTrue(isinstance(out, mmap.mmap))
+        self.assertEquals(len(out), 3000000)
+        self.assertEquals(out[0:3], "\0\0\0")
+        self.assertEquals(err, "err\n")
+        self.assertTrue(p.stdout.closed)
+
+        p = node.Popen(['sh', '-c', 'echo out; echo err >&2'],
+                stdout = nemu.SPOOL, stderr = nemu.STDOUT)
+        self.assertEquals(p.communicate()[0][:], "out\nerr\n")
+        p = node.Popen('true', stdout = nemu.SPOOL, stderr = nemu.SPOOL)
+        self.assertEquals(p.communicate(), ("", ""))
+        self.assertRaises(ValueError, node.Popen, 'true', stdin = nemu.SPOOL)
+
+    def test_rusage(self):
+        node = nemu.Node(nonetns = True)
+        # Busy loop for a bit, and touch some memory
+        p = node.Subprocess(['python', '-c',
+            'x = "a" * (20 << 20)\nwhile sum(__import__("os").times()[:2]) ' +
+            '< 0.2: pass'])
+        self.assertEquals(p.rusage, None)
+        self.assertEquals(p.wait(), 0)
+        self.assertTrue(p.rusage.ru_utime + p.rusage.ru_stime >= 0.2)
+        self.assertTrue(p.rusage.ru_maxrss >= 20 << 10)
+        self.assertTrue(p.rusage.ru_nvcsw + p.rusage.ru_nivcsw >= 0)
+
+        p = node.Subprocess('true')
+        while p.poll() == None:
+            time.sleep(0.01)
+        self.assertTrue(p.rusage.ru_maxrss > 0)
+
+        # The deferred reply of PROC WAIT carries it too
+        pid = node._slave.spawn(['sleep', '0.1'])
+        status, rusage = node._slave.wait(pid, rusage = True)
+        self.assertEquals(status, 0)
+        self.assertTrue(rusage.ru_maxrss > 0)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_direct(self):
+        node = nemu.Node()
+        p = node.Popen(['cat', '/proc/net/dev'], stdout = sp.PIPE,
+                direct = True)
+        out = p.communicate()[0]
+        self.assertEquals(p.returncode, 0)
+        self.assertTrue(p.rusage != None)
+        # Only the loopback of the node is seen
+        self.assertEquals([l.split(":")[0].strip()
+            for l in out.split("\n")[2:] if l], ["lo"])
+        self.assertTrue(p.pid in node._processes)
+
+        # Without posix_spawn, the child joins the name space itself
+        sp.USE_POSIX_SPAWN = False
+        try:
+            p = node.Popen(['cat', '/proc/net/dev'], stdout = sp.PIPE,
+                    direct = True)
+            self.assertEquals(p.communicate()[0], out)
+        finally:
+            sp.USE_POSIX_SPAWN = True
+        # The calling thread is back in its own name space
+        self.assertEquals(os.readlink("/proc/thread-self/ns/net"),
+                os.readlink("/proc/self/ns/net"))
+
+        p = node.Subprocess(['sleep', '10'], direct = True)
+        q = node.Subprocess(['sleep', '10'])
+        self.assertEquals(nemu.wait_any([p, q], 0.2), ([], [p, q]))
+        p.signal()
+        self.assertEquals(nemu.wait_any([p, q], 5), ([p], [q]))
+        self.assertEquals(p.returncode, -signal.SIGTERM)
+        r = node.Subprocess(['sleep', '10'], direct = True)
+        node.destroy()
+        self.assertEquals(r.returncode, -signal.SIGTERM)
+
+        self.assertRaises(OSError, nemu.Node().Subprocess, self.nofile,
+                direct = True)
+
+    def test_spawn_many(self):
+        node = nemu.Node(nonetns = True)
+        r, w = os.pipe()
+        procs = node.spawn_many([
+            {'argv': ['sh', '-c', 'echo "$A$B"'], 'stdout': w},
+            {'argv': 'echo "$A$B"', 'shell': True, 'stdout': w,
+                'env': {'B': 'y'}},
+            {'argv': ['pwd'], 'stdout': w, 'cwd': '/'},
+            ], cwd = '/tmp', env = {'A': 'x', 'B': 'z',
+                'PATH': os.environ['PATH']})
+        self.assertEquals(len(procs), 3)
+        self.assertEquals(nemu.wait_all(procs, 5)[1], [])
+        self.assertEquals([p.returncode for p in procs], [0, 0, 0])
+        os.close(w)
+        out = _readall(r)
+        os.close(r)
+        self.assertEquals(sorted(out.split()), ["/", "xy", "xz"])
+        null = open("/dev/null", "w")
+        self.assertEquals([p.returncode for p in
+            nemu.wait_all(node.spawn_many([{'argv': ['pwd'], 'stdout': null},
+                ['true']]))[0]], [0, 0])
+        null.close()
+
+        # All or nothing
+        before = set(node._processes.keys())
+        self.assertRaises(OSError, node.spawn_many,
+                [['sleep', '10'], [self.nofile]])
+        self.assertEquals(set(node._processes.keys()), before)
+        self.assertEquals(node.spawn_many([]), [])
+
+    def test_env_template(self):
+        node = nemu.Node(nonetns = True)
+        node.set_env_template("default", {'A': 'x', 'B': 'y',
+            'PATH': os.environ['PATH']})
+        p = node.Popen(['sh', '-c', 'echo "$A-$B-$C"'], stdout = sp.PIPE,
+                env_template = "default", env = {'B': None, 'C': 'z'})
+        self.assertEquals(p.communicate()[0], "x--z\n")
+        p = node.Popen(['sh', '-c', 'echo "$A-$B-$C"'], stdout = sp.PIPE,
+                env_template = "default")
+        self.assertEquals(p.communicate()[0], "x-y-\n")
+
+        r, w = os.pipe()
+        procs = node.spawn_many([
+            {'argv': ['sh', '-c', 'echo "$A$B"'], 'stdout': w},
+            {'argv': ['sh', '-c', 'echo "$A$B"'], 'stdout': w,
+                'env': {'A': None}},
+            ], env_template = "default", env = {'B': 'w'})
+        self.assertEquals(nemu.wait_all(procs, 5)[1], [])
+        os.close(w)
+        out = _readall(r)
+        os.close(r)
+        self.assertEquals(sorted(out.split()), ["w", "xw"])
+
+        self.assertEquals(node._slave.expand_env("default", {'A': None}),
+                {'B': 'y', 'PATH': os.environ['PATH']})
+        node.del_env_template("default")
+        self.assertRaises(ValueError, node.Subprocess, ['true'],
+                env_template = "default")
+        self.assertRaises(ValueError, node.spawn_many, [['true']],
+                env_template = "default")
+        self.assertRaises(RuntimeError, node.del_env_template, "default")
+        # The node server is still usable
+        self.assertEquals(node.Subprocess(['true']).wait(), 0)
+
+    def test_wait_many(self):
+        node1 = nemu.Node(nonetns = True)
+        node2 = nemu.Node(nonetns = True)
+        short = node1.Subprocess(['sleep', '0.2'])
+        long1 = node1.Subprocess(['sleep', '10'])
+        long2 = node2.Subprocess(['sleep', '10'])
+        t = time.time()
+        done, pending = nemu.wait_any([short, long1, long2], 5)
+        self.assertTrue(time.time() - t < 2)
+        self.assertEquals(done, [short])
+        self.assertEquals(pending, [long1, long2])
+        self.assertEquals(short.returncode, 0)
+        self.assertTrue(short.rusage != None)
+        # Already finished
+        self.assertEquals(nemu.wait_any([short, long1]), ([short], [long1]))
+
+        # Time out, and the processes can still be waited for
+        t = time.time()
+        self.assertEquals(nemu.wait_all([short, long1, long2], 0.3),
+                ([short], [long1, long2]))
+        self.assertTrue(time.time() - t >= 0.3)
+        self.assertEquals(long1.poll(), None)
+
+        long1.signal()
+        long2.signal()
+        self.assertEquals(nemu.wait_all([long1, long2], 5),
+                ([long1, long2], []))
+        self.assertEquals(long1.returncode, -signal.SIGTERM)
+        self.assertEquals(long2.returncode, -signal.SIGTERM)
+
+    def test_wait_many_text_mode(self):
+        # Text mode connections cannot send wait requests: processes are
+        # polled instead
+        node = nemu.Node(nonetns = True)
+        path = "/tmp/nemu-test-%d.ctl" % os.getpid()
+        node.listen(path)
+        main = node._slave
+        node._slave = text = nemu.protocol.Client.connect(path, binary = False)
+        try:
+            short = node.Subprocess(['sleep', '0.2'])
+            long1 = node.Subprocess(['sleep', '10'])
+            long2 = node.Subprocess(['sleep', '10'])
+            p = node.Popen(['sh', '-c', 'echo foo'], stdout = sp.PIPE)
+        finally:
+            node._slave = main
+        self.assertEquals(nemu.wait_any([short, long1], 5), ([short], [long1]))
+        self.assertEquals(nemu.wait_all([long1], 0.2), ([], [long1]))
+        self.assertEquals(p.communicate(timeout = 5), ("foo\n", None))
+        long1.destroy()
+        self.assertEquals(long1.returncode, -signal.SIGTERM)
+        node.destroy()
+        self.assertEquals(long2.returncode, -signal.SIGTERM)
+        text.shutdown()
+        self.assertFalse(os.path.exists(path))
+
     def test_backticks(self):
         node = nemu.Node(nonetns = True)
         self.assertEquals(node.backticks("echo hello world"), "hello world\n")